@@ -0,0 +1,276 @@
+"""Parallel archive import from several source devices.
+
+Sources are grouped by device (st_dev). Each device gets one reader thread
+that walks its sources sequentially, so a card is never read by two
+threads at once, while different devices are read concurrently. Readers
+push the file data through a bounded queue to a single writer thread, the
+only one writing to the destination disk.
+
+"""
+
+import os
+import Queue
+import shutil
+import threading
+
+import archiveplan
+import contentindex
+import fastcopy
+import filehash
+from picturearchiver import BACKUP_FILE_EXTS, CopyResult, PictureArchiver
+
+DEFAULT_QUEUE_SIZE = 32
+DEFAULT_BLOCK_SIZE = 1024 * 1024
+
+_OPEN, _DATA, _CLOSE, _ABORT, _FINISH = range(5)
+
+
+class _WriteJob(object):
+    __slots__ = ("archiver", "src_file", "dest_file", "file", "preallocated", "sync", "replace", "error")
+
+    def __init__(self, archiver, src_file, dest_file):
+        # The _PipelineArchiver copying the file, the write errors are reported through it
+        self.archiver = archiver
+        self.src_file = src_file
+        self.dest_file = dest_file
+        self.file = None
+        self.preallocated = False
+        # fsync the file before closing it, in verify mode
+        self.sync = False
+        # Overwrite dest_file if it exists, the open fails otherwise
+        self.replace = False
+        self.error = None
+
+
+class _PipelineArchiver(PictureArchiver):
+    """PictureArchiver that hands the destination writes to the pipeline writer thread."""
+
+    def __init__(self, src_path, dest_path):
+        PictureArchiver.__init__(self, src_path, dest_path)
+        self._pipeline = None
+        # The _WriteJob of the file being archived, if it is copied
+        self._job = None
+
+    def _copy_file(self, src_file, dest_file, header=None, replace=False):
+        pipeline = self._pipeline
+        if not pipeline.claim(dest_file):
+            raise IOError(dest_file + " is already being copied from another source")
+
+        job = _WriteJob(self, src_file, dest_file)
+        job.sync = self._verify
+        job.replace = replace
+        hasher = filehash.new_hasher("md5") if self._verify else None
+        opened = False
+        try:
+            with open(src_file, "rb") as f:
+                size = os.fstat(f.fileno()).st_size
+                if header is not None:
+                    size += len(header.data) - header.skip
+                    f.seek(header.skip)
+                pipeline.put(job, _OPEN, size)
+                opened = True
+                if header is not None:
+                    if hasher is not None:
+                        hasher.update(header.data)
+                    pipeline.put(job, _DATA, header.data)
+                while True:
+                    buf = f.read(pipeline.block_size)
+                    if not buf:
+                        break
+                    if hasher is not None:
+                        hasher.update(buf)
+                    pipeline.put(job, _DATA, buf)
+        except:
+            if opened:
+                pipeline.put(job, _ABORT)
+            else:
+                pipeline.release(dest_file)
+            raise
+
+        pipeline.put(job, _CLOSE)
+        self._job = job
+        return CopyResult(hasher.hexdigest() if hasher is not None else None, header is not None)
+
+    def log_summary(self, prefix=""):
+        # The copies are not finished when the walk ends, ArchivePipeline.run() logs it.
+        pass
+
+    def _finish_file(self, src_file, dest_file, src_size, picture_date, info, move, copy_result=None, operation=None):
+        # Runs in the writer thread once every byte queued before has been written.
+        job, self._job = self._job, None
+        self._pipeline.put(None, _FINISH, (self._finish_written,
+                                           (job, src_file, dest_file, src_size, picture_date, info, move,
+                                            copy_result, operation)))
+
+    def _finish_written(self, job, src_file, dest_file, src_size, picture_date, info, move, copy_result, operation):
+        if job is not None and job.error is not None:
+            # The file in dest_file, if any, is not the copy.
+            if operation is not None:
+                self._plan.set_state(operation, archiveplan.FAILED)
+            return
+        try:
+            PictureArchiver._finish_file(self, src_file, dest_file, src_size, picture_date, info, move, copy_result,
+                                         operation)
+        except Exception as exp:
+            self._error(exp)
+            if operation is not None:
+                self._plan.set_state(operation, archiveplan.FAILED)
+
+
+class ArchivePipeline(object):
+    def __init__(self, dest_path, queue_size=DEFAULT_QUEUE_SIZE, block_size=DEFAULT_BLOCK_SIZE):
+        self._dest_path = dest_path
+        self._queue = Queue.Queue(queue_size)
+        self._devices = {}
+        self._claimed = set()
+        self._lock = threading.Lock()
+        self._archivers = []
+        self._progress = None
+        self.block_size = block_size
+
+    def add_source(self, src_path):
+        """Adds a source folder, folders in the same device are imported one after the other."""
+        device = os.stat(src_path).st_dev
+        self._devices.setdefault(device, []).append(src_path)
+
+    def put(self, job, kind, data=None):
+        self._queue.put((job, kind, data))
+
+    def claim(self, dest_file):
+        with self._lock:
+            if dest_file in self._claimed:
+                return False
+            self._claimed.add(dest_file)
+            return True
+
+    def release(self, dest_file):
+        with self._lock:
+            self._claimed.discard(dest_file)
+
+    def _write(self, job, kind, data):
+        if kind == _FINISH:
+            func, args = data
+            func(*args)
+            return
+
+        if job.error is not None:
+            if kind in (_CLOSE, _ABORT):
+                self.release(job.dest_file)
+            return
+
+        try:
+            if kind == _OPEN:
+                job.file = fastcopy.open_destination(job.dest_file, job.replace)
+                job.preallocated = fastcopy.preallocate(job.file.fileno(), data)
+            elif kind == _DATA:
+                job.file.write(data)
+            elif kind == _CLOSE:
+                if job.preallocated:
+                    job.file.truncate(job.file.tell())
+                if job.sync:
+                    job.file.flush()
+                    os.fsync(job.file.fileno())
+                job.file.close()
+                shutil.copymode(job.src_file, job.dest_file)
+                self.release(job.dest_file)
+            elif kind == _ABORT:
+                job.file.close()
+                os.remove(job.dest_file)
+                self.release(job.dest_file)
+        except (IOError, OSError) as e:
+            job.error = e
+            job.archiver._error(e)
+            if job.file is not None:
+                job.file.close()
+                # Whatever was written can't be trusted, the file must not pass for a finished copy.
+                if os.path.exists(job.dest_file):
+                    os.remove(job.dest_file)
+            if kind in (_CLOSE, _ABORT):
+                self.release(job.dest_file)
+
+    def _writer(self):
+        while True:
+            job, kind, data = self._queue.get()
+            if kind is None:
+                break
+            try:
+                self._write(job, kind, data)
+            except Exception as e:
+                if job is not None:
+                    job.error = e
+                    job.archiver._error(e)
+                else:
+                    self._print(u"ERROR: " + unicode(e))
+
+    def _reader(self, archivers):
+        for archiver in archivers:
+            archiver._print("Starting import from " + archiver._srcPath)
+            try:
+                archiver.archive_pictures()
+            except Exception as e:
+                archiver._error(e)
+
+    def _print(self, text):
+        if self._progress is not None:
+            self._progress.note(text)
+        else:
+            print text
+
+    def _on_advance(self, archiver):
+        # The progress of all the sources together, their readers advance at the same time.
+        count = total_count = size = total_size = 0
+        for archiver in self._archivers:
+            done, total, done_size, total_bytes = archiver.get_progress()
+            count += done
+            total_count += total
+            size += done_size
+            total_size += total_bytes
+        self._progress.set_total(total_count, total_size)
+        self._progress.set_done(count, size)
+
+    def run(self, diagnostics, move, start_size, verify=False, dedup=None, catalog=None, resume=True, progress=None):
+        """Imports all the sources, returns the archivers used (one per source folder).
+
+        Args:
+          progress: The progress.Progress of the whole import, the messages are written through it too.
+        """
+        self._progress = progress
+        content_index = None
+        if dedup is not None:
+            content_index = contentindex.ContentIndex(self._dest_path, BACKUP_FILE_EXTS)
+            self._print("Indexing " + self._dest_path)
+            content_index.refresh()
+
+        all_archivers = []
+        readers = []
+        for device, sources in self._devices.items():
+            archivers = []
+            for src_path in sources:
+                archiver = _PipelineArchiver.create(src_path, self._dest_path, diagnostics, move, start_size,
+                                                    verify, dedup, content_index, catalog, resume)
+                archiver._pipeline = self
+                if progress is not None:
+                    archiver.progress = progress
+                    archiver.onAdvance = self._on_advance
+                archivers.append(archiver)
+            all_archivers += archivers
+            readers.append(threading.Thread(target=self._reader, args=(archivers, )))
+        self._archivers = all_archivers
+
+        writer = threading.Thread(target=self._writer)
+        writer.start()
+        for reader in readers:
+            reader.start()
+
+        for reader in readers:
+            reader.join()
+
+        self.put(None, None)
+        writer.join()
+
+        for archiver in all_archivers:
+            if archiver._plan is not None:
+                # The last files were still queued when the reader tried.
+                archiver._plan.finish()
+            PictureArchiver.log_summary(archiver, archiver._srcPath + ": ")
+        return all_archivers
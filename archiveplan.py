@@ -0,0 +1,251 @@
+"""Journaled archive plan.
+
+The archiver first walks the source and decides what to do with every
+file (the plan), then executes it. The plan is stored in picture-data.db
+and every operation is marked as it completes, so an interrupted run is
+resumed from the first pending operation without scanning or dating the
+source again. The marks are written in batches, every operation can be
+executed again safely if the run stops before its mark was written.
+
+"""
+
+import datetime
+import os
+import threading
+import time
+
+import utils
+from db import BuffData
+
+MKDIR = "mkdir"
+COPY = "copy"
+MOVE = "move"
+LINK = "link"
+SKIP = "skip"
+RMDIR = "rmdir"
+
+PENDING = "pending"
+DONE = "done"
+FAILED = "failed"
+
+FILE_OPERATIONS = (COPY, MOVE, LINK, SKIP)
+
+# note of the MOVE operations that are a rename, inside the same device
+RENAME = "rename"
+# note of the COPY operations over a smaller file already in the destination
+REPLACE = "replace"
+
+COPY_RATE_KEY = "archive_copy_rate"
+DEFAULT_COPY_RATE = 20 * 1024 * 1024
+
+# Estimated seconds spent on every copied file besides the data copy (open, date correction...) and on the
+# operations that only change metadata (rename, mkdir...)
+_OPERATION_COST = 0.005
+_METADATA_COST = 0.0005
+
+# Operation states are written to the database every this many operations or seconds
+_FLUSH_COUNT = 256
+_FLUSH_INTERVAL = 2.0
+
+_DATE_FORMATS = ("%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M:%S.%f")
+
+
+def _parse_date(value):
+    if value is None:
+        return None
+    for date_format in _DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, date_format)
+        except ValueError:
+            pass
+    return None
+
+
+class Operation(object):
+    """One step of the plan. note is the message logged for SKIP, the archived file to link for LINK, RENAME for a
+    MOVE inside the same device and REPLACE for a COPY over an existing file."""
+    __slots__ = ("seq", "op", "src", "dest", "size", "date", "note", "state")
+
+    def __init__(self, seq, op, src=None, dest=None, size=0, date=None, note=None, state=PENDING):
+        self.seq = seq
+        self.op = op
+        self.src = src
+        self.dest = dest
+        self.size = size
+        self.date = date
+        self.note = note
+        self.state = state
+
+    def row(self):
+        return (self.seq, self.op, self.src, self.dest, self.size,
+                self.date.isoformat() if self.date is not None else None, self.note, self.state)
+
+
+class ArchivePlan(object):
+    def __init__(self, src_path, dest_path, move):
+        self.src_path = src_path
+        self.dest_path = dest_path
+        self.move = move
+        self.operations = []
+        self.plan_id = None
+        # Time the plan was made and if it is the one of an interrupted run
+        self.created = time.time()
+        self.resumed = False
+        # seq of the operations that failed in the interrupted run, pending again
+        self.retried = set()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._updates = []
+        self._flushed = time.time()
+
+    def _get_data(self):
+        # Operations are marked from the pipeline writer thread too.
+        data = getattr(self._local, "data", None)
+        if data is None:
+            data = self._local.data = BuffData()
+        return data
+
+    def add(self, op, src=None, dest=None, size=0, date=None, note=None):
+        # Nothing to execute for a skip, it is only recorded to be counted.
+        operation = Operation(len(self.operations), op, src, dest, size, date, note, DONE if op == SKIP else PENDING)
+        self.operations.append(operation)
+        return operation
+
+    def save(self):
+        self.plan_id = self._get_data().create_archive_plan(self.src_path, self.dest_path, self.move,
+                                                            [operation.row() for operation in self.operations])
+
+    @classmethod
+    def load_open(cls, src_path, dest_path, move):
+        """Returns the plan of an interrupted run with the same folders and mode, None if there is none.
+
+        The operations that failed are pending again, to be retried.
+        """
+        plan = cls(src_path, dest_path, move)
+        data = plan._get_data()
+        open_plan = data.get_open_archive_plan(src_path, dest_path, move)
+        if open_plan is None:
+            return None
+
+        plan.plan_id, created = open_plan
+        created = _parse_date(created)
+        plan.created = time.mktime(created.timetuple()) if created is not None else None
+        plan.resumed = True
+
+        for seq, op, src, dest, size, picture_date, note, state in data.get_archive_plan(plan.plan_id):
+            if state == FAILED:
+                plan.retried.add(seq)
+                state = PENDING
+            plan.operations.append(Operation(seq, op, src, dest, size, _parse_date(picture_date), note, state))
+        return plan
+
+    def matches_source(self):
+        """True if the sources of the pending operations are still there with the size they were planned with.
+
+        Camera cards mount at the same path, the plan of another card must not be resumed for the one inserted now.
+        """
+        for operation in self.pending():
+            if operation.op not in (COPY, MOVE, LINK):
+                continue
+            try:
+                size = os.path.getsize(operation.src)
+            except OSError:
+                if operation.op == MOVE and os.path.isfile(operation.dest):
+                    # Moved when the run was interrupted.
+                    continue
+                return False
+            if operation.op != LINK and size != operation.size:
+                return False
+        return True
+
+    @classmethod
+    def discard(cls, src_path, dest_path, move):
+        BuffData().discard_archive_plans(src_path, dest_path, move)
+
+    def pending(self):
+        return [operation for operation in self.operations if operation.state == PENDING]
+
+    def set_state(self, operation, state):
+        operation.state = state
+        if self.plan_id is None:
+            return
+
+        with self._lock:
+            self._updates.append((state, self.plan_id, operation.seq))
+            if len(self._updates) < _FLUSH_COUNT and time.time() - self._flushed < _FLUSH_INTERVAL:
+                return
+            updates = self._updates
+            self._updates = []
+            self._flushed = time.time()
+        self._get_data().set_archive_operation_states(updates)
+
+    def flush(self):
+        with self._lock:
+            updates = self._updates
+            self._updates = []
+            self._flushed = time.time()
+        if updates:
+            self._get_data().set_archive_operation_states(updates)
+
+    def finish(self):
+        """Closes the plan if every operation was executed, returns True if it was closed."""
+        if self.plan_id is None:
+            return False
+        self.flush()
+        return self._get_data().finish_archive_plan(self.plan_id, PENDING)
+
+    def summary(self, operations=None):
+        """Returns {op: (count, bytes)} of the given operations, all of them by default."""
+        result = {}
+        for operation in operations if operations is not None else self.operations:
+            count, size = result.get(operation.op, (0, 0))
+            result[operation.op] = (count + 1, size + (operation.size or 0))
+        return result
+
+    def estimate(self, operations=None, copy_rate=None):
+        """Returns the estimated seconds to execute the operations, all of them by default."""
+        if copy_rate is None:
+            copy_rate = get_copy_rate()
+
+        total = 0.0
+        for operation in operations if operations is not None else self.operations:
+            if operation.op == SKIP:
+                continue
+            if operation.op == COPY or (operation.op == MOVE and operation.note != RENAME):
+                total += _OPERATION_COST + float(operation.size or 0) / copy_rate
+            else:
+                total += _METADATA_COST
+        return total
+
+    def describe(self, operations=None):
+        """One line summary of the operations and their cost."""
+        summary = self.summary(operations)
+        parts = []
+        for op in (COPY, MOVE, LINK, MKDIR, RMDIR, SKIP):
+            if op in summary:
+                count, size = summary[op]
+                text = str(count) + " " + op
+                if op in (COPY, MOVE) and size:
+                    text += " (" + utils.sizeof_fmt(size) + ")"
+                parts.append(text)
+        return ", ".join(parts or ["nothing to do"]) + ". Estimated time: " + \
+            utils.format_time(self.estimate(operations))
+
+
+def get_copy_rate():
+    """Bytes per second copied to the archive measured in the last runs, or a conservative default."""
+    value = BuffData().get_setting(COPY_RATE_KEY)
+    try:
+        return float(value) if value else DEFAULT_COPY_RATE
+    except ValueError:
+        return DEFAULT_COPY_RATE
+
+
+def record_copy_rate(size, seconds):
+    """Updates the measured copy rate with a run that copied size bytes in seconds, short runs are ignored."""
+    if size < 64 * 1024 * 1024 or seconds <= 0:
+        return
+    rate = size / seconds
+    # Smoothed, a single run with the disk cache warm or a slow card should not swing the estimates.
+    rate = 0.5 * rate + 0.5 * get_copy_rate()
+    BuffData().set_setting(COPY_RATE_KEY, str(rate))
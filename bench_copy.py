@@ -0,0 +1,87 @@
+#!/usr/bin/python
+# coding=UTF8
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import fastcopy
+import utils
+
+
+def make_file(file_name, size):
+    chunk = os.urandom(min(size, 1024 * 1024))
+    with open(file_name, "wb") as f:
+        written = 0
+        while written < size:
+            f.write(chunk[:size - written])
+            written += len(chunk)
+
+
+def copy_all(copy, files, dest_folder):
+    stt = time.time()
+    size = 0
+    for file_name in files:
+        dest_file = os.path.join(dest_folder, os.path.basename(file_name))
+        copy(file_name, dest_file)
+        size += os.path.getsize(dest_file)
+        os.remove(dest_file)
+    return size, time.time() - stt
+
+
+def bench(title, files, dest_folder):
+    print title
+    methods = [("shutil.copy", shutil.copy), ("fastcopy", fastcopy.copy_file)]
+    for name in (fastcopy.COPY_FILE_RANGE, fastcopy.SENDFILE, fastcopy.BLOCKS):
+        methods.append((name, lambda src, dst, name=name: fastcopy.copy_file(src, dst, [name])))
+
+    for name, copy in methods:
+        try:
+            size, elapsed = copy_all(copy, files, dest_folder)
+        except (IOError, OSError) as e:
+            print "  %-16s failed: %s" % (name, e)
+            continue
+        print "  %-16s %8.1f MB/s %8.2f s" % (name, size / elapsed / (1024 * 1024), elapsed)
+
+    dest_file = os.path.join(dest_folder, "method_check")
+    print "  fastcopy uses", fastcopy.copy_file(files[0], dest_file)
+    os.remove(dest_file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the kernel assisted copy against shutil.copy.')
+    parser.add_argument('source', help='Folder where the test files are created.', nargs='?', default=None)
+    parser.add_argument('destination', help='Folder where the test files are copied.', nargs='?', default=None)
+    parser.add_argument('-n', dest="count", type=int, help='Number of small JPEG sized files', default=200)
+    parser.add_argument('-z', dest="small_size", type=int, help='Size in KB of the small files', default=4096)
+    parser.add_argument('-v', dest="video_size", type=int, help='Size in MB of the video sized file', default=2048)
+    options = parser.parse_args()
+
+    src_folder = tempfile.mkdtemp(prefix="bench_copy_src_", dir=options.source)
+    dest_folder = tempfile.mkdtemp(prefix="bench_copy_dst_", dir=options.destination)
+    try:
+        small_files = []
+        for i in xrange(options.count):
+            file_name = os.path.join(src_folder, "IMG_%05d.jpg" % i)
+            make_file(file_name, options.small_size * 1024)
+            small_files.append(file_name)
+
+        video_file = os.path.join(src_folder, "VID_00001.mp4")
+        make_file(video_file, options.video_size * 1024 * 1024)
+
+        print "Source files may be in the page cache, drop it between runs for cold numbers."
+        bench(str(options.count) + " files of " + utils.sizeof_fmt(options.small_size * 1024), small_files,
+              dest_folder)
+        bench("1 file of " + utils.sizeof_fmt(options.video_size * 1024 * 1024), [video_file], dest_folder)
+    finally:
+        shutil.rmtree(src_folder)
+        shutil.rmtree(dest_folder)
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print "Terminated by user."
@@ -0,0 +1,128 @@
+#!/usr/bin/python
+# coding=UTF8
+
+import argparse
+import os
+import shutil
+import struct
+import tempfile
+import time
+
+import exifreader
+import utils
+
+
+def _ifd(entries, offset, next_ifd=0):
+    """Builds a little endian IFD at offset, entries are (tag, type, count, data) with data already packed."""
+    data_offset = offset + 2 + len(entries) * 12 + 4
+    body = struct.pack("<H", len(entries))
+    extra = b""
+    for tag, field_type, count, data in entries:
+        if len(data) <= 4:
+            body += struct.pack("<HHI", tag, field_type, count) + data.ljust(4, b"\x00")
+        else:
+            body += struct.pack("<HHII", tag, field_type, count, data_offset + len(extra))
+            extra += data
+    return body + struct.pack("<I", next_ifd) + extra
+
+
+def _rationals(*values):
+    return b"".join(struct.pack("<II", n, d) for n, d in values)
+
+
+def make_exif_segment(date, padding):
+    date_str = date.strftime("%Y:%m:%d %H:%M:%S").encode("ascii") + b"\x00"
+    padding_data = b"\x00" * padding
+
+    # IFD0 is at 8, its size doesn't depend on the pointers values.
+    ifd0_len = len(_ifd([(0x0132, 2, 20, date_str), (0x8769, 4, 1, b"\x00" * 4), (0x8825, 4, 1, b"\x00" * 4),
+                         (0x927c, 7, padding, padding_data)], 8))
+    exif_offset = 8 + ifd0_len
+    exif_ifd = _ifd([(0x9003, 2, 20, date_str), (0x9004, 2, 20, date_str)], exif_offset)
+    gps_offset = exif_offset + len(exif_ifd)
+    gps_ifd = _ifd([(0x0001, 2, 2, b"N\x00"), (0x0002, 5, 3, _rationals((9, 1), (56, 1), (1234, 100))),
+                    (0x0003, 2, 2, b"W\x00"), (0x0004, 5, 3, _rationals((84, 1), (5, 1), (4321, 100)))], gps_offset)
+    ifd0 = _ifd([(0x0132, 2, 20, date_str), (0x8769, 4, 1, struct.pack("<I", exif_offset)),
+                 (0x8825, 4, 1, struct.pack("<I", gps_offset)), (0x927c, 7, padding, padding_data)], 8)
+
+    tiff = b"II*\x00" + struct.pack("<I", 8) + ifd0 + exif_ifd + gps_ifd
+    payload = b"Exif\x00\x00" + tiff
+    return b"\xff\xe1" + struct.pack(">H", len(payload) + 2) + payload
+
+
+def make_corpus(folder, count, image_size, padding):
+    import datetime
+
+    image_data = os.urandom(image_size)
+    base = datetime.datetime(2015, 1, 1)
+    for i in xrange(count):
+        date = base + datetime.timedelta(hours=i)
+        with open(os.path.join(folder, "IMG_%05d.jpg" % i), "wb") as f:
+            f.write(b"\xff\xd8")
+            f.write(make_exif_segment(date, padding))
+            f.write(b"\xff\xda\x00\x02")
+            f.write(image_data)
+            f.write(b"\xff\xd9")
+
+
+def read_with_pyexiv2(file_name):
+    import pyexiv2
+
+    exif_data = pyexiv2.ImageMetadata(file_name)
+    exif_data.read()
+    return utils.read_picture_date(exif_data)
+
+
+def read_with_exifreader(file_name):
+    return utils.read_picture_date(exifreader.read_exif(file_name))
+
+
+def bench(name, reader, files):
+    stt = time.time()
+    found = 0
+    for file_name in files:
+        if reader(file_name) is not None:
+            found += 1
+    elapsed = time.time() - stt
+    print "%-12s %6d files %8.3f s %10.1f files/s (%d dates found)" % (name, len(files), elapsed,
+                                                                       len(files) / elapsed, found)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the header-only EXIF reader against pyexiv2.')
+    parser.add_argument('folder', help='Folder with JPEG files, a synthetic corpus is created if not given.',
+                        nargs='?', default=None)
+    parser.add_argument('-n', dest="count", type=int, help='Number of synthetic pictures', default=2000)
+    parser.add_argument('-z', dest="image_size", type=int, help='Size in KB of the synthetic image data',
+                        default=256)
+    parser.add_argument('-p', dest="padding", type=int, help='Bytes of maker note padding in the EXIF data',
+                        default=16 * 1024)
+    options = parser.parse_args()
+
+    folder = options.folder
+    if folder is None:
+        folder = tempfile.mkdtemp(prefix="bench_exif_")
+        print "Creating", options.count, "pictures in", folder
+        make_corpus(folder, options.count, options.image_size * 1024, options.padding)
+
+    try:
+        files = [os.path.join(folder, name) for name in os.listdir(folder) if utils.is_picture(name)]
+        # Warm up the page cache so both readers measure parsing.
+        for file_name in files:
+            exifreader.read_exif(file_name)
+
+        bench("exifreader", read_with_exifreader, files)
+        try:
+            bench("pyexiv2", read_with_pyexiv2, files)
+        except ImportError:
+            print "pyexiv2 is not installed."
+    finally:
+        if options.folder is None:
+            shutil.rmtree(folder)
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print "Terminated by user."
@@ -0,0 +1,73 @@
+#!/usr/bin/python
+# coding=UTF8
+
+import argparse
+import os
+import tempfile
+import time
+
+import filehash
+import utils
+
+BLOCK_SIZES = [128, 64 * 1024, 256 * 1024, 1024 * 1024, 4 * 1024 * 1024, 16 * 1024 * 1024]
+
+
+def make_test_file(size_mb):
+    fd, file_name = tempfile.mkstemp(prefix="bench_hashing_")
+    chunk = os.urandom(1024 * 1024)
+    with os.fdopen(fd, "wb") as f:
+        for i in xrange(size_mb):
+            f.write(chunk)
+    return file_name
+
+
+def bench(file_name, algorithms, block_size, use_mmap):
+    size = os.path.getsize(file_name)
+    stt = time.time()
+    filehash.hash_file(file_name, algorithms, block_size, use_mmap)
+    elapsed = time.time() - stt
+    return size / elapsed / (1024 * 1024), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure file hashing throughput for each block size.')
+    parser.add_argument('file', help='The file to hash, a random one is created if not given.', nargs='?',
+                        default=None)
+    parser.add_argument('-z', dest="size_mb", type=int, help='Size in megabytes of the generated file', default=256)
+    parser.add_argument('-a', dest="algorithms", help='Comma separated list of digests',
+                        default=",".join(filehash.DEFAULT_ALGORITHMS))
+    options = parser.parse_args()
+
+    file_name = options.file
+    if file_name is None:
+        file_name = make_test_file(options.size_mb)
+
+    algorithms = options.algorithms.split(",")
+    try:
+        print "Hashing", file_name, "(" + utils.sizeof_fmt(os.path.getsize(file_name)) + ") with", \
+            ", ".join(algorithms)
+
+        # Warm up the page cache so every run measures hashing, not the disk.
+        filehash.hash_file(file_name, ("crc32",))
+
+        for block_size in BLOCK_SIZES:
+            for use_mmap in (False, True):
+                if block_size < 64 * 1024 and use_mmap:
+                    continue
+                mbs, elapsed = bench(file_name, algorithms, block_size, use_mmap)
+                print "%10s %-5s %8.1f MB/s %8.2f s" % (utils.sizeof_fmt(block_size), "mmap" if use_mmap else "read",
+                                                       mbs, elapsed)
+
+        for algorithm in filehash.available_algorithms():
+            mbs, elapsed = bench(file_name, (algorithm,), filehash.DEFAULT_BLOCK_SIZE, None)
+            print "%10s %8.1f MB/s" % (algorithm, mbs)
+    finally:
+        if options.file is None:
+            os.remove(file_name)
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print "Terminated by user."
@@ -0,0 +1,85 @@
+#!/usr/bin/python
+# coding=UTF8
+
+import argparse
+import httplib
+import os
+import threading
+import time
+import urlparse
+
+import httppool
+import utils
+from standinserver import StandInServer
+
+
+def post_new_connection(server, body):
+    url = urlparse.urlsplit(server.url)
+    if server.https:
+        connection = httplib.HTTPSConnection(url.hostname, url.port, context=server.client_context())
+    else:
+        connection = httplib.HTTPConnection(url.hostname, url.port)
+    try:
+        connection.request("POST", "/services/upload/", body, {"Content-Type": "image/jpeg"})
+        connection.getresponse().read()
+    finally:
+        connection.close()
+
+
+def post_pooled(pool, server, body):
+    pool.request("POST", server.url + "/services/upload/", body, {"Content-Type": "image/jpeg"}).read()
+
+
+def run(post, count, jobs, body):
+    def worker(n):
+        for i in xrange(n):
+            post(body)
+
+    threads = [threading.Thread(target=worker, args=(count // jobs + (1 if i < count % jobs else 0), ))
+               for i in xrange(jobs)]
+    stt = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.time() - stt
+
+
+def bench(title, server, post, count, jobs, body):
+    connections = server.connections
+    elapsed = run(post, count, jobs, body)
+    size = count * len(body)
+    print "  %-16s %8.1f MB/s %8.1f req/s %8.2f s %6d connections" % (
+        title, size / elapsed / (1024 * 1024), count / elapsed, elapsed, server.connections - connections)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare a connection per request against the keep-alive pool '
+                                                 'uploading to a local stand-in server.')
+    parser.add_argument('-n', dest="count", type=int, help='Number of uploads', default=200)
+    parser.add_argument('-z', dest="size", type=int, help='Size in KB of each upload', default=3072)
+    parser.add_argument('-j', dest="jobs", type=int, help='Uploads at the same time', default=4)
+    parser.add_argument('-p', dest="plain", action="store_true", help='Plain HTTP instead of HTTPS')
+    options = parser.parse_args()
+
+    server = StandInServer(not options.plain)
+    server.start()
+    try:
+        body = os.urandom(options.size * 1024)
+        pool = httppool.ConnectionPool(options.jobs, ssl_context=server.client_context())
+        print options.count, "uploads of", utils.sizeof_fmt(len(body)), "to", server.url
+        for jobs in sorted(set([1, options.jobs])):
+            print str(jobs) + " at a time:"
+            bench("new connection", server, lambda data: post_new_connection(server, data), options.count, jobs,
+                  body)
+            bench("pooled", server, lambda data: post_pooled(pool, server, data), options.count, jobs, body)
+        pool.close()
+    finally:
+        server.stop()
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print "Terminated by user."
@@ -0,0 +1,73 @@
+#!/usr/bin/python
+# coding=UTF8
+
+import argparse
+import cStringIO
+import multiprocessing
+import multiprocessing.pool
+import os
+import time
+
+import Image
+
+import dirwalker
+import fastresize
+import utils
+
+
+def resize_full(file_name):
+    """The resize GoogleUploader did before, without the pyexiv2 copy of the metadata."""
+    img = Image.open(file_name)
+    size = fastresize.target_size(img.size[0], img.size[1], fastresize.DEFAULT_MAX_WIDTH)
+    if size is None:
+        return None
+    out = cStringIO.StringIO()
+    img.resize(size, Image.ANTIALIAS).save(out, "JPEG", quality=fastresize.DEFAULT_QUALITY)
+    return out.getvalue()
+
+
+def bench(title, files, resize):
+    stt = time.time()
+    for file_name in files:
+        resize(file_name)
+    elapsed = time.time() - stt
+    print "  %-16s %8.2f s %8.1f files/s" % (title, elapsed, len(files) / elapsed)
+
+
+def bench_pool(title, files, processes):
+    pool = fastresize.ResizePool(processes)
+    # The upload pipeline calls it from several transform threads.
+    threads = multiprocessing.pool.ThreadPool(max(processes, 1))
+    stt = time.time()
+    for spool_name in threads.imap_unordered(pool.resize, files):
+        if spool_name is not None:
+            os.remove(spool_name)
+    elapsed = time.time() - stt
+    threads.close()
+    pool.close()
+    print "  %-16s %8.2f s %8.1f files/s" % (title, elapsed, len(files) / elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the full decode resize against the draft mode one.')
+    parser.add_argument('folder', help='Folder with the JPEG files to resize')
+    parser.add_argument('-n', dest="count", type=int, help='Number of files', default=50)
+    options = parser.parse_args()
+
+    files = []
+    for entry in dirwalker.walk(options.folder, [".jpg", ".jpeg"]):
+        files.append(entry.path)
+        if len(files) >= options.count:
+            break
+
+    print len(files), "files,", utils.sizeof_fmt(sum(os.path.getsize(f) for f in files))
+    bench("full decode", files, resize_full)
+    bench("draft mode", files, fastresize.resize)
+    bench_pool("draft, pool", files, multiprocessing.cpu_count())
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print "Terminated by user."
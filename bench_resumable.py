@@ -0,0 +1,96 @@
+#!/usr/bin/python
+# coding=UTF8
+
+import argparse
+import hashlib
+import os
+import tempfile
+import time
+
+import httppool
+import resumable
+import utils
+from db import BuffData
+from standinserver import StandInServer
+
+SERVICE_NAME = "bench-resumable"
+
+
+class Interrupted(Exception):
+    pass
+
+
+def upload(server, pool, data, file_name, md5sum, chunk_size, stop_after=None):
+    chunks = [0]
+
+    def on_progress(offset):
+        chunks[0] += 1
+        if stop_after is not None and chunks[0] >= stop_after:
+            raise Interrupted()
+
+    upload = resumable.ResumableUpload(data, SERVICE_NAME, file_name, md5sum, chunk_size, pool, on_progress)
+    body = upload.upload(server.url + "/upload/resumable/feed/api/user/default/albumid/1", "<entry/>",
+                         "application/atom+xml", "video/mp4")
+    return upload, body
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Upload a file in chunks to a local stand-in server that injects '
+                                                 'faults, stopping the upload halfway and resuming it.')
+    parser.add_argument('-z', dest="size", type=int, help='Size in MB of the file', default=64)
+    parser.add_argument('-c', dest="chunk", type=int, help='Chunk size in KB', default=1024)
+    parser.add_argument('-f', dest="faults", type=float, help='Fraction of the chunks that fail', default=0.2)
+    parser.add_argument('-k', dest="stop_after", type=int, help='Stop after that many chunks, then resume',
+                        default=10)
+    parser.add_argument('-b', dest="backoff", type=float, help='Base of the backoff in seconds', default=0.05)
+    parser.add_argument('-p', dest="plain", action="store_true", help='Plain HTTP instead of HTTPS')
+    options = parser.parse_args()
+
+    resumable.BACKOFF_BASE = options.backoff
+    resumable.RETRY_ATTEMPTS = 20
+
+    handle, file_name = tempfile.mkstemp(prefix="resumable_", suffix=".mp4")
+    server = StandInServer(not options.plain, faults=options.faults)
+    server.start()
+    data = BuffData()
+    try:
+        with os.fdopen(handle, "wb") as f:
+            for i in xrange(options.size):
+                f.write(os.urandom(1024 * 1024))
+        md5sum = utils.get_md5sum_from_file(file_name)
+        pool = httppool.ConnectionPool(2, ssl_context=server.client_context())
+        size = options.size * 1024 * 1024
+        print "Uploading", utils.sizeof_fmt(size), "in chunks of", utils.sizeof_fmt(options.chunk * 1024), "to", \
+            server.url, "with", str(int(options.faults * 100)) + "% of faults"
+
+        stt = time.time()
+        if options.stop_after:
+            try:
+                upload(server, pool, data, file_name, md5sum, options.chunk * 1024, options.stop_after)
+            except Interrupted:
+                print "  Stopped after", options.stop_after, "chunks"
+
+        uploaded, body = upload(server, pool, data, file_name, md5sum, options.chunk * 1024)
+        elapsed = time.time() - stt
+
+        session = server.sessions[max(server.sessions)]
+        received_md5 = hashlib.md5(session.data).hexdigest()
+        print "  Resumed from     ", utils.sizeof_fmt(uploaded.resumed_from)
+        print "  Faults injected  ", server.faults_injected
+        print "  Bytes sent       ", utils.sizeof_fmt(server.bytes_received), "(%.2fx the file)" % (
+            float(server.bytes_received) / size)
+        print "  Time             ", utils.format_time(elapsed), "(%.1f MB/s)" % (size / elapsed / (1024 * 1024))
+        print "  Session left     ", data.get_upload_session(SERVICE_NAME, file_name, md5sum)
+        print "  Content          ", "OK" if received_md5 == md5sum and "gphoto:id" in body else "CORRUPTED"
+        pool.close()
+    finally:
+        data.remove_upload_session(SERVICE_NAME, file_name)
+        server.stop()
+        os.remove(file_name)
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print "Terminated by user."
@@ -0,0 +1,218 @@
+"""Catalog of the files in the archive destination.
+
+Kept in an sqlite file next to the destination_folder marker so it moves
+with the disk. The archiver answers "does this file exist and how big is
+it" from the catalog instead of stat'ing the (possibly sleeping) backup
+disk for every imported file. Paths are stored relative to the
+destination folder.
+
+"""
+
+import os
+import random
+import sqlite3
+import threading
+from multiprocessing.pool import ThreadPool
+
+import dirwalker
+import utils
+
+CATALOG_FILE_NAME = "destination_catalog.db"
+DEFAULT_JOBS = 8
+
+
+def catalog_file(dest_path):
+    return os.path.join(dest_path, CATALOG_FILE_NAME)
+
+
+def _scan_tree(dir_name):
+    """Lists a sub tree for rebuild(), returns ([(path, size, mtime_ns)], [(path, mtime_ns)])."""
+    files = []
+    dirs = []
+    for entry in dirwalker.walk(dir_name, yield_dirs=True):
+        try:
+            st = entry.stat()
+        except OSError:
+            continue
+        if entry.is_dir:
+            dirs.append((entry.path, utils.stat_mtime_ns(st)))
+        else:
+            files.append((entry.path, st.st_size, utils.stat_mtime_ns(st)))
+    return files, dirs
+
+
+class Catalog(object):
+    def __init__(self, dest_path):
+        self._root = dest_path
+        self._lock = threading.Lock()
+        # Shared by the pipeline reader and writer threads, every access holds the lock.
+        self._connection = sqlite3.connect(catalog_file(dest_path), timeout=30.0, check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, dir TEXT, size INTEGER, mtime_ns INTEGER)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS files_dir ON files (dir)")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, mtime_ns INTEGER)")
+
+    @classmethod
+    def open_existing(cls, dest_path):
+        """Returns the catalog of dest_path, None if it was never built."""
+        if not os.path.isfile(catalog_file(dest_path)):
+            return None
+        return cls(dest_path)
+
+    def _relative(self, path):
+        path = os.path.relpath(path, self._root)
+        return "" if path == "." else path
+
+    def _execute(self, sql, args=()):
+        with self._lock:
+            return self._connection.execute(sql, args).fetchall()
+
+    def get(self, path):
+        """Returns (size, mtime_ns) of path, None if it is not in the catalog."""
+        result = self._execute("SELECT size, mtime_ns FROM files WHERE path = ?", (self._relative(path), ))
+        return result[0] if result else None
+
+    def has_dir(self, path):
+        return len(self._execute("SELECT 1 FROM dirs WHERE path = ?", (self._relative(path), ))) == 1
+
+    def _set_dir(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+        self._connection.execute("INSERT OR REPLACE INTO dirs (path, mtime_ns) VALUES(?, ?)",
+                                 (self._relative(path), utils.stat_mtime_ns(st)))
+
+    def add(self, path):
+        """Records a file just written to the destination, and the folders created for it."""
+        st = os.stat(path)
+        rel_path = self._relative(path)
+        with self._lock:
+            with self._connection:
+                self._connection.execute("INSERT OR REPLACE INTO files (path, dir, size, mtime_ns) VALUES(?, ?, ?, ?)",
+                                         (rel_path, os.path.dirname(rel_path), st.st_size, utils.stat_mtime_ns(st)))
+                dir_name = os.path.dirname(path)
+                while True:
+                    # The mtime of the folder changed, the new ones must be added.
+                    self._set_dir(dir_name)
+                    if self._relative(dir_name) == "":
+                        break
+                    dir_name = os.path.dirname(dir_name)
+
+    def remove(self, path):
+        with self._lock:
+            with self._connection:
+                self._connection.execute("DELETE FROM files WHERE path = ?", (self._relative(path), ))
+
+    def _replace_dir(self, dir_name, files, mtime_ns):
+        rel_dir = self._relative(dir_name)
+        self._connection.execute("DELETE FROM files WHERE dir = ?", (rel_dir, ))
+        self._connection.executemany(
+            "INSERT OR REPLACE INTO files (path, dir, size, mtime_ns) VALUES(?, ?, ?, ?)",
+            [(self._relative(path), rel_dir, size, file_mtime_ns) for path, size, file_mtime_ns in files])
+        self._connection.execute("INSERT OR REPLACE INTO dirs (path, mtime_ns) VALUES(?, ?)", (rel_dir, mtime_ns))
+
+    def rebuild(self, jobs=DEFAULT_JOBS):
+        """Lists the whole destination again, each top level folder in its own thread. Returns the number of files."""
+        top_files = []
+        subdirs = []
+        for entry in dirwalker.list_dir(self._root):
+            if entry.is_dir():
+                subdirs.append(entry.path)
+            elif entry.is_file() and not entry.name.startswith(CATALOG_FILE_NAME):
+                st = entry.stat()
+                top_files.append((entry.path, st.st_size, utils.stat_mtime_ns(st)))
+
+        pool = ThreadPool(jobs)
+        try:
+            trees = pool.map(_scan_tree, subdirs)
+        finally:
+            pool.close()
+            pool.join()
+
+        count = len(top_files)
+        with self._lock:
+            with self._connection:
+                self._connection.execute("DELETE FROM files")
+                self._connection.execute("DELETE FROM dirs")
+                self._replace_dir(self._root, top_files, utils.stat_mtime_ns(os.stat(self._root)))
+                for files, dirs in trees:
+                    by_dir = {}
+                    for path, size, mtime_ns in files:
+                        by_dir.setdefault(os.path.dirname(path), []).append((path, size, mtime_ns))
+                    for dir_name, mtime_ns in dirs:
+                        self._replace_dir(dir_name, by_dir.get(dir_name, []), mtime_ns)
+                    count += len(files)
+        return count
+
+    def check(self, sample=0, fix=True):
+        """Compares the catalog with the disk.
+
+        Stats every cataloged folder, a folder whose mtime changed had files added or removed. Files modified in
+        place don't change their folder, sample is the number of random files also stat'ed to detect them.
+
+        Returns:
+          The list of paths (folders and files) that did not match, they are updated in the catalog if fix is set.
+        """
+        stale = []
+        for rel_dir, mtime_ns in self._execute("SELECT path, mtime_ns FROM dirs"):
+            dir_name = os.path.join(self._root, rel_dir)
+            try:
+                if utils.stat_mtime_ns(os.stat(dir_name)) == mtime_ns:
+                    continue
+            except OSError:
+                pass
+            stale.append(dir_name)
+
+        if sample > 0:
+            count = self._execute("SELECT COUNT(*) FROM files")[0][0]
+            for offset in random.sample(xrange(count), min(sample, count)):
+                rel_path, size, mtime_ns = self._execute("SELECT path, size, mtime_ns FROM files LIMIT 1 OFFSET ?",
+                                                         (offset, ))[0]
+                path = os.path.join(self._root, rel_path)
+                try:
+                    st = os.stat(path)
+                    if st.st_size == size and utils.stat_mtime_ns(st) == mtime_ns:
+                        continue
+                except OSError:
+                    pass
+                stale.append(path)
+
+        if fix:
+            for path in stale:
+                self._fix(path)
+        return stale
+
+    def _fix(self, path):
+        rel_path = self._relative(path)
+        new_dirs = []
+        with self._lock:
+            with self._connection:
+                if os.path.isfile(path):
+                    st = os.stat(path)
+                    self._connection.execute(
+                        "INSERT OR REPLACE INTO files (path, dir, size, mtime_ns) VALUES(?, ?, ?, ?)",
+                        (rel_path, os.path.dirname(rel_path), st.st_size, utils.stat_mtime_ns(st)))
+                elif os.path.isdir(path):
+                    files = []
+                    for entry in dirwalker.list_dir(path):
+                        if entry.is_dir():
+                            known = self._connection.execute("SELECT 1 FROM dirs WHERE path = ?",
+                                                             (self._relative(entry.path), )).fetchall()
+                            if not known:
+                                new_dirs.append(entry.path)
+                        elif entry.is_file() and not entry.name.startswith(CATALOG_FILE_NAME):
+                            st = entry.stat()
+                            files.append((entry.path, st.st_size, utils.stat_mtime_ns(st)))
+                    self._replace_dir(path, files, utils.stat_mtime_ns(os.stat(path)))
+                else:
+                    self._connection.execute("DELETE FROM files WHERE path = ? OR dir = ?", (rel_path, rel_path))
+                    self._connection.execute("DELETE FROM dirs WHERE path = ?", (rel_path, ))
+
+        for dir_name in new_dirs:
+            self._fix(dir_name)
+
+    def get_stats(self):
+        count, size = self._execute("SELECT COUNT(*), SUM(size) FROM files")[0]
+        dirs = self._execute("SELECT COUNT(*) FROM dirs")[0][0]
+        return count, size or 0, dirs
@@ -0,0 +1,133 @@
+"""Adaptive limit of concurrent transfers.
+
+Additive increase, multiplicative decrease: after every window of
+transfers the limit grows by one while the aggregate throughput keeps
+improving, is halved as soon as the service throttles (HTTP 429/503) or
+too many transfers fail, and shrinks by one when a bigger limit did not
+help or the transfers got slower. On a plateau the limit is held, it is
+only probed one higher after a few stable windows.
+
+"""
+
+import threading
+import time
+
+THROTTLING_STATUS = (429, 503)
+
+# Seconds and transfers (times the limit) of a measuring window
+WINDOW_SECONDS = 5.0
+WINDOW_TRANSFERS = 2
+
+_ERROR_RATE = 0.2
+_MIN_GAIN = 1.05
+_MAX_LATENCY_GROWTH = 1.5
+# Windows without a change before the limit is probed one higher
+_PROBE_WINDOWS = 3
+
+
+def is_throttling(error):
+    """True if error is the service asking to slow down."""
+    status = getattr(error, "status", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    try:
+        return int(status) in THROTTLING_STATUS
+    except (TypeError, ValueError):
+        return False
+
+
+class AimdLimiter(object):
+    def __init__(self, initial, maximum, minimum=1):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = min(max(initial, self.minimum), self.maximum)
+        self.decision = None
+        self._active = 0
+        self._cond = threading.Condition()
+        self._last = None
+        self._increased = False
+        self._decreased = 0
+        self._stable = 0
+        self._start_window()
+
+    def _start_window(self):
+        self._window_start = time.time()
+        self._bytes = 0
+        self._transfers = 0
+        self._errors = 0
+        self._throttled = 0
+        self._latency = 0.0
+
+    def acquire(self):
+        with self._cond:
+            while self._active >= self.limit:
+                self._cond.wait(1.0)
+            self._active += 1
+
+    def throttled(self):
+        """The service throttled a transfer that is retried without releasing its slot."""
+        with self._cond:
+            self._throttled += 1
+            self._update()
+
+    def release(self, size, seconds, error=False, throttled=False):
+        """Ends a transfer of size bytes that took seconds."""
+        with self._cond:
+            self._active -= 1
+            self._transfers += 1
+            self._latency += seconds
+            if throttled:
+                self._throttled += 1
+            elif error:
+                self._errors += 1
+            else:
+                self._bytes += size
+            self._update()
+            self._cond.notify_all()
+
+    def _set_limit(self, limit, reason):
+        limit = min(max(limit, self.minimum), self.maximum)
+        self._increased = limit > self.limit
+        if limit != self.limit:
+            self._stable = 0
+            self.decision = str(self.limit) + " -> " + str(limit) + " (" + reason + ")"
+            self.limit = limit
+
+    def _update(self):
+        if self._throttled:
+            # The transfers started before the last decrease are throttled too, it is not halved again for them.
+            if time.time() - self._decreased > WINDOW_SECONDS:
+                self._set_limit(self.limit // 2, "throttled")
+                self._decreased = time.time()
+            self._start_window()
+            return
+
+        elapsed = time.time() - self._window_start
+        if elapsed < WINDOW_SECONDS or self._transfers < WINDOW_TRANSFERS * self.limit:
+            return
+
+        throughput = self._bytes / elapsed
+        latency = self._latency / self._transfers
+        if float(self._errors) / self._transfers > _ERROR_RATE:
+            self._set_limit(self.limit // 2, "errors")
+            self._decreased = time.time()
+        elif self._last is None or throughput > self._last[0] * _MIN_GAIN:
+            self._set_limit(self.limit + 1, "faster")
+        elif self._increased:
+            # The last increase did not pay off, the transfers only share the same bandwidth.
+            self._set_limit(self.limit - 1, "no gain")
+        elif latency > self._last[1] * _MAX_LATENCY_GROWTH:
+            self._set_limit(self.limit - 1, "slower")
+        elif self._stable + 1 >= _PROBE_WINDOWS:
+            # Probe again, the link may have more room now.
+            self._set_limit(self.limit + 1, "probe")
+        else:
+            # A plateau, the limit is held.
+            self._stable += 1
+
+        self._last = (throughput, latency)
+        self._start_window()
+
+    def describe(self):
+        with self._cond:
+            return str(self._active) + "/" + str(self.limit) + " uploads"
@@ -0,0 +1,122 @@
+"""Content addressed index of the archive destination.
+
+Finds a file with the same content anywhere in the archive in three
+tiers: the size (from the index, no I/O), then a partial hash of the
+first and last 64 KB and only then the full md5sum, so most incoming
+files are told apart without reading the archived ones. The index is
+kept in picture-data.db and refreshed incrementally, only the folders
+that changed since the last refresh are listed again.
+
+"""
+
+import os
+import threading
+
+import dirwalker
+import filehash
+import utils
+from db import BuffData
+from dirindex import DirIndex
+
+SKIP = "skip"
+LINK = "link"
+
+
+class ContentIndex(object):
+    def __init__(self, root, extensions=None):
+        """
+        Args:
+          root: The archive destination folder.
+          extensions: Only the files with these extensions are indexed, all of them if None.
+        """
+        # The entries are scoped to the root, the same database serves every destination disk.
+        self._root = os.path.abspath(root)
+        self._extensions = extensions
+        self._local = threading.local()
+
+    def _get_data(self):
+        # sqlite connections can't be shared between threads, the pipeline looks up and adds from different ones.
+        data = getattr(self._local, "data", None)
+        if data is None:
+            data = self._local.data = BuffData()
+        return data
+
+    def refresh(self):
+        """Indexes the files added, changed or removed since the last refresh, returns the number of folders listed."""
+        if not os.path.isdir(self._root):
+            # Not mounted, its entries are kept for when it is.
+            return 0
+        data = self._get_data()
+        dir_index = DirIndex(data, "content-index:" + self._root)
+        pending = {}
+        listed = 0
+        for entry in dirwalker.walk(self._root, self._extensions, yield_dirs=True, unchanged=dir_index.unchanged):
+            if entry.is_dir:
+                data.set_content_dir(self._root, os.path.abspath(entry.path), pending.pop(entry.path, []))
+                dir_index.mark_entry(entry)
+                listed += 1
+            else:
+                pending.setdefault(entry.dir_name, []).append(
+                    (os.path.abspath(entry.path), entry.size, utils.stat_mtime_ns(entry.stat())))
+        return listed
+
+    def add(self, path):
+        """Indexes a file just archived."""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+        self._get_data().set_content_entry(self._root, os.path.abspath(path), st.st_size, utils.stat_mtime_ns(st))
+
+    def find(self, file_name, st=None):
+        """Returns the path of an archived file with the same content as file_name, None if there is none."""
+        data = self._get_data()
+        if st is None:
+            st = os.stat(file_name)
+        size = st.st_size
+
+        candidates = data.get_content_by_size(self._root, size)
+        if not candidates:
+            return None
+
+        partial = None
+        matches = []
+        for path, mtime_ns, candidate_partial in candidates:
+            try:
+                candidate_st = os.stat(path)
+            except OSError:
+                if os.path.isdir(self._root):
+                    data.remove_content_entry(self._root, path)
+                continue
+
+            if candidate_st.st_size != size or utils.stat_mtime_ns(candidate_st) != mtime_ns:
+                # Modified in place since it was indexed, e.g. its EXIF date corrected.
+                data.set_content_entry(self._root, path, candidate_st.st_size, utils.stat_mtime_ns(candidate_st))
+                if candidate_st.st_size != size:
+                    continue
+                candidate_partial = None
+
+            if os.path.samefile(path, file_name):
+                continue
+
+            if candidate_partial is None:
+                candidate_partial = filehash.partial_hash(path)
+                data.set_content_entry(self._root, path, size, utils.stat_mtime_ns(candidate_st), candidate_partial)
+
+            if partial is None:
+                partial = filehash.partial_hash(file_name)
+
+            if candidate_partial == partial:
+                if size <= 2 * filehash.PARTIAL_BLOCK_SIZE:
+                    # The partial hash covered the whole file.
+                    return path
+                matches.append((path, candidate_st))
+
+        if not matches:
+            return None
+
+        md5sum = data.get_file_md5sum(file_name, st)
+        for path, candidate_st in matches:
+            if data.get_file_md5sum(path, candidate_st) == md5sum:
+                return path
+        return None
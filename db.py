@@ -1,7 +1,10 @@
+import json
 import os
 import sqlite3
 import datetime
+import time
 import utils
+import filehash
 
 last_location_time_key = "last_location_time"
 CIPHER_KEY = "buJ&zb2u"
@@ -23,6 +26,44 @@ class BuffData:
             "CREATE TABLE IF NOT EXISTS location (timestamp INTEGER PRIMARY KEY, latitude REAL, longitude REAL, "
             "altitude REAL, address TEXT )")
         self._connection.execute("CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS file_hash (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, "
+            "inode INTEGER, device INTEGER, md5sum TEXT, sha256 TEXT, crc32 TEXT, hash_date TEXT )")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS dir_index (scope TEXT, path TEXT, mtime_ns INTEGER, file_count INTEGER, "
+            "subdirs TEXT, pass_date TEXT, PRIMARY KEY (scope, path) )")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS archived (dest_path TEXT PRIMARY KEY, md5sum TEXT, size INTEGER, "
+            "picture_date TEXT, archive_date TEXT )")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS archived_md5sum ON archived (md5sum)")
+        self._cursor.execute("PRAGMA table_info(content_index)")
+        columns = [row[1] for row in self._cursor.fetchall()]
+        if columns and "root" not in columns:
+            # Written before the entries were scoped to their archive root, the index is rebuilt on the next refresh.
+            with self._connection:
+                self._connection.execute("DROP TABLE content_index")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS content_index (root TEXT, path TEXT, dir TEXT, size INTEGER, "
+            "mtime_ns INTEGER, partial_hash TEXT, PRIMARY KEY (root, path) )")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS content_index_size ON content_index (root, size)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS content_index_dir ON content_index (root, dir)")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS archive_plans (plan_id INTEGER PRIMARY KEY AUTOINCREMENT, src_path TEXT, "
+            "dest_path TEXT, move INTEGER, created TEXT, finished TEXT )")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS archive_plan (plan_id INTEGER, seq INTEGER, op TEXT, src TEXT, dest TEXT, "
+            "size INTEGER, picture_date TEXT, note TEXT, state TEXT, PRIMARY KEY (plan_id, seq) )")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS remote_inventory (scope TEXT, remote_key TEXT, photo_id TEXT, sync_date TEXT, "
+            "PRIMARY KEY (scope, remote_key) )")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS upload_sessions (service TEXT, file_name TEXT, md5sum TEXT, session_url TEXT, "
+            "offset INTEGER, size INTEGER, created TEXT, PRIMARY KEY (service, file_name) )")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS upload_queue (scope TEXT, path TEXT, size INTEGER, state TEXT, "
+            "attempts INTEGER, worker TEXT, lease_until REAL, error TEXT, enqueued TEXT, finished TEXT, "
+            "PRIMARY KEY (scope, path) )")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS upload_queue_state ON upload_queue (scope, state)")
         self.CIPHER_KEY = utils.get_cipher_key(CIPHER_KEY)
 
 
@@ -153,4 +194,308 @@ class BuffData:
             with self._connection:
                 self._connection.execute(
                     "INSERT OR IGNORE INTO uploaded (file_name, photo_id, md5sum, upload_date)VALUES(?, ?, ?, ?) ",
-                    (file_name, service_name + "=" + photo_id, md5sum, service_name + "=" + date,))
\ No newline at end of file
+                    (file_name, service_name + "=" + photo_id, md5sum, service_name + "=" + date,))
+
+    def _get_cached_digests(self, file_name, st):
+        self._cursor.execute("SELECT md5sum, sha256, crc32 FROM file_hash WHERE path = ? AND size = ? AND "
+                             "mtime_ns = ? AND inode = ? AND device = ?",
+                             (file_name, st.st_size, utils.stat_mtime_ns(st), st.st_ino, st.st_dev))
+        result = self._cursor.fetchall()
+        if len(result) == 1:
+            md5sum, sha256, crc32 = result[0]
+            return {"md5": md5sum, "sha256": sha256, "crc32": crc32}
+        return None
+
+    def _set_cached_digests(self, file_name, st, digests):
+        with self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO file_hash (path, size, mtime_ns, inode, device, md5sum, sha256, crc32, "
+                "hash_date) VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (file_name, st.st_size, utils.stat_mtime_ns(st), st.st_ino, st.st_dev, digests["md5"],
+                 digests["sha256"], digests["crc32"], datetime.datetime.now().isoformat()))
+
+    def get_file_digests(self, file_name, st=None):
+        """Returns the md5, sha256 and crc32 digests of a file, hashing it only if it changed since last time."""
+        if st is None:
+            st = os.stat(file_name)
+
+        digests = self._get_cached_digests(file_name, st)
+        if digests is None:
+            digests = filehash.hash_file(file_name)
+            self._set_cached_digests(file_name, st, digests)
+
+        return digests
+
+    def get_file_md5sum(self, file_name, st=None):
+        return self.get_file_digests(file_name, st)["md5"]
+
+    def invalidate_file_digests(self, path):
+        """Forgets the cached digests of a file, or of every file under path if it is a folder."""
+        with self._connection:
+            cur = self._connection.execute("DELETE FROM file_hash WHERE path = ? OR path LIKE ? ESCAPE '\\'",
+                                           (path, utils.sql_like_escape(os.path.join(path, "")) + "%"))
+        return cur.rowcount
+
+    def vacuum_hash_cache(self):
+        """Removes the cached digests of the files that no longer exist or changed, returns the number removed."""
+        self._cursor.execute("SELECT path, size, mtime_ns, inode, device FROM file_hash")
+        stale = []
+        for path, size, mtime_ns, inode, device in self._cursor.fetchall():
+            try:
+                st = os.stat(path)
+                if st.st_size != size or utils.stat_mtime_ns(st) != mtime_ns or st.st_ino != inode or \
+                        st.st_dev != device:
+                    stale.append((path, ))
+            except OSError:
+                stale.append((path, ))
+
+        with self._connection:
+            self._connection.executemany("DELETE FROM file_hash WHERE path = ?", stale)
+        self._connection.execute("VACUUM")
+        return len(stale)
+
+    def get_hash_cache_stats(self):
+        self._cursor.execute("SELECT COUNT(*), SUM(size) FROM file_hash")
+        count, size = self._cursor.fetchone()
+        return count, size or 0
+
+    def get_dir_index(self, scope, path):
+        self._cursor.execute("SELECT mtime_ns, file_count, subdirs FROM dir_index WHERE scope = ? AND path = ?",
+                             (scope, path))
+        result = self._cursor.fetchall()
+        if len(result) == 1:
+            mtime_ns, file_count, subdirs = result[0]
+            return mtime_ns, file_count, json.loads(subdirs)
+        return None
+
+    def set_dir_index(self, scope, path, mtime_ns, file_count, subdirs):
+        with self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO dir_index (scope, path, mtime_ns, file_count, subdirs, pass_date) "
+                "VALUES(?, ?, ?, ?, ?, ?)",
+                (scope, path, mtime_ns, file_count, json.dumps(subdirs), datetime.datetime.now().isoformat()))
+
+    def clear_dir_index(self, scope):
+        with self._connection:
+            self._connection.execute("DELETE FROM dir_index WHERE scope = ?", (scope, ))
+
+    def set_file_archived(self, dest_path, md5sum, size, picture_date):
+        with self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO archived (dest_path, md5sum, size, picture_date, archive_date) "
+                "VALUES(?, ?, ?, ?, ?)",
+                (dest_path, md5sum, size, picture_date.isoformat() if picture_date is not None else None,
+                 datetime.datetime.now().isoformat()))
+
+    def get_file_archived(self, dest_path):
+        """Returns (md5sum, size, picture_date) recorded when dest_path was archived, None if it was not."""
+        self._cursor.execute("SELECT md5sum, size, picture_date FROM archived WHERE dest_path = ?", (dest_path, ))
+        result = self._cursor.fetchall()
+        if len(result) == 1:
+            return result[0]
+        return None
+
+    def set_content_dir(self, root, dir_name, files):
+        """Replaces the content index entries of the files directly in dir_name.
+
+        Args:
+          root: The archive folder the index belongs to.
+          files: List of (path, size, mtime_ns), the partial hash of the files that did not change is kept.
+        """
+        self._cursor.execute(
+            "SELECT path, size, mtime_ns, partial_hash FROM content_index WHERE root = ? AND dir = ?",
+            (root, dir_name))
+        known = dict((path, (size, mtime_ns, partial)) for path, size, mtime_ns, partial in self._cursor.fetchall())
+        rows = []
+        for path, size, mtime_ns in files:
+            partial = None
+            if known.get(path, (None, None, None))[:2] == (size, mtime_ns):
+                partial = known[path][2]
+            rows.append((root, path, dir_name, size, mtime_ns, partial))
+
+        with self._connection:
+            self._connection.execute("DELETE FROM content_index WHERE root = ? AND dir = ?", (root, dir_name))
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO content_index (root, path, dir, size, mtime_ns, partial_hash) "
+                "VALUES(?, ?, ?, ?, ?, ?)", rows)
+
+    def set_content_entry(self, root, path, size, mtime_ns, partial_hash=None):
+        with self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO content_index (root, path, dir, size, mtime_ns, partial_hash) "
+                "VALUES(?, ?, ?, ?, ?, ?)", (root, path, os.path.dirname(path), size, mtime_ns, partial_hash))
+
+    def remove_content_entry(self, root, path):
+        with self._connection:
+            self._connection.execute("DELETE FROM content_index WHERE root = ? AND path = ?", (root, path))
+
+    def get_content_by_size(self, root, size):
+        """Returns [(path, mtime_ns, partial_hash)] of the files indexed under root with the given size."""
+        self._cursor.execute("SELECT path, mtime_ns, partial_hash FROM content_index WHERE root = ? AND size = ?",
+                             (root, size))
+        return self._cursor.fetchall()
+
+    def create_archive_plan(self, src_path, dest_path, move, operations):
+        """Stores a plan, operations is a list of (seq, op, src, dest, size, picture_date, note, state)."""
+        with self._connection:
+            cur = self._connection.execute(
+                "INSERT INTO archive_plans (src_path, dest_path, move, created) VALUES(?, ?, ?, ?)",
+                (src_path, dest_path, int(move), datetime.datetime.now().isoformat()))
+            plan_id = cur.lastrowid
+            self._connection.executemany(
+                "INSERT INTO archive_plan (plan_id, seq, op, src, dest, size, picture_date, note, state) "
+                "VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(plan_id, ) + tuple(operation) for operation in operations])
+        return plan_id
+
+    def get_open_archive_plan(self, src_path, dest_path, move):
+        """Returns (plan_id, created) of the last unfinished plan for the same folders and mode, None if there is none."""
+        self._cursor.execute("SELECT plan_id, created FROM archive_plans WHERE src_path = ? AND dest_path = ? AND "
+                             "move = ? AND finished IS NULL ORDER BY plan_id DESC LIMIT 1",
+                             (src_path, dest_path, int(move)))
+        return self._cursor.fetchone()
+
+    def get_archive_plan(self, plan_id):
+        """Returns the operations of a plan as (seq, op, src, dest, size, picture_date, note, state)."""
+        self._cursor.execute("SELECT seq, op, src, dest, size, picture_date, note, state FROM archive_plan "
+                             "WHERE plan_id = ? ORDER BY seq", (plan_id, ))
+        return self._cursor.fetchall()
+
+    def set_archive_operation_states(self, updates):
+        """updates is a list of (state, plan_id, seq)."""
+        with self._connection:
+            self._connection.executemany("UPDATE archive_plan SET state = ? WHERE plan_id = ? AND seq = ?", updates)
+
+    def finish_archive_plan(self, plan_id, pending_state):
+        """Closes a plan and drops its operations if none is still pending, returns True if it was closed."""
+        with self._connection:
+            cur = self._connection.execute(
+                "UPDATE archive_plans SET finished = ? WHERE plan_id = ? AND NOT EXISTS "
+                "(SELECT 1 FROM archive_plan WHERE plan_id = ? AND state = ?)",
+                (datetime.datetime.now().isoformat(), plan_id, plan_id, pending_state))
+            if cur.rowcount != 1:
+                return False
+            self._connection.execute("DELETE FROM archive_plan WHERE plan_id = ?", (plan_id, ))
+        return True
+
+    def discard_archive_plans(self, src_path, dest_path, move):
+        with self._connection:
+            self._connection.execute(
+                "DELETE FROM archive_plan WHERE plan_id IN (SELECT plan_id FROM archive_plans WHERE src_path = ? "
+                "AND dest_path = ? AND move = ? AND finished IS NULL)", (src_path, dest_path, int(move)))
+            self._connection.execute("DELETE FROM archive_plans WHERE src_path = ? AND dest_path = ? AND move = ? "
+                                     "AND finished IS NULL", (src_path, dest_path, int(move)))
+
+    def set_remote_inventory(self, scope, entries):
+        """Adds the photos found in a service account, entries is a list of (remote_key, photo_id)."""
+        date = datetime.datetime.now().isoformat()
+        with self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO remote_inventory (scope, remote_key, photo_id, sync_date) VALUES(?, ?, ?, ?)",
+                [(scope, remote_key, photo_id, date) for remote_key, photo_id in entries])
+
+    def get_remote_photo_id(self, scope, remote_key):
+        self._cursor.execute("SELECT photo_id FROM remote_inventory WHERE scope = ? AND remote_key = ?",
+                             (scope, remote_key))
+        result = self._cursor.fetchall()
+        if len(result) == 1:
+            return result[0][0]
+        return None
+
+    def clear_remote_inventory(self, scope):
+        with self._connection:
+            self._connection.execute("DELETE FROM remote_inventory WHERE scope = ?", (scope, ))
+
+    def get_upload_session(self, service_name, file_name, md5sum):
+        """Returns (session_url, offset) of the unfinished resumable upload of file_name, None if there is none."""
+        self._cursor.execute("SELECT session_url, offset FROM upload_sessions WHERE service = ? AND file_name = ? "
+                             "AND md5sum = ?", (service_name, file_name, md5sum))
+        result = self._cursor.fetchall()
+        if len(result) == 1:
+            return result[0]
+        return None
+
+    def set_upload_session(self, service_name, file_name, md5sum, session_url, offset, size):
+        with self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO upload_sessions (service, file_name, md5sum, session_url, offset, size, "
+                "created) VALUES(?, ?, ?, ?, ?, ?, ?)",
+                (service_name, file_name, md5sum, session_url, offset, size, datetime.datetime.now().isoformat()))
+
+    def set_upload_offset(self, service_name, file_name, offset):
+        with self._connection:
+            self._connection.execute("UPDATE upload_sessions SET offset = ? WHERE service = ? AND file_name = ?",
+                                     (offset, service_name, file_name))
+
+    def remove_upload_session(self, service_name, file_name):
+        with self._connection:
+            self._connection.execute("DELETE FROM upload_sessions WHERE service = ? AND file_name = ?",
+                                     (service_name, file_name))
+
+    def enqueue_uploads(self, scope, entries):
+        """Adds the (path, size) entries not in the queue yet as pending, returns the number added."""
+        date = datetime.datetime.now().isoformat()
+        with self._connection:
+            before = self._connection.total_changes
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO upload_queue (scope, path, size, state, attempts, enqueued) "
+                "VALUES(?, ?, ?, 'pending', 0, ?)", ((scope, path, size, date) for path, size in entries))
+            return self._connection.total_changes - before
+
+    def lease_uploads(self, scope, worker, count, lease_seconds, max_attempts):
+        """Leases to worker up to count pending entries, or leased ones whose lease expired. Returns (path, size)."""
+        now = time.time()
+        lease_until = now + lease_seconds
+        # The update and the select are one transaction, no other worker writes in between.
+        with self._connection:
+            self._connection.execute(
+                "UPDATE upload_queue SET state = 'failed', error = 'Lease expired', lease_until = NULL "
+                "WHERE scope = ? AND state = 'leased' AND lease_until < ? AND attempts >= ?",
+                (scope, now, max_attempts))
+            self._connection.execute(
+                "UPDATE upload_queue SET state = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1 "
+                "WHERE rowid IN (SELECT rowid FROM upload_queue WHERE scope = ? AND (state = 'pending' OR "
+                "(state = 'leased' AND lease_until < ?)) LIMIT ?)", (worker, lease_until, scope, now, count))
+            return self._connection.execute(
+                "SELECT path, size FROM upload_queue WHERE scope = ? AND state = 'leased' AND worker = ? "
+                "AND lease_until = ?", (scope, worker, lease_until)).fetchall()
+
+    def renew_upload_leases(self, scope, worker, lease_seconds):
+        with self._connection:
+            self._connection.execute("UPDATE upload_queue SET lease_until = ? WHERE scope = ? AND state = 'leased' "
+                                     "AND worker = ?", (time.time() + lease_seconds, scope, worker))
+
+    def finish_upload(self, scope, path, worker, state, error=None, max_attempts=None):
+        """Sets an entry leased to worker done, or failed: back to pending unless it was leased max_attempts times.
+
+        Returns False if the entry is no longer leased to worker, its lease expired and was taken over.
+        """
+        with self._connection:
+            if state == "failed":
+                cur = self._connection.execute(
+                    "UPDATE upload_queue SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                    "lease_until = NULL, error = ? WHERE scope = ? AND path = ? AND state = 'leased' AND worker = ?",
+                    (max_attempts, error, scope, path, worker))
+            else:
+                cur = self._connection.execute(
+                    "UPDATE upload_queue SET state = ?, lease_until = NULL, error = NULL, finished = ? "
+                    "WHERE scope = ? AND path = ? AND state = 'leased' AND worker = ?",
+                    (state, datetime.datetime.now().isoformat(), scope, path, worker))
+            return cur.rowcount == 1
+
+    def release_uploads(self, scope, worker):
+        with self._connection:
+            self._connection.execute(
+                "UPDATE upload_queue SET state = 'pending', lease_until = NULL, attempts = attempts - 1 "
+                "WHERE scope = ? AND state = 'leased' AND worker = ?", (scope, worker))
+
+    def retry_failed_uploads(self, scope):
+        with self._connection:
+            return self._connection.execute(
+                "UPDATE upload_queue SET state = 'pending', attempts = 0 WHERE scope = ? AND state = 'failed'",
+                (scope, )).rowcount
+
+    def get_upload_queue_stats(self, scope):
+        self._cursor.execute("SELECT state, COUNT(*), SUM(size) FROM upload_queue WHERE scope = ? GROUP BY state",
+                             (scope, ))
+        return dict((state, (count, size or 0)) for state, count, size in self._cursor.fetchall())
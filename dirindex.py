@@ -0,0 +1,53 @@
+"""Persistent index of the folders completely processed by a tool.
+
+A folder whose mtime has not changed since its last successful pass has
+the same entries, so the walker can skip listing it and only descend
+into the sub folders recorded for it.
+
+"""
+
+import os
+
+import utils
+
+
+class DirIndex(object):
+    def __init__(self, data, scope):
+        """
+        Args:
+          data: The BuffData instance where the index is stored.
+          scope: Name of the tool (and service) the index belongs to, each one keeps its own passes.
+        """
+        self._data = data
+        self._scope = scope
+
+    def unchanged(self, dir_name, st):
+        """Returns the sub folders of dir_name if it did not change since it was marked, None otherwise."""
+        index = self._data.get_dir_index(self._scope, os.path.abspath(dir_name))
+        if index is None:
+            return None
+
+        mtime_ns, file_count, subdirs = index
+        if mtime_ns != utils.stat_mtime_ns(st):
+            return None
+
+        return [os.path.join(dir_name, name) for name in subdirs]
+
+    def mark(self, path, mtime_ns, file_count, subdir_names):
+        self._data.set_dir_index(self._scope, os.path.abspath(path), mtime_ns, file_count, subdir_names)
+
+    def mark_entry(self, entry, restat=False):
+        """Records a folder yielded by dirwalker.walk() as completely processed.
+
+        Use restat if the tool itself may have modified the folder while processing it.
+        """
+        try:
+            st = os.stat(entry.path) if restat else entry.stat()
+        except OSError:
+            return
+
+        subdir_names = [os.path.basename(d) for d in entry.subdirs]
+        self.mark(entry.path, utils.stat_mtime_ns(st), entry.count - len(subdir_names), subdir_names)
+
+    def clear(self):
+        self._data.clear_dir_index(self._scope)
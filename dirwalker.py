@@ -0,0 +1,183 @@
+"""Streaming directory tree walker shared by all the tools.
+
+Lists every folder once with scandir (when available) and reuses the
+cached stat data of each entry, so files are filtered by extension and
+size without extra syscalls. The walk is iterative, deep trees don't hit
+the recursion limit.
+
+"""
+
+import os
+import sys
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+SKIP_TYPE = "type"
+SKIP_SIZE = "size"
+
+
+class _ListdirEntry(object):
+    """Minimal DirEntry look-alike used when scandir is not available."""
+    __slots__ = ("name", "path", "_stat")
+
+    def __init__(self, dir_name, name):
+        self.name = name
+        self.path = os.path.join(dir_name, name)
+        self._stat = None
+
+    def stat(self):
+        if self._stat is None:
+            self._stat = os.stat(self.path)
+        return self._stat
+
+    def is_dir(self):
+        try:
+            return (self.stat().st_mode & 0o170000) == 0o040000
+        except OSError:
+            return False
+
+    def is_file(self):
+        try:
+            return (self.stat().st_mode & 0o170000) == 0o100000
+        except OSError:
+            return False
+
+
+def list_dir(dir_name):
+    """Lists dir_name, the entries have the path, name, is_dir(), is_file() and stat() of os.scandir entries."""
+    if scandir is not None:
+        return list(scandir(dir_name))
+    return [_ListdirEntry(dir_name, name) for name in os.listdir(dir_name)]
+
+
+class WalkEntry(object):
+    """A file found by walk(), or a folder when it has been completely walked (is_dir is True).
+
+    For folders count is the number of entries listed in it, subdirs the paths of its sub folders and stat() the
+    folder stat taken before it was listed, if any.
+    """
+    __slots__ = ("path", "name", "dir_name", "is_dir", "count", "subdirs", "_entry", "_stat")
+
+    def __init__(self, dir_name, entry, is_dir=False, count=0, subdirs=None, st=None):
+        self.dir_name = dir_name
+        self.is_dir = is_dir
+        self.count = count
+        self.subdirs = subdirs
+        self._entry = entry
+        self._stat = st
+        if entry is None:
+            self.path = dir_name
+            self.name = os.path.basename(dir_name)
+        else:
+            self.path = entry.path
+            self.name = entry.name
+
+    def stat(self):
+        if self._entry is None:
+            if self._stat is None:
+                self._stat = os.stat(self.path)
+            return self._stat
+        return self._entry.stat()
+
+    @property
+    def size(self):
+        try:
+            return self.stat().st_size
+        except OSError:
+            return 0
+
+    @property
+    def mtime(self):
+        return self.stat().st_mtime
+
+
+def _default_on_error(error):
+    sys.stderr.write(str(error) + "\n")
+
+
+def _extension(name):
+    return os.path.splitext(name)[1].lower()
+
+
+def walk(root, extensions=None, min_size=0, on_skip=None, on_error=None, yield_dirs=False, unchanged=None):
+    """Walks the tree under root yielding a WalkEntry for every regular file.
+
+    Args:
+      root: The folder to walk.
+      extensions: If given only files with one of these extensions (".jpg", ...) are yielded.
+      min_size: Files smaller than this are not yielded.
+      on_skip: Called as on_skip(entry, reason) for every file filtered out, reason is SKIP_TYPE or SKIP_SIZE.
+      on_error: Called with the exception when a folder can't be listed.
+      yield_dirs: Also yield every folder, after all its files and sub folders have been yielded.
+      unchanged: Called as unchanged(dir_name, stat) before listing each folder. If it returns a list of sub folders
+          the folder is not listed, its files are not yielded and only those sub folders are walked.
+    """
+    if on_error is None:
+        on_error = _default_on_error
+
+    if extensions is not None:
+        extensions = frozenset(e.lower() for e in extensions)
+
+    if not os.path.isdir(root):
+        on_error(OSError(root + " is not a directory."))
+        return
+
+    stack = [root]
+    while stack:
+        dir_name = stack.pop()
+        if isinstance(dir_name, WalkEntry):
+            yield dir_name
+            continue
+
+        dir_stat = None
+        if unchanged is not None:
+            try:
+                dir_stat = os.stat(dir_name)
+            except OSError as e:
+                on_error(e)
+                continue
+
+            known_subdirs = unchanged(dir_name, dir_stat)
+            if known_subdirs is not None:
+                stack.extend(reversed(known_subdirs))
+                continue
+
+        try:
+            entries = list_dir(dir_name)
+        except OSError as e:
+            on_error(e)
+            continue
+
+        subdirs = []
+        files = []
+        for entry in entries:
+            try:
+                if entry.is_dir():
+                    subdirs.append(entry.path)
+                elif entry.is_file():
+                    files.append(WalkEntry(dir_name, entry))
+            except OSError as e:
+                on_error(e)
+
+        if yield_dirs:
+            stack.append(WalkEntry(dir_name, None, True, len(entries), subdirs, dir_stat))
+        stack.extend(reversed(subdirs))
+
+        for entry in files:
+            if extensions is not None and _extension(entry.name) not in extensions:
+                if on_skip is not None:
+                    on_skip(entry, SKIP_TYPE)
+                continue
+
+            if min_size > 0 and entry.size < min_size:
+                if on_skip is not None:
+                    on_skip(entry, SKIP_SIZE)
+                continue
+
+            yield entry
@@ -0,0 +1,173 @@
+"""Adds the missing EXIF date tags to a JPEG while it is copied.
+
+Builds a new JPEG header (everything up to the end of the APP1 Exif
+segment) with the date tags set, to be written in place of the source
+header followed by the rest of the source file. The TIFF data is only
+appended to: new copies of IFD0 and of the Exif IFD with the dates added
+go at the end of the segment and the header offset is pointed to them,
+so every offset in the original data (maker notes, thumbnail) stays
+valid. Files this can't handle return None and are left to pyexiv2.
+
+"""
+
+import struct
+
+import exifreader
+
+_DATETIME = 0x0132
+_DATETIME_ORIGINAL = 0x9003
+_DATETIME_DIGITIZED = 0x9004
+_EXIF_IFD_POINTER = 0x8769
+
+_ASCII = 2
+_LONG = 4
+
+_TAG_IDS = {exifreader.IMAGE_DATETIME: _DATETIME, exifreader.PHOTO_DATETIME_ORIGINAL: _DATETIME_ORIGINAL,
+            exifreader.PHOTO_DATETIME_DIGITIZED: _DATETIME_DIGITIZED}
+
+_SOI = b"\xff\xd8"
+_APP0 = 0xe0
+_APP1 = 0xe1
+_COM = 0xfe
+_EXIF_HEADER = b"Exif\x00\x00"
+_MAX_SEGMENT_LENGTH = 0xffff
+_MAX_SEGMENTS = 16
+
+
+class ExifHeader(object):
+    """data replaces the first skip bytes of the source file."""
+    __slots__ = ("data", "skip")
+
+    def __init__(self, data, skip):
+        self.data = data
+        self.skip = skip
+
+
+def _find_segments(f):
+    """Returns (position, end) of the APP1 Exif segment and the position to insert one if there is none."""
+    insert_pos = 2
+    for i in range(_MAX_SEGMENTS):
+        pos = f.tell()
+        header = f.read(4)
+        if len(header) < 4 or header[0:1] != b"\xff":
+            break
+
+        marker = ord(header[1:2])
+        if not (0xe0 <= marker <= 0xef or marker == _COM):
+            # The metadata segments are all before the tables and frame segments.
+            break
+
+        end = pos + 2 + struct.unpack(">H", header[2:4])[0]
+        if marker == _APP1 and f.read(len(_EXIF_HEADER)) == _EXIF_HEADER:
+            return (pos, end), insert_pos
+        if marker == _APP0 and i == 0:
+            # JFIF requires its APP0 segment right after SOI.
+            insert_pos = end
+        f.seek(end)
+
+    return None, insert_pos
+
+
+def _read_ifd(tiff, order, offset):
+    count = struct.unpack_from(order + "H", tiff, offset)[0]
+    entries = {}
+    for i in range(count):
+        tag, field_type, value_count, raw = struct.unpack_from(order + "HHI4s", tiff, offset + 2 + i * 12)
+        entries[tag] = (field_type, value_count, raw)
+    next_offset = struct.unpack_from(order + "I", tiff, offset + 2 + count * 12)[0]
+    return entries, next_offset
+
+
+def _append_ifd(tiff, order, entries, next_offset, values):
+    """Appends an IFD to tiff and returns its offset, values are the data of the new entries keyed by tag."""
+    if len(tiff) % 2:
+        tiff.append(0)
+
+    offset = len(tiff)
+    data_offset = offset + 2 + len(entries) * 12 + 4
+    data = bytearray()
+    ifd = bytearray(struct.pack(order + "H", len(entries)))
+    for tag in sorted(entries):
+        field_type, value_count, raw = entries[tag]
+        if tag in values:
+            raw = struct.pack(order + "I", data_offset + len(data))
+            data += values[tag]
+            if len(data) % 2:
+                data.append(0)
+        ifd += struct.pack(order + "HHI4s", tag, field_type, value_count, raw)
+    ifd += struct.pack(order + "I", next_offset)
+
+    tiff += ifd
+    tiff += data
+    return offset
+
+
+def _patch_tiff(tiff, date_tags):
+    order = {b"II": "<", b"MM": ">"}.get(bytes(tiff[:2]))
+    if order is None or struct.unpack_from(order + "H", tiff, 2)[0] != 42:
+        raise ValueError("Not a TIFF header")
+
+    ifd0, next_offset = _read_ifd(tiff, order, struct.unpack_from(order + "I", tiff, 4)[0])
+    exif_ifd = {}
+    if _EXIF_IFD_POINTER in ifd0:
+        field_type, value_count, raw = ifd0[_EXIF_IFD_POINTER]
+        exif_ifd = _read_ifd(tiff, order, struct.unpack(order + "I", raw)[0])[0]
+
+    values = {}
+    for tag, value in date_tags.items():
+        values[tag] = value
+        target = ifd0 if tag == _DATETIME else exif_ifd
+        target[tag] = (_ASCII, len(value), None)
+
+    if exif_ifd:
+        exif_offset = _append_ifd(tiff, order, exif_ifd, 0, values)
+        ifd0[_EXIF_IFD_POINTER] = (_LONG, 1, struct.pack(order + "I", exif_offset))
+    ifd0_offset = _append_ifd(tiff, order, ifd0, next_offset, values)
+    struct.pack_into(order + "I", tiff, 4, ifd0_offset)
+
+
+def build_header(file_name, date, tags=None):
+    """Builds the header of file_name with the missing date tags set to date.
+
+    Args:
+      tags: The exifreader.read_exif() result for file_name, read if None.
+
+    Returns:
+      An ExifHeader, or None if nothing is missing or the file can't be patched.
+    """
+    if tags is None:
+        tags = exifreader.read_exif(file_name)
+        if tags is None:
+            return None
+
+    value = (date.strftime("%Y:%m:%d %H:%M:%S") + "\x00").encode("ascii")
+    date_tags = dict((_TAG_IDS[key], value) for key in exifreader.DATE_TAGS if tags.get(key) is None)
+    if not date_tags:
+        return None
+
+    try:
+        with open(file_name, "rb") as f:
+            if f.read(2) != _SOI:
+                return None
+
+            segment, insert_pos = _find_segments(f)
+            if segment is not None:
+                pos, end = segment
+                f.seek(pos + 4 + len(_EXIF_HEADER))
+                tiff = bytearray(f.read(end - f.tell()))
+            else:
+                pos = end = insert_pos
+                tiff = bytearray(b"MM\x00\x2a" + struct.pack(">I", 8) + struct.pack(">HI", 0, 0))
+
+            _patch_tiff(tiff, date_tags)
+
+            length = 2 + len(_EXIF_HEADER) + len(tiff)
+            if length > _MAX_SEGMENT_LENGTH:
+                return None
+
+            f.seek(0)
+            data = f.read(pos) + b"\xff\xe1" + struct.pack(">H", length) + _EXIF_HEADER + bytes(tiff)
+    except (IOError, ValueError, struct.error):
+        return None
+
+    return ExifHeader(data, end)
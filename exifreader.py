@@ -0,0 +1,222 @@
+"""Header-only EXIF reader for JPEG files.
+
+Walks the JPEG segment headers up to the APP1 Exif segment and parses only
+the TIFF IFDs needed to get the picture dates and the GPS position, reading
+a few KB instead of loading all the metadata with pyexiv2.
+
+"""
+
+import datetime
+import struct
+from fractions import Fraction
+
+IMAGE_DATETIME = 'Exif.Image.DateTime'
+PHOTO_DATETIME_ORIGINAL = 'Exif.Photo.DateTimeOriginal'
+PHOTO_DATETIME_DIGITIZED = 'Exif.Photo.DateTimeDigitized'
+GPS_LATITUDE_REF = 'Exif.GPSInfo.GPSLatitudeRef'
+GPS_LATITUDE = 'Exif.GPSInfo.GPSLatitude'
+GPS_LONGITUDE_REF = 'Exif.GPSInfo.GPSLongitudeRef'
+GPS_LONGITUDE = 'Exif.GPSInfo.GPSLongitude'
+GPS_ALTITUDE_REF = 'Exif.GPSInfo.GPSAltitudeRef'
+GPS_ALTITUDE = 'Exif.GPSInfo.GPSAltitude'
+
+DATE_TAGS = (IMAGE_DATETIME, PHOTO_DATETIME_ORIGINAL, PHOTO_DATETIME_DIGITIZED)
+
+_EXIF_IFD_POINTER = 0x8769
+_GPS_IFD_POINTER = 0x8825
+
+_IFD0_TAGS = {0x0132: IMAGE_DATETIME}
+_EXIF_TAGS = {0x9003: PHOTO_DATETIME_ORIGINAL, 0x9004: PHOTO_DATETIME_DIGITIZED}
+_GPS_TAGS = {0x0001: GPS_LATITUDE_REF, 0x0002: GPS_LATITUDE, 0x0003: GPS_LONGITUDE_REF,
+             0x0004: GPS_LONGITUDE, 0x0005: GPS_ALTITUDE_REF, 0x0006: GPS_ALTITUDE}
+
+# TIFF field type -> size in bytes of one value
+_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 7: 1, 9: 4, 10: 8}
+
+_SOI = b"\xff\xd8"
+_EXIF_HEADER = b"Exif\x00\x00"
+
+# Markers without a length field
+_STANDALONE_MARKERS = frozenset([0x01] + list(range(0xd0, 0xd8)))
+_SOS = 0xda
+_MAX_SEGMENTS = 16
+
+# APP1 bytes read up front, IFD values beyond this are read with a seek.
+_HEAD_SIZE = 8 * 1024
+
+
+class _TiffReader(object):
+    def __init__(self, f, base, length):
+        self._f = f
+        self._base = base
+        self._length = length
+        self._head = f.read(min(length, _HEAD_SIZE))
+        order = self._head[:2]
+        if order == b"II":
+            self._order = "<"
+        elif order == b"MM":
+            self._order = ">"
+        else:
+            raise ValueError("Not a TIFF header")
+
+    def read(self, offset, length):
+        if offset < 0 or offset + length > self._length:
+            raise ValueError("Offset out of the Exif segment")
+        if offset + length <= len(self._head):
+            return self._head[offset:offset + length]
+        self._f.seek(self._base + offset)
+        data = self._f.read(length)
+        if len(data) != length:
+            raise ValueError("Truncated Exif segment")
+        return data
+
+    def unpack(self, fmt, offset):
+        fmt = self._order + fmt
+        return struct.unpack(fmt, self.read(offset, struct.calcsize(fmt)))
+
+    def first_ifd(self):
+        return self.unpack("I", 4)[0]
+
+    def ifd_entries(self, offset):
+        count = self.unpack("H", offset)[0]
+        data = self.read(offset + 2, count * 12)
+        for i in range(count):
+            yield struct.unpack(self._order + "HHI4s", data[i * 12:i * 12 + 12])
+
+    def value(self, field_type, count, raw):
+        size = _TYPE_SIZES.get(field_type)
+        if size is None:
+            return None
+
+        total = size * count
+        if total <= 4:
+            data = raw[:total]
+        else:
+            data = self.read(struct.unpack(self._order + "I", raw)[0], total)
+
+        if field_type == 2:
+            return data.split(b"\x00", 1)[0].decode("ascii", "replace")
+        if field_type in (1, 7):
+            values = struct.unpack("%dB" % count, data)
+        elif field_type == 3:
+            values = struct.unpack(self._order + "%dH" % count, data)
+        elif field_type in (4, 9):
+            values = struct.unpack(self._order + ("%dI" if field_type == 4 else "%di") % count, data)
+        else:
+            ints = struct.unpack(self._order + ("%dI" if field_type == 5 else "%di") % (count * 2), data)
+            values = tuple(Fraction(ints[i], ints[i + 1]) if ints[i + 1] else None for i in range(0, len(ints), 2))
+
+        if count == 1:
+            return values[0]
+        return values
+
+
+def parse_exif_date(value):
+    """Converts an EXIF "YYYY:MM:DD HH:MM:SS" string to a datetime, None if it is empty or malformed."""
+    try:
+        return datetime.datetime.strptime(value.strip()[:19], "%Y:%m:%d %H:%M:%S")
+    except (ValueError, AttributeError):
+        return None
+
+
+def _read_ifd(reader, offset, tags, result):
+    pointers = {}
+    for tag, field_type, count, raw in reader.ifd_entries(offset):
+        if tag in (_EXIF_IFD_POINTER, _GPS_IFD_POINTER):
+            pointers[tag] = reader.value(field_type, count, raw)
+        elif tag in tags:
+            try:
+                result[tags[tag]] = reader.value(field_type, count, raw)
+            except (ValueError, struct.error):
+                pass
+    return pointers
+
+
+def _find_exif_segment(f):
+    """Leaves f at the start of the TIFF header and returns its length, or returns None if there is no Exif."""
+    for i in range(_MAX_SEGMENTS):
+        header = f.read(2)
+        if len(header) < 2 or header[0:1] != b"\xff":
+            return None
+
+        marker = ord(header[1:2])
+        while marker == 0xff:
+            marker = ord(f.read(1) or b"\x00")
+
+        if marker in _STANDALONE_MARKERS:
+            continue
+        if marker == _SOS or marker == 0xd9:
+            return None
+
+        length = struct.unpack(">H", f.read(2))[0] - 2
+        if length < 0:
+            return None
+
+        if marker == 0xe1 and length > len(_EXIF_HEADER):
+            if f.read(len(_EXIF_HEADER)) == _EXIF_HEADER:
+                return length - len(_EXIF_HEADER)
+            f.seek(length - len(_EXIF_HEADER), 1)
+        else:
+            f.seek(length, 1)
+
+    return None
+
+
+def read_exif(file_name):
+    """Reads the date and GPS tags of a JPEG file.
+
+    Returns:
+      A dict keyed by the pyexiv2 tag names (Exif.Image.DateTime, ...). Dates are returned as datetime objects,
+      (or None if malformed), rationals as fractions.Fraction. The dict is empty if the JPEG has no Exif data.
+      None if the file is not a JPEG or its Exif data could not be parsed, use pyexiv2 in that case.
+    """
+    try:
+        with open(file_name, "rb") as f:
+            if f.read(2) != _SOI:
+                return None
+
+            length = _find_exif_segment(f)
+            result = {}
+            if length is None:
+                return result
+
+            reader = _TiffReader(f, f.tell(), length)
+            pointers = _read_ifd(reader, reader.first_ifd(), _IFD0_TAGS, result)
+            if _EXIF_IFD_POINTER in pointers:
+                _read_ifd(reader, pointers[_EXIF_IFD_POINTER], _EXIF_TAGS, result)
+            if _GPS_IFD_POINTER in pointers:
+                _read_ifd(reader, pointers[_GPS_IFD_POINTER], _GPS_TAGS, result)
+    except (IOError, ValueError, struct.error):
+        return None
+
+    for key in DATE_TAGS:
+        if key in result:
+            result[key] = parse_exif_date(result[key])
+
+    return result
+
+
+def _to_degrees(value):
+    try:
+        degrees = float(value[0]) + float(value[1]) / 60 + float(value[2]) / 3600
+    except (TypeError, IndexError):
+        return None
+    return degrees
+
+
+def gps_position(tags):
+    """Returns the (latitude, longitude) in decimal degrees stored in tags, None if it has no complete position."""
+    if GPS_LATITUDE_REF not in tags or GPS_LONGITUDE_REF not in tags:
+        return None
+
+    lat = _to_degrees(tags.get(GPS_LATITUDE))
+    lng = _to_degrees(tags.get(GPS_LONGITUDE))
+    if lat is None or lng is None:
+        return None
+
+    if tags[GPS_LATITUDE_REF] == "S":
+        lat = -lat
+    if tags[GPS_LONGITUDE_REF] == "W":
+        lng = -lng
+
+    return lat, lng
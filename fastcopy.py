@@ -0,0 +1,249 @@
+"""Kernel assisted file copy.
+
+Tries, in order, a reflink (copy on write clone, btrfs/xfs), then
+copy_file_range and sendfile, which copy inside the kernel without
+passing the data through Python buffers, and finally a plain block copy.
+The destination is preallocated up front to reduce fragmentation. Every
+step falls back cleanly when the file system or the platform lacks it.
+
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import shutil
+
+import filehash
+
+BLOCK_SIZE = 1024 * 1024
+
+REFLINK = "reflink"
+COPY_FILE_RANGE = "copy_file_range"
+SENDFILE = "sendfile"
+BLOCKS = "blocks"
+
+_FICLONE = 0x40049409
+_FALLOC_FL_KEEP_SIZE = 1
+
+# errno values meaning "not supported here, try the next method"
+_UNSUPPORTED = frozenset([errno.EINVAL, errno.ENOSYS, errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EBADF,
+                          errno.EPERM, getattr(errno, "ENOTSUP", errno.EOPNOTSUPP)])
+
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        try:
+            _libc = ctypes.CDLL(ctypes.util.find_library("c") or None, use_errno=True)
+        except OSError:
+            _libc = False
+    return _libc
+
+
+def _libc_function(name, restype, argtypes):
+    libc = _get_libc()
+    func = getattr(libc, name, None) if libc else None
+    if func is not None:
+        func.restype = restype
+        func.argtypes = argtypes
+    return func
+
+
+def _check(result):
+    if result < 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+    return result
+
+
+def preallocate(fd, size):
+    """Reserves size bytes for fd without changing its size, returns False if it is not supported."""
+    if size <= 0 or os.name != "posix":
+        return False
+
+    fallocate = _libc_function("fallocate", ctypes.c_int, [ctypes.c_int, ctypes.c_int, ctypes.c_longlong,
+                                                           ctypes.c_longlong])
+    if fallocate is None:
+        return False
+    try:
+        _check(fallocate(fd, _FALLOC_FL_KEEP_SIZE, 0, size))
+        return True
+    except OSError:
+        return False
+
+
+def _reflink(src_fd, dst_fd, size):
+    import fcntl
+
+    fcntl.ioctl(dst_fd, _FICLONE, src_fd)
+
+
+def _copy_file_range(src_fd, dst_fd, size):
+    copy_range = getattr(os, "copy_file_range", None)
+    if copy_range is None:
+        func = _libc_function("copy_file_range", ctypes.c_ssize_t,
+                              [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t,
+                               ctypes.c_uint])
+        if func is None:
+            raise OSError(errno.ENOSYS, "copy_file_range not available")
+        copy_range = lambda src, dst, count: _check(func(src, None, dst, None, count, 0))
+
+    _copy_loop(copy_range, src_fd, dst_fd, size)
+
+
+def _sendfile(src_fd, dst_fd, size):
+    sendfile = getattr(os, "sendfile", None)
+    if sendfile is not None:
+        send = lambda src, dst, count: sendfile(dst, src, None, count)
+    else:
+        func = _libc_function("sendfile", ctypes.c_ssize_t,
+                              [ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t])
+        if func is None:
+            raise OSError(errno.ENOSYS, "sendfile not available")
+        send = lambda src, dst, count: _check(func(dst, src, None, count))
+
+    _copy_loop(send, src_fd, dst_fd, size)
+
+
+def _copy_loop(copy_chunk, src_fd, dst_fd, size):
+    copied = 0
+    while copied < size:
+        n = copy_chunk(src_fd, dst_fd, min(size - copied, 1 << 30))
+        if n == 0:
+            break
+        copied += n
+
+
+def _write_all(fd, data):
+    while data:
+        n = os.write(fd, data)
+        data = data[n:]
+
+
+def _copy_blocks(src_fd, dst_fd, size):
+    while True:
+        buf = os.read(src_fd, BLOCK_SIZE)
+        if not buf:
+            break
+        _write_all(dst_fd, buf)
+
+
+def open_destination(dest_file, replace=False):
+    """Opens dest_file to write a copy, failing with EEXIST if it already exists unless replace is set."""
+    flags = os.O_WRONLY | os.O_CREAT | getattr(os, "O_BINARY", 0) | (os.O_TRUNC if replace else os.O_EXCL)
+    return os.fdopen(os.open(dest_file, flags, 0o666), "wb")
+
+
+def _remove_failed(dest_file):
+    try:
+        os.remove(dest_file)
+    except OSError:
+        pass
+
+
+_METHODS = [(REFLINK, _reflink), (COPY_FILE_RANGE, _copy_file_range), (SENDFILE, _sendfile),
+            (BLOCKS, _copy_blocks)]
+
+
+def copy_file(src_file, dest_file, methods=None, prefix=None, skip=0, replace=False):
+    """Copies the data and permission bits of src_file to dest_file (like shutil.copy).
+
+    Args:
+      methods: Names of the methods to try, all of them by default.
+      prefix: Data written at the start of dest_file in place of the first skip bytes of src_file.
+      replace: Overwrite dest_file if it exists, otherwise the copy fails with EEXIST.
+
+    Returns:
+      The name of the method that made the copy.
+    """
+    with open(src_file, "rb") as src:
+        dst = open_destination(dest_file, replace)
+        try:
+            src_fd = src.fileno()
+            dst_fd = dst.fileno()
+            size = os.fstat(src_fd).st_size - skip
+            start = 0
+            if prefix is not None:
+                _write_all(dst_fd, prefix)
+                os.lseek(src_fd, skip, os.SEEK_SET)
+                start = len(prefix)
+
+            preallocated = False
+            for name, method in _METHODS:
+                if methods is not None and name not in methods:
+                    continue
+                if name == REFLINK and prefix is not None:
+                    # A clone is the whole file.
+                    continue
+                if name != REFLINK and not preallocated:
+                    preallocated = preallocate(dst_fd, start + size)
+                try:
+                    method(src_fd, dst_fd, size)
+                    used = name
+                    break
+                except (IOError, OSError) as e:
+                    if e.errno not in _UNSUPPORTED or name == BLOCKS:
+                        raise
+                    # Start over, a failed method may have copied part of the data.
+                    os.lseek(src_fd, skip, os.SEEK_SET)
+                    os.lseek(dst_fd, start, os.SEEK_SET)
+                    os.ftruncate(dst_fd, start)
+            else:
+                raise IOError("No copy method available")
+
+            if preallocated:
+                # Release the blocks reserved beyond the data if the copy ended up smaller.
+                os.ftruncate(dst_fd, os.fstat(dst_fd).st_size)
+            dst.close()
+        except:
+            dst.close()
+            _remove_failed(dest_file)
+            raise
+
+    shutil.copymode(src_file, dest_file)
+    return used
+
+
+def copy_file_hashed(src_file, dest_file, algorithms=("md5", ), prefix=None, skip=0, sync=False, replace=False):
+    """Copies src_file to dest_file computing the digests of the bytes as they are written.
+
+    The source is read only once, the data has to pass through Python so no kernel copy is used.
+
+    Args:
+      prefix: Data written at the start of dest_file in place of the first skip bytes of src_file.
+      sync: fsync dest_file before returning, so the errors writing the data to the disk are raised here.
+      replace: Overwrite dest_file if it exists, otherwise the copy fails with EEXIST.
+
+    Returns:
+      A dict mapping each algorithm name to the hex digest of the copied data.
+    """
+    hashers = [filehash.new_hasher(a) for a in algorithms]
+    with open(src_file, "rb") as src:
+        dst = open_destination(dest_file, replace)
+        try:
+            preallocated = preallocate(dst.fileno(), os.fstat(src.fileno()).st_size - skip + len(prefix or b""))
+            if prefix is not None:
+                src.seek(skip)
+            buf = prefix or src.read(BLOCK_SIZE)
+            while buf:
+                for h in hashers:
+                    h.update(buf)
+                dst.write(buf)
+                buf = src.read(BLOCK_SIZE)
+
+            if preallocated:
+                dst.truncate(dst.tell())
+            if sync:
+                dst.flush()
+                os.fsync(dst.fileno())
+            dst.close()
+        except:
+            dst.close()
+            _remove_failed(dest_file)
+            raise
+
+    shutil.copymode(src_file, dest_file)
+    return dict(zip(algorithms, [h.hexdigest() for h in hashers]))
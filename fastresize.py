@@ -0,0 +1,161 @@
+"""Fast downscaling of the pictures sent reduced to the upload services.
+
+JPEGs are decoded in draft mode: libjpeg scales them by 1/2, 1/4 or 1/8
+in the DCT domain while decoding, so a 24 Mpx photo reduced to 2048 px is
+decoded at a quarter of its size and only that is resized with ANTIALIAS.
+The metadata segments of the source (APP1 Exif and XMP, APP13 IPTC) are
+copied byte for byte into the output, instead of reading the metadata of
+both files with pyexiv2 and writing it again.
+
+The result is written to a spool folder in memory (/dev/shm) rather than
+next to the source, which may be a slow or read only disk, and the resizes
+run in a pool of processes, the decoding is CPU bound.
+
+"""
+
+import cStringIO
+import multiprocessing
+import os
+import struct
+import tempfile
+import time
+
+import Image
+
+import fileinfo
+
+# The first one that is a writable folder is used, the system temp folder if none.
+SPOOL_FOLDERS = ["/dev/shm"]
+SPOOL_PREFIX = ".resizing___"
+
+DEFAULT_MAX_WIDTH = 2048
+DEFAULT_QUALITY = 88
+
+_SOI = b"\xff\xd8"
+_APP0 = 0xe0
+_APP1 = 0xe1
+_APP13 = 0xed
+_COM = 0xfe
+_MAX_SEGMENTS = 32
+
+
+def spool_folder():
+    for folder in SPOOL_FOLDERS:
+        if os.path.isdir(folder) and os.access(folder, os.W_OK):
+            return folder
+    return tempfile.gettempdir()
+
+
+def read_metadata_segments(f):
+    """Returns the APP1 and APP13 segments, marker included, at the start of the JPEG in file f."""
+    if f.read(2) != _SOI:
+        return []
+
+    segments = []
+    for i in range(_MAX_SEGMENTS):
+        header = f.read(4)
+        if len(header) < 4 or header[0:1] != b"\xff":
+            break
+
+        marker = ord(header[1:2])
+        if not (0xe0 <= marker <= 0xef or marker == _COM):
+            # The metadata segments are all before the tables and frame segments.
+            break
+
+        length = struct.unpack(">H", header[2:4])[0]
+        if marker in (_APP1, _APP13):
+            segments.append(header + f.read(length - 2))
+        else:
+            f.seek(length - 2, os.SEEK_CUR)
+    return segments
+
+
+def insert_segments(data, segments):
+    """Returns the JPEG data with segments inserted after SOI, or after the JFIF APP0 segment if it has one."""
+    if not segments or data[:2] != _SOI:
+        return data
+
+    insert_pos = 2
+    if ord(data[3:4]) == _APP0:
+        insert_pos = 4 + struct.unpack(">H", data[4:6])[0]
+    return data[:insert_pos] + b"".join(segments) + data[insert_pos:]
+
+
+def target_size(width, height, max_width):
+    """The size of a picture scaled to fit max_width x max_width, None if it already fits."""
+    if width <= max_width and height <= max_width:
+        return None
+
+    if width > height:
+        return max_width, int(float(height) * max_width / width)
+    if width < height:
+        return int(float(width) * max_width / height), max_width
+    return max_width, max_width
+
+
+def resize(file_name, max_width=DEFAULT_MAX_WIDTH, quality=DEFAULT_QUALITY):
+    """Returns the data of file_name reduced to fit max_width, in its own format, None if it already fits."""
+    with open(file_name, "rb") as f:
+        segments = read_metadata_segments(f)
+        f.seek(0)
+        img = Image.open(f)
+        size = target_size(img.size[0], img.size[1], max_width)
+        if size is None:
+            return None
+
+        image_format = img.format
+        # Only JPEG has a draft mode, the other formats ignore it.
+        img.draft(img.mode, size)
+        img = img.resize(size, Image.ANTIALIAS)
+
+    out = cStringIO.StringIO()
+    img.save(out, image_format, quality=quality)
+    data = out.getvalue()
+    if image_format == "JPEG":
+        data = insert_segments(data, segments)
+    return data
+
+
+def resize_to_spool(file_name, max_width=DEFAULT_MAX_WIDTH, quality=DEFAULT_QUALITY):
+    """Writes file_name reduced to the spool folder, returns its name or None if it already fits."""
+    data = resize(file_name, max_width, quality)
+    if data is None:
+        return None
+
+    handle, spool_name = tempfile.mkstemp(suffix=os.path.splitext(file_name)[1], prefix=SPOOL_PREFIX,
+                                          dir=spool_folder())
+    try:
+        with os.fdopen(handle, "wb") as f:
+            f.write(data)
+        filetime = time.mktime(fileinfo.get_file_info(file_name).file_date.timetuple())
+        os.utime(spool_name, (filetime, filetime))
+    except:
+        os.remove(spool_name)
+        raise
+    return spool_name
+
+
+class ResizePool(object):
+    def __init__(self, processes=None, max_width=DEFAULT_MAX_WIDTH, quality=DEFAULT_QUALITY):
+        """
+        Args:
+          processes: Number of resize processes, 0 to resize in the calling thread. The CPU count if None.
+
+        The processes are started here, it must be created before the threads of the caller.
+        """
+        self.processes = multiprocessing.cpu_count() if processes is None else processes
+        self.max_width = max_width
+        self.quality = quality
+        self._pool = multiprocessing.Pool(self.processes) if self.processes > 0 else None
+
+    def resize(self, file_name):
+        """resize_to_spool() in one of the processes, it may be called from several threads."""
+        if self._pool is None:
+            return resize_to_spool(file_name, self.max_width, self.quality)
+        return self._pool.apply(resize_to_spool, (file_name, self.max_width, self.quality))
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
@@ -0,0 +1,132 @@
+"""Streaming multi-digest file hashing.
+
+Reads every file once, in large blocks or through a memory map, and feeds
+each block to all the requested digests.
+
+"""
+
+import hashlib
+import mmap
+import os
+import zlib
+
+DEFAULT_BLOCK_SIZE = 1024 * 1024
+DEFAULT_ALGORITHMS = ("md5", "sha256", "crc32")
+
+# Files smaller than this are read with a single block read, mapping them is not worth the syscalls
+MMAP_MIN_SIZE = 4 * DEFAULT_BLOCK_SIZE
+
+PARTIAL_BLOCK_SIZE = 64 * 1024
+
+
+class _Crc32(object):
+    """hashlib-like wrapper around zlib.crc32 (fast, non-cryptographic)."""
+
+    def __init__(self):
+        self._value = 0
+
+    def update(self, data):
+        self._value = zlib.crc32(data, self._value)
+
+    def hexdigest(self):
+        return "%08x" % (self._value & 0xffffffff)
+
+
+class _XXHash64(object):
+    """hashlib-like wrapper around xxhash.xxh64, only available if the xxhash module is installed."""
+
+    def __init__(self):
+        import xxhash
+
+        self._hash = xxhash.xxh64()
+        self.update = self._hash.update
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+
+def new_hasher(algorithm):
+    if algorithm == "crc32":
+        return _Crc32()
+    if algorithm == "xxh64":
+        return _XXHash64()
+    return hashlib.new(algorithm)
+
+
+def available_algorithms():
+    result = ["md5", "sha1", "sha256", "crc32"]
+    try:
+        import xxhash
+        result.append("xxh64")
+    except ImportError:
+        pass
+    return result
+
+
+def _hash_blocks(f, hashers, block_size):
+    while True:
+        buf = f.read(block_size)
+        if not buf:
+            break
+        for h in hashers:
+            h.update(buf)
+
+
+def _hash_mmap(f, hashers, size, block_size):
+    m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        offset = 0
+        while offset < size:
+            buf = m[offset:offset + block_size]
+            for h in hashers:
+                h.update(buf)
+            offset += block_size
+    finally:
+        m.close()
+
+
+def hash_file(file_name, algorithms=DEFAULT_ALGORITHMS, block_size=DEFAULT_BLOCK_SIZE, use_mmap=None):
+    """Computes several digests of a file in a single pass.
+
+    Args:
+      file_name: The file to hash.
+      algorithms: Names of the digests to compute. Any hashlib name, "crc32" or "xxh64".
+      block_size: Size of each read.
+      use_mmap: Read the file through a memory map. If None it is decided by the file size.
+
+    Returns:
+      A dict mapping each algorithm name to its hex digest.
+    """
+    hashers = [new_hasher(a) for a in algorithms]
+    with open(file_name, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if use_mmap is None:
+            use_mmap = size >= MMAP_MIN_SIZE
+
+        if use_mmap and size > 0:
+            _hash_mmap(f, hashers, size, block_size)
+        else:
+            _hash_blocks(f, hashers, block_size)
+
+    return dict(zip(algorithms, [h.hexdigest() for h in hashers]))
+
+
+def md5sum(file_name):
+    return hash_file(file_name, ("md5",))["md5"]
+
+
+def partial_hash(file_name, block_size=PARTIAL_BLOCK_SIZE):
+    """md5 of the first and last block_size bytes of a file, cheap to tell apart files of the same size.
+
+    Files up to twice block_size are read entirely, so for them it is the md5sum of the whole file.
+    """
+    h = hashlib.md5()
+    with open(file_name, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size <= 2 * block_size:
+            h.update(f.read())
+        else:
+            h.update(f.read(block_size))
+            f.seek(size - block_size)
+            h.update(f.read(block_size))
+    return h.hexdigest()
@@ -0,0 +1,127 @@
+"""Per process cache of file metadata.
+
+The archiver, uploaders and geotagger all need the stat, date, GPS
+position and mime type of the same files. get_file_info() returns a
+FileInfo that computes each of them at most once, kept in a bounded LRU
+cache. Whoever modifies a file must call invalidate() for it.
+
+"""
+
+import datetime
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import exifreader
+import mp4reader
+import utils
+
+DEFAULT_CACHE_SIZE = 4096
+
+_NOT_READ = object()
+
+
+class FileInfo(object):
+    __slots__ = ("path", "_stat", "_exif_tags", "_date", "_mime_type")
+
+    def __init__(self, path, st=None):
+        self.path = path
+        self._stat = st
+        self._exif_tags = _NOT_READ
+        self._date = _NOT_READ
+        self._mime_type = _NOT_READ
+
+    def stat(self):
+        if self._stat is None:
+            self._stat = os.stat(self.path)
+        return self._stat
+
+    @property
+    def size(self):
+        return self.stat().st_size
+
+    @property
+    def exif_tags(self):
+        """Date and GPS tags read by exifreader, None if the file is not a JPEG or they could not be read."""
+        if self._exif_tags is _NOT_READ:
+            self._exif_tags = exifreader.read_exif(self.path) if utils.is_picture(self.path) else None
+        return self._exif_tags
+
+    @property
+    def has_exif_dates(self):
+        """True if all the EXIF date tags are set, so there is nothing to correct."""
+        tags = self.exif_tags
+        return tags is not None and all(tags.get(key) is not None for key in exifreader.DATE_TAGS)
+
+    @property
+    def gps_position(self):
+        tags = self.exif_tags
+        if tags is None:
+            return None
+        return exifreader.gps_position(tags)
+
+    @property
+    def file_date(self):
+        """The date of the file in the file system (ctime)."""
+        file_date = time.localtime(self.stat().st_ctime)
+        return datetime.datetime(file_date.tm_year, file_date.tm_mon, file_date.tm_mday,
+                                 file_date.tm_hour, file_date.tm_min, file_date.tm_sec)
+
+    @property
+    def date(self):
+        """Same as utils.get_picture_date, from EXIF or the movie header, the file name or the file date."""
+        if self._date is _NOT_READ:
+            obj_date = None
+            if utils.is_picture(self.path):
+                tags = self.exif_tags
+                if tags is not None:
+                    obj_date = utils.read_picture_date(tags)
+                else:
+                    obj_date = utils.date_from_exif_data(self.path)
+            elif mp4reader.is_iso_media(self.path):
+                obj_date = mp4reader.read_creation_date(self.path)
+
+            if obj_date is None:
+                obj_date = utils.get_date_from_filename(self.path)
+                if obj_date is None:
+                    obj_date = self.file_date
+
+            self._date = obj_date
+        return self._date
+
+    @property
+    def mime_type(self):
+        if self._mime_type is _NOT_READ:
+            self._mime_type = utils.file_name_to_mimetype(self.path)
+        return self._mime_type
+
+
+_cache = OrderedDict()
+_cache_size = DEFAULT_CACHE_SIZE
+_lock = threading.Lock()
+
+
+def set_cache_size(size):
+    global _cache_size
+    with _lock:
+        _cache_size = size
+        while len(_cache) > _cache_size:
+            _cache.popitem(last=False)
+
+
+def get_file_info(path, st=None):
+    """Returns the cached FileInfo of path, st is used as its stat if it is not cached yet."""
+    with _lock:
+        info = _cache.pop(path, None)
+        if info is None:
+            info = FileInfo(path, st)
+            if len(_cache) >= _cache_size:
+                _cache.popitem(last=False)
+        _cache[path] = info
+    return info
+
+
+def invalidate(path):
+    with _lock:
+        _cache.pop(path, None)
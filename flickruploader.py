@@ -4,8 +4,10 @@ import webbrowser
 import flickrapi
 from flickrapi.auth import FlickrAccessToken
 
-from pictureuploader import PictureUploader, FileWithCallback
-import utils
+from pictureuploader import PictureUploader
+import concurrency
+import fileinfo
+import httppool
 
 
 md5_tag_prefix = "checksum:md5="
@@ -20,14 +22,37 @@ class FlickrUploader(PictureUploader):
         PictureUploader.__init__(self)
 
         self._token_key = "flickr-token"
+        self._account = user or ""
         if user:
             self._token_key += "-" + user
 
-        self._flickr = flickrapi.FlickrAPI(api_key, api_secret, store_token=False, username=user, cache=False,
-                                           token=self._load_token())
+        self._api_key = api_key
+        self._api_secret = api_secret
+        self._user = user
+        self._flickr = self._new_flickr(self._load_token())
+        self._local.flickr = self._flickr
         self.check_remote_chksum = True
+        self.max_uploads = 4
         self._set_service_name("flickr")
 
+    def _new_flickr(self, token):
+        flickr = flickrapi.FlickrAPI(self._api_key, self._api_secret, store_token=False, username=self._user,
+                                     cache=False, token=token)
+        # Keep-alive connections for the API calls and the uploads, flickrapi sends them through a requests session.
+        httppool.mount(getattr(getattr(flickr, "flickr_oauth", None), "session", None))
+        return flickr
+
+    def _get_flickr(self):
+        """The FlickrAPI of the calling thread, with the token of the authenticated one.
+
+        The pipeline calls find_remote() and send_file() from several threads, a FlickrAPI and its OAuth requests
+        session are not known to be safe to share between them. Only the connection pool is shared.
+        """
+        flickr = getattr(self._local, "flickr", None)
+        if flickr is None:
+            flickr = self._local.flickr = self._new_flickr(self._flickr.token_cache.token)
+        return flickr
+
     def _load_token(self):
         try:
             token_data = self._dataHelper.get_secure_data(self._token_key)
@@ -53,46 +78,70 @@ class FlickrUploader(PictureUploader):
 
 
     def get_photoid_from_md5sum(self, md5sum):
-        for photo in self._flickr.walk(user_id="me", tags=md5_tag_prefix + md5sum):
+        for photo in self._get_flickr().walk(user_id="me", tags=md5_tag_prefix + md5sum):
             return photo.get("id")
         return 0
 
-    def upload_file(self, file_name, md5sum=None):
-        try:
-            if md5sum is None:
-                md5sum = utils.get_md5sum_from_file(file_name)
-                pass
-
-            photoid = 0
-            if self.check_remote_chksum:
-                photoid = self.get_photoid_from_md5sum(md5sum)
-            if photoid != 0:
-                print "File", file_name, "already uploaded. ID:", photoid
-                return photoid
+    def fetch_inventory(self, since=None):
+        kwargs = {}
+        if since is not None:
+            kwargs["min_upload_date"] = str(int(since))
+        for photo in self._get_flickr().walk(user_id="me", extras="machine_tags", per_page="500", **kwargs):
+            for tag in (photo.get("machine_tags") or "").split():
+                if tag.startswith(md5_tag_prefix):
+                    yield "md5:" + tag[len(md5_tag_prefix):], photo.get("id")
+
+    def find_remote(self, file_name, md5sum):
+        if not self.check_remote_chksum:
+            return 0
+        if self.use_inventory:
+            return PictureUploader.find_remote(self, file_name, md5sum)
+        return self.get_photoid_from_md5sum(md5sum)
 
+    def send_file(self, file_name, md5sum, upload_name=None):
+        try:
             tags = md5_tag_prefix + md5sum
-            date = utils.get_picture_date(file_name)
+            date = fileinfo.get_file_info(file_name).date
             if date is not None:
                 tags += " " + date_tag_prefix + date.isoformat()
                 tags += " " + date_year_tag_prefix + date.strftime("%Y")
                 tags += " " + date_month_tag_prefix + date.strftime("%Y-%m")
                 tags += " " + date_day_tag_prefix + date.strftime("%Y-%m-%d")
 
-            f = FileWithCallback(file_name)
-            rsp = self._flickr.upload(file_name, f, title="",
-                                      description="", tags=tags, is_public="0", is_family="0",
-                                      is_friend="0", format="xmlnode")
-            f.all_done()
+            # Flickr has no resumable uploads, a transient failure sends the whole file again.
+            attempts = [0]
 
-            sys.stdout.flush()
+            def upload():
+                attempts[0] += 1
+                if attempts[0] > 1:
+                    # The upload is not idempotent, the photo may have been stored and only the response lost.
+                    photo_id = self.get_photoid_from_md5sum(md5sum)
+                    if photo_id:
+                        return photo_id
 
-            if rsp['stat'] == u'ok':
-                return rsp.photoid[0].text
+                f = self.open_upload(upload_name, file_name)
+                try:
+                    rsp = self._get_flickr().upload(file_name, f, title="",
+                                                    description="", tags=tags, is_public="0", is_family="0",
+                                                    is_friend="0", format="xmlnode")
+                finally:
+                    f.close()
 
-            return 0
+                if rsp['stat'] == u'ok':
+                    return rsp.photoid[0].text
+                return 0
+
+            photo_id = self.retry(upload, file_name)
+
+            sys.stdout.flush()
+
+            return photo_id
         except Exception as e:
+            if concurrency.is_throttling(e):
+                # Counted by the upload limiter, it reports the failure.
+                raise
             try:
-                print "Error on: ", file_name
+                self.note(u"Error on: " + file_name)
                 sys.stderr.write(u"Error on " + file_name + u": " + unicode(e) + u"\n")
             except:
                 sys.stderr.write("Error printing error.\n")  # :D
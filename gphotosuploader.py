@@ -1,10 +1,8 @@
 #!/usr/bin/python
 # coding=UTF8
 
-import pyexiv2
+import datetime
 import os
-import Image
-import time
 import webbrowser
 import sys
 
@@ -14,7 +12,12 @@ import gdata.media
 import gdata.geo
 
 from picasaclient import PicasaClient
-from pictureuploader import PictureUploader, FileWithCallback
+from pictureuploader import PictureUploader
+import concurrency
+import fastresize
+import fileinfo
+import resumable
+import uploadpipeline
 import utils
 
 
@@ -25,6 +28,9 @@ NICKNAME_KEY = "nickname"
 ALBUM_KEY = "albumid"
 
 MAX_VIDEO_SIZE = 104857600
+# Bigger files are sent in chunks that are not sent again after a failure
+RESUMABLE_MIN_SIZE = 16 * 1024 * 1024
+INVENTORY_PAGE_SIZE = 1000
 
 
 class GoogleUploader(PictureUploader):
@@ -33,20 +39,38 @@ class GoogleUploader(PictureUploader):
         self._client_id = client_id
         self._client_secret = client_secret
         self._gd_client = PicasaClient()
+        self._local.gd_client = self._gd_client
+        self._token = None
         self._autobackup_album = None
         self._set_service_name("gphotos")
         self.original_size = False
         self._user_name = user or ""
+        self._account = user or ""
         self._allowed_file_exts += [".mov", ".mp4", ".avi", ".mpg", ".mpeg", ".3gp", ".3gpp"]
         self._user_data = None
         self._token_key = TOKEN_KEY
+        self.max_uploads = 8
+        self._resizer = None
         if user:
             self._token_key += "-" + user
 
+    def _get_client(self):
+        """The PicasaClient of the calling thread, authorized with the token of the authenticated one.
+
+        OAuth2Token.authorize() wraps the http client request to refresh the token on a 401, so the upload threads
+        each get a client of their own instead of sending and refreshing through a single one.
+        """
+        client = getattr(self._local, "gd_client", None)
+        if client is None:
+            client = self._local.gd_client = PicasaClient()
+            if self._token is not None:
+                self._token.authorize(client)
+        return client
+
     def get_user_feed_data(self):
         if self._user_data is None:
             albumid = "default"
-            feed = self._gd_client.GetUserFeed()
+            feed = self._get_client().GetUserFeed()
             user_name = feed.nickname.text
             for album in feed.entry:
                 if album.name.text == "InstantUpload":
@@ -65,75 +89,100 @@ class GoogleUploader(PictureUploader):
 
         return self._autobackup_album
 
-    def resize_image(self, org_file_name, rez_file_name, max_width=2048):
-        img = Image.open(org_file_name)
-
-        w, h = img.size
-
-        if w <= max_width and h <= max_width:
-            return False
-
-        if w > h:
-            ratio = (max_width / float(w))
-            h = int((float(h) * float(ratio)))
-            w = max_width
-        elif w < h:
-            ratio = (max_width / float(h))
-            w = int((float(w) * float(ratio)))
-            h = max_width
-        else:
-            w = max_width
-            h = max_width
-
-        img = img.resize((w, h), Image.ANTIALIAS)
-        img.save(rez_file_name, None, quality=88)
-
-        org_exif_data = pyexiv2.ImageMetadata(org_file_name)
-        org_exif_data.read()
-        rez_exif_data = pyexiv2.ImageMetadata(rez_file_name)
-        rez_exif_data.read()
-
-        org_exif_data.copy(rez_exif_data, True, True, True, True)
-        rez_exif_data.write()
+    def fetch_inventory(self, since=None):
+        # Picasa only has the checksum of the photos uploaded with one, the others can't be told apart from a
+        # different file with the same name and size and are sent again.
+        updated_min = None
+        if since is not None:
+            updated_min = datetime.datetime.utcfromtimestamp(since).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+        start_index = 1
+        while True:
+            feed = self._get_client().GetAlbumPhotos(self.get_autobackup_album_url(), start_index, INVENTORY_PAGE_SIZE,
+                                                   updated_min)
+            for entry in feed.entry:
+                photo_id = entry.gphoto_id.text
+                if entry.checksum is not None and entry.checksum.text:
+                    yield "md5:" + entry.checksum.text, photo_id
+
+            if len(feed.entry) < INVENTORY_PAGE_SIZE:
+                break
+            start_index += len(feed.entry)
+
+    def transform_file(self, file_name):
+        content = fileinfo.get_file_info(file_name).mime_type
+        if content is None or not content.startswith("image") or self.original_size:
+            return None
+
+        if self._resizer is not None:
+            return self._resizer.resize(file_name)
+        return fastresize.resize_to_spool(file_name)
+
+    def _with_resizer(self, upload, *args):
+        if self.original_size:
+            return upload(self, *args)
+
+        # The resize processes are forked before the upload threads are started.
+        self._resizer = fastresize.ResizePool()
+        self.workers.setdefault(uploadpipeline.TRANSFORM, self._resizer.processes)
+        try:
+            return upload(self, *args)
+        finally:
+            self._resizer.close()
+            self._resizer = None
 
-        datetime = utils.get_date_from_file_date(org_file_name)
-        filetime = time.mktime(datetime.timetuple())
-        os.utime(rez_file_name, (filetime, filetime))
+    def upload_directory(self, dir_name):
+        return self._with_resizer(PictureUploader.upload_directory, dir_name)
 
-        return True
+    def work_queue(self, queue=None):
+        return self._with_resizer(PictureUploader.work_queue, queue)
 
-    def upload_file(self, file_name, md5sum=None):
+    def send_file(self, file_name, md5sum, upload_name=None):
         album_url = self.get_autobackup_album_url()
         fname = os.path.basename(file_name)
-        temp_file_name = None
         photo_id = 0
         try:
-            content = utils.file_name_to_mimetype(file_name)
+            content = fileinfo.get_file_info(file_name).mime_type
             if content is None:
                 sys.stderr.write("Can't determine mime type for file " + file_name + "\n")
                 return 0
 
-            if content.startswith("image") and not self.original_size:
-                path, name = os.path.split(file_name)
-                temp_file_name = os.path.join(path, ".resizing___" + name)
-                if self.resize_image(file_name, temp_file_name):
-                    file_name = temp_file_name
-                else:
-                    temp_file_name = None
-
-
-            f = FileWithCallback(file_name)
-            if content.startswith("video") and f.len > MAX_VIDEO_SIZE:
+            size = utils.get_file_size(upload_name or file_name)
+            if content.startswith("video") and size > MAX_VIDEO_SIZE:
                 sys.stderr.write("File " + file_name + " is bigger than " + utils.sizeof_fmt(MAX_VIDEO_SIZE) + "\n")
                 return 0
 
-            photo = self._gd_client.InsertPhotoSimple(album_url, fname, "", f, content)
+            # A resized copy is not resumed, it may not be the same in the next run.
+            if size >= RESUMABLE_MIN_SIZE and (upload_name is None or upload_name == file_name):
+                transfer = self.start_transfer(file_name, size)
+                upload = resumable.ResumableUpload(self._get_data(), self._cloud_service_name, file_name, md5sum,
+                                                   on_progress=transfer.set if transfer is not None else None,
+                                                   on_retry=self.on_retry)
+                try:
+                    photo = self._get_client().InsertPhotoResumable(album_url, fname, "", upload, content,
+                                                                   checksum=md5sum)
+                finally:
+                    if transfer is not None:
+                        transfer.end()
+                if upload.resumed_from:
+                    self.note("Resumed " + fname + " from " + utils.sizeof_fmt(upload.resumed_from))
+            else:
+                def upload():
+                    f = self.open_upload(upload_name, file_name)
+                    try:
+                        # The md5sum of the original, a resized copy is known by it too.
+                        return self._get_client().InsertPhotoSimple(album_url, fname, "", f, content,
+                                                                    checksum=md5sum)
+                    finally:
+                        f.close()
+
+                photo = self.retry(upload, fname)
             photo_id = photo.gphoto_id.text
         except Exception as e:
-            print "Failed to upload file", fname + ":", e
-
-        if temp_file_name is not None:
-            os.remove(temp_file_name)
+            if concurrency.is_throttling(e):
+                # Counted by the upload limiter, it reports the failure.
+                raise
+            self.note(u"Failed to upload file " + fname + u": " + unicode(e))
 
         return photo_id
 
@@ -159,7 +208,7 @@ class GoogleUploader(PictureUploader):
 
     def refresh_token(self, token):
         # Hack to fix possible bug in Google SDK (I have no idea what I'm doing)
-        token._refresh(self._gd_client.http_client.request)
+        token._refresh(self._get_client().http_client.request)
         self._save_token(token)
 
     def authenticate(self):
@@ -168,7 +217,8 @@ class GoogleUploader(PictureUploader):
             if token is not None:                
                 self.refresh_token(token)
                 if not token.invalid:                    
-                    token.authorize(self._gd_client)
+                    self._token = token
+                    token.authorize(self._get_client())
                     return True
                 
             token = gdata.gauth.OAuth2Token(
@@ -179,7 +229,8 @@ class GoogleUploader(PictureUploader):
             print "Authorize URL:", authorize_url
             webbrowser.open_new_tab(authorize_url)
             token.get_access_token(unicode(raw_input('Verifier code: ')))
-            token.authorize(self._gd_client)
+            self._token = token
+            token.authorize(self._get_client())
             self._save_token(token)
             return True
 
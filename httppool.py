@@ -0,0 +1,281 @@
+"""Keep-alive HTTP connection pool shared by the uploaders.
+
+Every request used to open its own connection, paying the TCP and TLS
+handshakes and the TCP slow start again for each photo. The pool keeps
+the connections open after the response has been read and hands them to
+the next request to the same host, up to pool_size connections per host.
+Connections idle for more than idle_timeout are closed instead of reused,
+before the server drops them on its side. A request waiting longer than
+acquire_timeout for a free connection fails with PoolTimeout.
+
+gdata uses it through picasaclient.PooledHttpClient and flickrapi (which
+goes through requests) through a PooledRequestsAdapter mounted on its
+session.
+
+"""
+
+import httplib
+import socket
+import threading
+import time
+import urlparse
+
+try:
+    import requests
+    import requests.adapters
+    import requests.structures
+    import requests.utils
+except ImportError:
+    requests = None
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_IDLE_TIMEOUT = 30.0
+DEFAULT_TIMEOUT = 300.0
+DEFAULT_ACQUIRE_TIMEOUT = 600.0
+
+
+class PoolTimeout(socket.timeout):
+    """No connection to the host was given back to the pool in time."""
+
+
+class PooledResponse(object):
+    """httplib response that gives its connection back to the pool once it has been read completely."""
+
+    def __init__(self, pool, key, connection, response):
+        self._pool = pool
+        self._key = key
+        self._connection = connection
+        self._response = response
+        if response.isclosed():
+            # No body (HEAD, 204...)
+            self._release(True)
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    def read(self, amt=None):
+        try:
+            data = self._response.read() if amt is None else self._response.read(amt)
+        except:
+            self._release(False)
+            raise
+        if self._response.isclosed():
+            self._release(True)
+        return data
+
+    def close(self):
+        # Closing before the end leaves unread data in the connection, it can't be reused.
+        complete = self._response.isclosed()
+        self._response.close()
+        self._release(complete)
+
+    def _release(self, complete):
+        connection = self._connection
+        if connection is None:
+            return
+        self._connection = None
+        if not complete or self._response.will_close:
+            connection.close()
+            connection = None
+        self._pool.release(self._key, connection)
+
+
+class ConnectionPool(object):
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, idle_timeout=DEFAULT_IDLE_TIMEOUT, timeout=DEFAULT_TIMEOUT,
+                 ssl_context=None, acquire_timeout=DEFAULT_ACQUIRE_TIMEOUT):
+        """
+        Args:
+          pool_size: Maximum connections open to the same host, requests beyond it wait for a free one.
+          idle_timeout: Seconds a connection is kept open without being used.
+          timeout: Socket timeout of the connections.
+          ssl_context: The ssl.SSLContext of the https connections, the default one if None.
+          acquire_timeout: Seconds a request waits for a free connection before PoolTimeout is raised.
+        """
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.acquire_timeout = acquire_timeout
+        self.ssl_context = ssl_context
+        self.created = 0
+        self.reused = 0
+        self._idle = {}
+        self._active = {}
+        self._cond = threading.Condition()
+
+    def acquire(self, scheme, host, port=None):
+        """Returns (key, connection, reused), the connection must be given back with release()."""
+        key = (scheme, host, port)
+        deadline = time.time() + self.acquire_timeout
+        with self._cond:
+            while True:
+                idle = self._idle.get(key)
+                now = time.time()
+                while idle:
+                    connection, last_used = idle.pop()
+                    if now - last_used < self.idle_timeout:
+                        self._active[key] = self._active.get(key, 0) + 1
+                        self.reused += 1
+                        return key, connection, True
+                    connection.close()
+
+                if self._active.get(key, 0) < self.pool_size:
+                    self._active[key] = self._active.get(key, 0) + 1
+                    self.created += 1
+                    break
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    # A response that is never read or closed keeps its connection taken.
+                    raise PoolTimeout("No free connection to " + host + " after " + str(self.acquire_timeout) + " s")
+                self._cond.wait(min(remaining, 1.0))
+
+        try:
+            if scheme == "https":
+                if self.ssl_context is not None:
+                    connection = httplib.HTTPSConnection(host, port, timeout=self.timeout, context=self.ssl_context)
+                else:
+                    connection = httplib.HTTPSConnection(host, port, timeout=self.timeout)
+            else:
+                connection = httplib.HTTPConnection(host, port, timeout=self.timeout)
+            connection.connect()
+            # The headers and the body are sent separately, with Nagle the next request on a kept alive connection
+            # waits for the delayed ACK of the last one.
+            connection.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except:
+            self.release(key, None)
+            raise
+        return key, connection, False
+
+    def release(self, key, connection):
+        """Gives a connection back, None if it was closed."""
+        with self._cond:
+            self._active[key] -= 1
+            if connection is not None:
+                self._idle.setdefault(key, []).append((connection, time.time()))
+            self._cond.notify()
+
+    def request(self, method, url, body=None, headers=None, timeout=None):
+        """Sends a request through a pooled connection, returns a PooledResponse.
+
+        timeout is the socket timeout of this request, the one of the pool if None.
+        """
+        parsed = urlparse.urlsplit(url)
+        path = parsed.path or "/"
+        if parsed.query:
+            path += "?" + parsed.query
+
+        while True:
+            key, connection, reused = self.acquire(parsed.scheme, parsed.hostname, parsed.port)
+            try:
+                # A kept alive connection still has the timeout of the last request.
+                connection.sock.settimeout(timeout if timeout is not None else self.timeout)
+                connection.request(method, path, body, headers or {})
+                response = connection.getresponse()
+            except (socket.error, httplib.HTTPException):
+                connection.close()
+                self.release(key, None)
+                # The server may have dropped a kept alive connection, the request is sent again in a new one
+                # unless its body was a file already consumed.
+                if reused and (body is None or isinstance(body, basestring)):
+                    continue
+                raise
+            return PooledResponse(self, key, connection, response)
+
+    def close(self):
+        """Closes the idle connections."""
+        with self._cond:
+            for idle in self._idle.values():
+                for connection, last_used in idle:
+                    connection.close()
+            self._idle = {}
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """The pool shared by the uploaders."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool()
+        return _pool
+
+
+def configure(pool_size=None, idle_timeout=None, acquire_timeout=None):
+    pool = get_pool()
+    if pool_size is not None:
+        pool.pool_size = pool_size
+    if idle_timeout is not None:
+        pool.idle_timeout = idle_timeout
+    if acquire_timeout is not None:
+        pool.acquire_timeout = acquire_timeout
+
+
+if requests is not None:
+    class PooledRequestsAdapter(requests.adapters.BaseAdapter):
+        """requests transport adapter sending through a ConnectionPool.
+
+        The pool only makes direct connections checked against the default certificates, the requests with a proxy,
+        another CA bundle or a client certificate are sent by a stock HTTPAdapter instead.
+        """
+
+        def __init__(self, pool):
+            requests.adapters.BaseAdapter.__init__(self)
+            self._pool = pool
+            self._fallback = None
+
+        def _get_fallback(self):
+            if self._fallback is None:
+                self._fallback = requests.adapters.HTTPAdapter()
+            return self._fallback
+
+        def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+            if verify is not True or cert is not None or _select_proxy(request.url, proxies):
+                return self._get_fallback().send(request, stream, timeout, verify, cert, proxies)
+
+            if isinstance(timeout, tuple):
+                # (connect, read), the pool connects with its own timeout.
+                timeout = timeout[1]
+            headers = dict(request.headers)
+            # The body is handed to the caller as it arrives, it can't be compressed.
+            headers["Accept-Encoding"] = "identity"
+            response = self._pool.request(request.method, request.url, request.body, headers, timeout)
+            result = requests.Response()
+            result.status_code = response.status
+            result.reason = response.reason
+            result.headers = requests.structures.CaseInsensitiveDict(response.getheaders())
+            result.encoding = requests.utils.get_encoding_from_headers(result.headers)
+            result.raw = response
+            result.url = request.url
+            result.request = request
+            result.connection = self
+            if not stream:
+                # Reads the body, giving the connection back to the pool.
+                result.content
+            return result
+
+        def close(self):
+            if self._fallback is not None:
+                self._fallback.close()
+
+    def _select_proxy(url, proxies):
+        """The proxy of proxies requests would use for url, None if it is sent directly."""
+        if not proxies:
+            return None
+        parsed = urlparse.urlsplit(url)
+        for key in (parsed.scheme + "://" + (parsed.hostname or ""), parsed.scheme, "all"):
+            if proxies.get(key):
+                return proxies[key]
+        return None
+
+
+def mount(session, pool=None):
+    """Sends the requests of a requests.Session through the pool, returns False if that is not possible."""
+    if requests is None or session is None or not hasattr(session, "mount"):
+        return False
+    adapter = PooledRequestsAdapter(pool or get_pool())
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return True
@@ -6,6 +6,10 @@ import argparse
 import os
 import sys
 from picturearchiver import PictureArchiver
+from archivepipeline import ArchivePipeline
+from catalog import Catalog
+import contentindex
+import progress
 import utils
 
 DEFAUL_CONFIG = "~/.hmsoft/arcpics.json"
@@ -18,10 +22,28 @@ if __name__ == "__main__":
     parser.add_argument('-c', dest="config", help='The config file', default=None)
     parser.add_argument('-z', dest="start_size", help='Take in account only files bigger than START_SIZE megabytes', default="0")
     parser.add_argument('-m', dest='move', action="store_true", help="Move files instead of copy them.")
-    parser.add_argument('-d', dest='diagnostics', action="store_true", help="Don't run the actual actions.")
+    parser.add_argument('-d', dest='diagnostics', action="store_true", help="Don't run the actual actions, show what would be done and its estimated time.")
     parser.add_argument('-s', dest='scan_only', action="store_true", help="Scan folder but don't perform backup")
+    parser.add_argument('-p', dest='parallel', action="store_true",
+                        help="Import from different source devices at the same time.")
+    parser.add_argument('-v', dest='verify', action="store_true",
+                        help="Hash the data while copying it, fsync the copies and record their digest. "
+                             "The copies go through Python then, without reflink, copy_file_range or sendfile.")
+    parser.add_argument('-u', dest='dedup', action="store_const", const=contentindex.SKIP, default=None,
+                        help="Skip the files already archived anywhere in the destination, with any name.")
+    parser.add_argument('-l', dest='dedup', action="store_const", const=contentindex.LINK,
+                        help="Like -u but hard link the files already archived into their date folder.")
+    parser.add_argument('-n', dest='no_catalog', action="store_true",
+                        help="Check the destination files in the disk even if it has a catalog.")
+    parser.add_argument('-r', dest='rescan', action="store_true",
+                        help="Scan the source again instead of resuming an interrupted run.")
+    parser.add_argument('-P', dest='progress_file', default=None,
+                        help="Write the progress as JSON lines to PROGRESS_FILE ('-' for the standard output, the "
+                             "other messages go to the standard error then).")
 
     options = parser.parse_args()
+    if options.progress_file == "-":
+        progress.reserve_stdout()
 
     import json
     config = None
@@ -55,6 +77,19 @@ if __name__ == "__main__":
         sys.stderr.write("Source folders in config is not a valid list: " + src_folders + "\n")
         exit()
 
+    catalog = None
+    if not options.no_catalog:
+        catalog = Catalog.open_existing(dest_folder)
+        if catalog is not None:
+            # Files written by other tools or by runs without the catalog are missing from it, the folders they
+            # changed are listed again.
+            stale = catalog.check()
+            print "Using the destination catalog,", len(stale), "folders updated."
+
+    pipeline = None
+    if options.parallel and not options.scan_only:
+        pipeline = ArchivePipeline(dest_folder)
+
     for path in src_folders:
         import glob
         try:
@@ -64,9 +99,26 @@ if __name__ == "__main__":
         for exp_path in expanded_paths:
             if os.path.isdir(exp_path):
                 if not os.path.isfile(os.path.join(exp_path, ".no_backup")):
+                    if pipeline is not None:
+                        pipeline.add_source(exp_path)
+                        continue
                     print "Starting import from ", exp_path
                     if not options.scan_only:
-                        PictureArchiver.do(exp_path, dest_folder, options.diagnostics, options.move, options.start_size)
+                        status = progress.open_progress("files", options.progress_file)
+                        try:
+                            PictureArchiver.do(exp_path, dest_folder, options.diagnostics, options.move,
+                                               options.start_size, options.verify, options.dedup, catalog,
+                                               not options.rescan, status)
+                        finally:
+                            status.close()
             else:
                 print path, " not found."
 
+    if pipeline is not None:
+        status = progress.open_progress("files", options.progress_file)
+        try:
+            pipeline.run(options.diagnostics, options.move, options.start_size, options.verify, options.dedup, catalog,
+                         not options.rescan, status)
+        finally:
+            status.close()
+
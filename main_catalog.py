@@ -0,0 +1,56 @@
+#!/usr/bin/python
+# coding=UTF8
+
+import argparse
+import os
+import sys
+
+import catalog
+import utils
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Maintain the catalog of the backup disk, used by arcpics to check '
+                                                 'the files already archived without reading the disk.')
+    parser.add_argument('destination', help='The backup folder, if not specified it is determined automatically.',
+                        nargs='?', default=None)
+    parser.add_argument('-r', dest='rebuild', action="store_true", help="Rebuild the catalog listing the whole disk.")
+    parser.add_argument('-j', dest="jobs", type=int, help='Number of folders listed at the same time on rebuild',
+                        default=catalog.DEFAULT_JOBS)
+    parser.add_argument('-c', dest='check', action="store_true",
+                        help="Check the catalog against the disk and update the folders that changed.")
+    parser.add_argument('-s', dest="sample", type=int, help='Also check SAMPLE random files on check', default=0)
+    options = parser.parse_args()
+
+    if options.destination is not None:
+        dest_folder = unicode(options.destination, "UTF-8")
+    else:
+        dest_folder = utils.find_backup_folder(utils.primary_backup_marker)
+        if dest_folder is None:
+            sys.stderr.write("Could not determine backup folder\n")
+            exit()
+
+    if not os.path.isfile(catalog.catalog_file(dest_folder)) and not options.rebuild:
+        print dest_folder, "has no catalog, build it with -r."
+        exit()
+
+    dest_catalog = catalog.Catalog(dest_folder)
+
+    if options.rebuild:
+        print "Rebuilding catalog of", dest_folder
+        print dest_catalog.rebuild(options.jobs), "files found."
+
+    if options.check:
+        print "Checking catalog of", dest_folder
+        for path in dest_catalog.check(options.sample):
+            print "UPDATED:", path
+
+    count, size, dirs = dest_catalog.get_stats()
+    print count, "files in", dirs, "folders in catalog. (" + utils.sizeof_fmt(size) + ")"
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print "Terminated by user."
@@ -0,0 +1,28 @@
+#!/usr/bin/python
+# coding=UTF8
+
+import argparse
+import multiprocessing
+
+from picturearchiver import PictureArchiver
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Set the missing EXIF dates and the file time of the pictures and '
+                                                 'videos in the given folder recursively.')
+    parser.add_argument('folder', help='The folder with the pictures to correct.')
+    parser.add_argument('-j', dest="jobs", type=int, help='Number of worker processes (default one per CPU)',
+                        default=multiprocessing.cpu_count())
+    parser.add_argument('-f', dest='full_scan', action="store_true",
+                        help="Scan every folder, also the ones unchanged since the last pass")
+    options = parser.parse_args()
+
+    print "Correcting dates in", options.folder
+    PictureArchiver.correct_dates(unicode(options.folder, "UTF-8"), not options.full_scan, max(options.jobs, 1))
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print "Terminated by user."
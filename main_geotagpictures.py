@@ -16,6 +16,8 @@ def main():
     parser.add_argument('-o', dest="overwrite", action="store_true", help='Overwrite location tag if exists.')
     parser.add_argument('-r', dest="time_range", help='Location query time range in minutes. (default 15)', type=int,
                         default=15)
+    parser.add_argument('-f', dest='full_scan', action="store_true",
+                        help="Scan every folder, also the ones unchanged since the last geotag pass")
 
     options = parser.parse_args()
 
@@ -24,6 +26,8 @@ def main():
         exit()
 
     tagger = picgeotager.PicGotagger(options.time_range, options.overwrite)
+    if options.full_scan:
+        tagger.incremental = False
 
     if options.download_url is not None:
         if not options.download_url.startswith("http://"):
@@ -6,26 +6,63 @@ import os
 import sys
 
 from gphotosuploader import GoogleUploader
+import progress
 import utils
 
 
 def main():
     def scan(fup):
         print "Scanning folder", options.folder, "..."
-        pc, npc, pcs, npcs = fup.scan_directory(options.folder)
+        fup.incremental = not options.full_scan
+        pc, npc, pcs, npcs = fup.scan_directory(options.folder, options.manifest)
         print pc, "total pictures found. (" + utils.sizeof_fmt(pcs) + ")"
         print npc, "other files found. (" + utils.sizeof_fmt(npcs) + ")"
 
+    def queue(up):
+        if options.enqueue:
+            print "Scanning folder", options.folder, "..."
+            up.incremental = not options.full_scan
+            print up.enqueue_directory(unicode(options.folder, "UTF-8")), "files added to the upload queue."
+        stats = up.open_queue().stats()
+        for state in ("pending", "leased", "done", "failed"):
+            count, size = stats.get(state, (0, 0))
+            print state + ":", count, "files (" + utils.sizeof_fmt(size) + ")"
+
     parser = argparse.ArgumentParser(description='Upload to Google+ all JPEG pictures in the given folder recursively')
-    parser.add_argument('folder', help='The folder to search for pictures')
+    parser.add_argument('folder', help='The folder to search for pictures', nargs='?', default=None)
     parser.add_argument('-u', dest="user_name", help='Google user name', default="")
     parser.add_argument('-s', dest='scan_only', action="store_true", help="Scan folder but don't upload pictures")
+    parser.add_argument('-m', dest="manifest", help='Save the scan result to MANIFEST, or reuse it if no folder changed since',
+                        default=None)
+    parser.add_argument('-t', dest='stream', action="store_true",
+                        help="Start uploading while the folder is still being scanned")
+    parser.add_argument('-f', dest='full_scan', action="store_true",
+                        help="Scan every folder, also the ones unchanged since the last upload")
+    parser.add_argument('-j', dest="jobs", type=int, default=None,
+                        help='Maximum number of files uploaded at the same time, the number in flight is adjusted to '
+                             'the link speed (default 8)')
     parser.add_argument('-r', dest="small_size", action="store_true", help='Reduce image size before upload.')
+    parser.add_argument('-n', dest='no_chk_remote', action="store_true",
+                        help="Do not check the photos already in the autobackup album")
+    parser.add_argument('-R', dest='full_inventory', action="store_true",
+                        help="Fetch the list of every photo in the album, not only the ones added since the last run")
+    parser.add_argument('-P', dest='progress_file', default=None,
+                        help="Write the progress as JSON lines to PROGRESS_FILE ('-' for the standard output, the "
+                             "other messages go to the standard error then)")
+    parser.add_argument('-q', dest='enqueue', action="store_true",
+                        help="Add the pictures of the folder to the upload queue, to be uploaded by the workers (-w)")
+    parser.add_argument('-w', dest='worker', action="store_true",
+                        help="Upload the pictures in the upload queue, with any other workers running, until it is "
+                             "empty")
+    parser.add_argument('-Q', dest='queue_status', action="store_true",
+                        help="Show the number of files in the upload queue by state")
     parser.add_argument('-a', dest='auth_only', action="store_true", help="Authenticate to Google service")
 
     options = parser.parse_args()
+    if options.progress_file == "-":
+        progress.reserve_stdout()
 
-    if not options.folder:
+    if not options.folder and not options.worker and not options.queue_status:
         parser.print_help()
         exit()
 
@@ -33,6 +70,10 @@ def main():
         scan(GoogleUploader("", ""))
         exit()
 
+    if options.enqueue or options.queue_status:
+        queue(GoogleUploader("", "", options.user_name))
+        exit()
+
     config_file_name = "~/.hmsoft/gphotos.json"
     api_keys = utils.get_api_keys_from_config(config_file_name)
 
@@ -56,14 +97,29 @@ def main():
         exit()
 
     print "Starting upload as user " + str(gup.user_name)
-    options.folder = unicode(options.folder, "UTF-8")
+    gup.incremental = not options.full_scan
+    gup.progress_file = options.progress_file
+    if options.jobs is not None:
+        gup.max_uploads = max(options.jobs, 1)
     gup.original_size = not options.small_size
+    if options.worker:
+        if not options.no_chk_remote:
+            print "Fetching the photos in the autobackup album..."
+            print gup.sync_inventory(options.full_inventory), "new photos found."
+        t = gup.work_queue()
+        print "Done in " + utils.format_time(t)
+        return
 
+    options.folder = unicode(options.folder, "UTF-8")
     if os.path.isfile(options.folder):
         gup.upload_file(options.folder)
         print "Done."
     else:
-        scan(gup)
+        if not options.no_chk_remote:
+            print "Fetching the photos in the autobackup album..."
+            print gup.sync_inventory(options.full_inventory), "new photos found."
+        if not options.stream:
+            scan(gup)
         t = gup.upload_directory(options.folder)
         print "Done in " + utils.format_time(t)
 
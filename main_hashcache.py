@@ -0,0 +1,37 @@
+#!/usr/bin/python
+# coding=UTF8
+
+import argparse
+
+from db import BuffData
+import utils
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Maintain the cache of file digests used to skip re-hashing '
+                                                 'unchanged files.')
+    parser.add_argument('-v', dest='vacuum', action="store_true",
+                        help="Remove the entries of files that no longer exist or changed")
+    parser.add_argument('-i', dest="invalidate", help='Forget the digests of a file or of every file in a folder',
+                        default=None)
+    options = parser.parse_args()
+
+    data = BuffData()
+
+    if options.invalidate:
+        path = unicode(options.invalidate, "UTF-8")
+        print data.invalidate_file_digests(path), "entries removed."
+
+    if options.vacuum:
+        print "Vacuuming hash cache..."
+        print data.vacuum_hash_cache(), "stale entries removed."
+
+    count, size = data.get_hash_cache_stats()
+    print count, "files in hash cache. (" + utils.sizeof_fmt(size) + ")"
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print "Terminated by user."
@@ -4,12 +4,14 @@
 import argparse
 import os
 import subprocess
+import catalog
 import utils
 
 rsync = "rsync"
 rsync_options = "-vrtui --stats --del"
-rsync_exclude = "--exclude=%(primary)s --exclude=%(secondary)s" % \
-                {"primary": utils.primary_backup_marker, "secondary": utils.secondary_backup_marker}
+rsync_exclude = "--exclude=%(primary)s --exclude=%(secondary)s --exclude='/%(catalog)s*'" % \
+                {"primary": utils.primary_backup_marker, "secondary": utils.secondary_backup_marker,
+                 "catalog": catalog.CATALOG_FILE_NAME}
 
 
 def main():
@@ -0,0 +1,130 @@
+"""Manifest of the candidate files found by a folder scan.
+
+The scan appends to it and the upload consumes it, so the folder tree is
+walked only once per run. Iterating a manifest that is still being filled
+blocks until the next entry arrives, which lets the upload start while the
+scan is running.
+
+"""
+
+import json
+import os
+import threading
+
+import utils
+
+
+class Manifest(object):
+    def __init__(self, root=None):
+        self.root = root
+        self.count = 0
+        self.size = 0
+        self.other_count = 0
+        self.other_size = 0
+        self.complete = False
+        self._entries = []
+        self._dirs = {}
+        self._cond = threading.Condition()
+
+    def add(self, path, size):
+        with self._cond:
+            self._entries.append((path, size))
+            self.count += 1
+            self.size += size
+            self._cond.notify_all()
+
+    def add_dir(self, path, mtime_ns, file_count, subdir_names):
+        """Adds a folder after all its files, so the consumer knows when it has been completely processed."""
+        with self._cond:
+            self._entries.append((path, None))
+            self._dirs[path] = (mtime_ns, file_count, subdir_names)
+            self._cond.notify_all()
+
+    def dir_info(self, path):
+        """Returns (mtime_ns, file_count, subdir_names) of a folder added with add_dir()."""
+        return self._dirs[path]
+
+    def is_current(self, unchanged=None):
+        """True if no folder of the scan changed since, checked with a stat of every folder instead of listing them.
+
+        The folders the scan skipped because they had not changed are checked with unchanged(dir_name, stat), the
+        callable given to dirwalker.walk(), if there is none they count as changed.
+        """
+        stack = [self.root]
+        while stack:
+            dir_name = stack.pop()
+            try:
+                st = os.stat(dir_name)
+            except OSError:
+                return False
+
+            info = self._dirs.get(dir_name)
+            if info is not None:
+                if info[0] != utils.stat_mtime_ns(st):
+                    return False
+                stack.extend(os.path.join(dir_name, name) for name in info[2])
+            else:
+                subdirs = unchanged(dir_name, st) if unchanged is not None else None
+                if subdirs is None:
+                    return False
+                stack.extend(subdirs)
+        return True
+
+    def add_other(self, size):
+        with self._cond:
+            self.other_count += 1
+            self.other_size += size
+
+    def close(self):
+        with self._cond:
+            self.complete = True
+            self._cond.notify_all()
+
+    def wait(self):
+        with self._cond:
+            while not self.complete:
+                self._cond.wait(1.0)
+
+    def __iter__(self):
+        """Yields (path, size) tuples, waiting for the scan if it has not finished yet.
+
+        Folders added with add_dir() are yielded with a size of None.
+        """
+        i = 0
+        while True:
+            with self._cond:
+                while i >= len(self._entries) and not self.complete:
+                    self._cond.wait(1.0)
+                if i >= len(self._entries):
+                    return
+                entry = self._entries[i]
+            yield entry
+            i += 1
+
+    def save(self, file_name):
+        self.wait()
+        with open(file_name, "w") as f:
+            f.write(json.dumps({"root": self.root, "other_count": self.other_count,
+                                "other_size": self.other_size}) + "\n")
+            for path, size in self._entries:
+                if size is None:
+                    f.write(json.dumps([path, None] + list(self._dirs[path])) + "\n")
+                else:
+                    f.write(json.dumps([path, size]) + "\n")
+
+    @classmethod
+    def load(cls, file_name):
+        with open(file_name) as f:
+            header = json.loads(f.readline())
+            manifest = cls(header["root"])
+            for line in f:
+                record = json.loads(line)
+                if record[1] is None:
+                    manifest.add_dir(record[0], *record[2:])
+                else:
+                    manifest.add(*record)
+
+        manifest.other_count = header["other_count"]
+        manifest.other_size = header["other_size"]
+        manifest.close()
+        return manifest
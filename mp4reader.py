@@ -0,0 +1,121 @@
+"""Creation date reader for ISO base media files (MP4, MOV, 3GP, ...).
+
+Jumps from box header to box header down to moov/mvhd (or moov/trak/tkhd)
+and reads only the creation time, the media data is never read.
+
+"""
+
+import datetime
+import os
+import struct
+
+VIDEO_EXTENSIONS = [".mp4", ".m4v", ".mov", ".3gp", ".3gpp", ".lrv"]
+
+# Seconds between 1904-01-01 (ISO base media epoch) and 1970-01-01
+_EPOCH_OFFSET = 2082844800
+_MAX_BOXES = 1024
+
+
+def is_iso_media(file_name):
+    fname, fext = os.path.splitext(file_name)
+    return fext.lower() in VIDEO_EXTENSIONS
+
+
+def _boxes(f, start, end):
+    """Yields (type, data_start, box_end) of every box between start and end without reading their data."""
+    pos = start
+    for i in range(_MAX_BOXES):
+        if pos + 8 > end:
+            return
+
+        f.seek(pos)
+        header = f.read(8)
+        if len(header) < 8:
+            return
+
+        size, kind = struct.unpack(">I4s", header)
+        header_len = 8
+        if size == 1:
+            large_size = f.read(8)
+            if len(large_size) < 8:
+                return
+            size = struct.unpack(">Q", large_size)[0]
+            header_len = 16
+        elif size == 0:
+            size = end - pos
+
+        if size < header_len:
+            return
+
+        yield kind, pos + header_len, min(pos + size, end)
+        pos += size
+
+
+def _find_box(f, start, end, kind):
+    for box_kind, data_start, box_end in _boxes(f, start, end):
+        if box_kind == kind:
+            return data_start, box_end
+    return None
+
+
+def _read_creation_time(f, start, end):
+    """Reads the creation time of a mvhd or tkhd box, both start with version, flags and creation time."""
+    f.seek(start)
+    version = f.read(4)
+    if len(version) < 4:
+        return 0
+
+    if ord(version[0:1]) == 1:
+        data = f.read(8)
+        fmt = ">Q"
+    else:
+        data = f.read(4)
+        fmt = ">I"
+
+    if len(data) != struct.calcsize(fmt) or start + 4 + len(data) > end:
+        return 0
+    return struct.unpack(fmt, data)[0]
+
+
+def _to_datetime(creation_time):
+    timestamp = creation_time - _EPOCH_OFFSET
+    if timestamp <= 0:
+        return None
+
+    try:
+        date = datetime.datetime.fromtimestamp(timestamp)
+    except (ValueError, OverflowError):
+        return None
+
+    if date > datetime.datetime.now() + datetime.timedelta(days=1):
+        return None
+    return date
+
+
+def read_creation_date(file_name):
+    """Returns the creation date stored in the movie header as local time, None if there is none."""
+    try:
+        with open(file_name, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            moov = _find_box(f, 0, size, b"moov")
+            if moov is None:
+                return None
+
+            mvhd = _find_box(f, moov[0], moov[1], b"mvhd")
+            if mvhd is not None:
+                date = _to_datetime(_read_creation_time(f, *mvhd))
+                if date is not None:
+                    return date
+
+            for kind, data_start, box_end in _boxes(f, moov[0], moov[1]):
+                if kind != b"trak":
+                    continue
+                tkhd = _find_box(f, data_start, box_end, b"tkhd")
+                if tkhd is not None:
+                    date = _to_datetime(_read_creation_time(f, *tkhd))
+                    if date is not None:
+                        return date
+    except (IOError, struct.error):
+        pass
+
+    return None
@@ -1,13 +1,56 @@
+"""Provides a client to interact with Google Picasa Web API v2.
+
+Not all operations are implemented at this time.
+
+"""
+
+import httplib
 import os
+import socket
 import atom.http_core
 import gdata.client
 import gdata.photos
 
-"""Provides a client to interact with Google Picasa Web API v2.
+import httppool
 
-Not all operations are implemented at this time.
 
-"""
+class PooledHttpClient(atom.http_core.HttpClient):
+    """atom HttpClient sending the requests through a keep-alive httppool.ConnectionPool."""
+
+    def __init__(self, pool=None):
+        self._pool = pool or httppool.get_pool()
+
+    def _http_request(self, method, uri, headers=None, body_parts=None):
+        if isinstance(uri, (str, unicode)):
+            uri = atom.http_core.Uri.parse_uri(uri)
+
+        while True:
+            key, connection, reused = self._pool.acquire(uri.scheme, uri.host, int(uri.port) if uri.port else None)
+            try:
+                if self.debug:
+                    connection.debuglevel = 1
+                connection.putrequest(method, uri._get_relative_path())
+                for header_name, value in (headers or {}).iteritems():
+                    connection.putheader(header_name, value)
+                connection.endheaders()
+
+                if body_parts and filter(lambda x: x != '', body_parts):
+                    for part in body_parts:
+                        atom.http_core._send_data_part(part, connection)
+
+                response = connection.getresponse()
+            except (socket.error, httplib.HTTPException):
+                connection.close()
+                self._pool.release(key, None)
+                # A kept alive connection dropped by the server, sent again unless a file part was consumed.
+                if reused and all(isinstance(part, basestring) for part in body_parts or []):
+                    continue
+                raise
+            except:
+                connection.close()
+                self._pool.release(key, None)
+                raise
+            return httppool.PooledResponse(self._pool, key, connection, response)
 
 
 class PicasaClient(gdata.client.GDClient):
@@ -25,6 +68,7 @@ class PicasaClient(gdata.client.GDClient):
           kwargs: The other parameters to pass to the gdata.client.GDClient
               constructor.
         """
+        kwargs.setdefault("http_client", PooledHttpClient())
         gdata.client.GDClient.__init__(self, auth_token=auth_token, **kwargs)
         self.domain = domain
 
@@ -40,8 +84,44 @@ class PicasaClient(gdata.client.GDClient):
         return self.get_feed(uri, auth_token=None,
                              converter=converter, **kwargs)
 
+    def GetAlbumPhotos(self, album_uri, start_index=1, max_results=1000, updated_min=None, **kwargs):
+        """Returns a page of the photo entries of an album, updated_min is an RFC 3339 date."""
+        def converter(response):
+            body = response.read()
+            return gdata.photos.AnyFeedFromString(body)
+
+        uri = '%s://%s%s?kind=photo&start-index=%d&max-results=%d' % (self.scheme, self.server, album_uri,
+                                                                      start_index, max_results)
+        if updated_min is not None:
+            uri += '&updated-min=' + updated_min
+        return self.get_feed(uri, auth_token=None, converter=converter, **kwargs)
+
+    def InsertPhotoResumable(self, album_uri, title, summary, upload, content_type='video/mp4', checksum=None):
+        """Sends a photo or video with the resumable upload protocol, upload is a resumable.ResumableUpload.
+
+        checksum is stored with the photo and listed back in gphoto:checksum.
+        """
+        if album_uri.startswith('/data/feed/'):
+            album_uri = '/data/upload/resumable/' + album_uri[len('/data/'):]
+        uri = '%s://%s%s' % (self.scheme, self.server, album_uri)
+
+        metadata = gdata.photos.PhotoEntry()
+        metadata.title = atom.Title(text=title)
+        metadata.summary = atom.Summary(text=summary, summary_type='text')
+        if checksum is not None:
+            metadata.checksum = gdata.photos.Checksum(text=checksum)
+
+        http_request = atom.http_core.HttpRequest()
+        http_request.headers['GData-Version'] = self.api_version
+        http_request.headers['Slug'] = title
+        if self.auth_token is not None:
+            self.auth_token.modify_request(http_request)
+
+        body = upload.upload(uri, str(metadata), 'application/atom+xml', content_type, http_request.headers)
+        return gdata.photos.AnyEntryFromString(body)
+
     def InsertPhotoSimple(self, album_uri, title, summary, fileobj,
-                          content_type='image/jpeg', keywords=None):
+                          content_type='image/jpeg', keywords=None, checksum=None):
         http_request = atom.http_core.HttpRequest()
 
         size = 0
@@ -64,6 +144,8 @@ class PicasaClient(gdata.client.GDClient):
             if isinstance(keywords, list):
                 keywords = ','.join(keywords)
             metadata.media.keywords = gdata.media.Keywords(text=keywords)
+        if checksum is not None:
+            metadata.checksum = gdata.photos.Checksum(text=checksum)
 
         http_request.add_body_part(str(metadata), "application/atom+xml")
         http_request.add_body_part(fileobj, content_type, size)
@@ -1,11 +1,12 @@
-import os
 import pyexiv2
 import urllib
 import urllib2
 import time
-import sys
 
 import db
+import fileinfo
+import dirwalker
+from dirindex import DirIndex
 import utils
 
 
@@ -48,6 +49,10 @@ def set_gps_location(file_name, lat, lng, overwrite=False, address=None):
     lng -- longitude (as float)
 
     """
+    if not overwrite and fileinfo.get_file_info(file_name).gps_position is not None:
+        print file_name, "-> Already tagged"
+        return GeotagStatus.already_tagged
+
     exiv_image = pyexiv2.ImageMetadata(file_name)
     exiv_image.read()
 
@@ -78,6 +83,7 @@ def set_gps_location(file_name, lat, lng, overwrite=False, address=None):
     exiv_image["Exif.GPSInfo.GPSVersionID"] = '2 0 0 0'
 
     exiv_image.write(True)
+    fileinfo.invalidate(file_name)
 
     print file_name, "-> Tagged!", "(overwrited)" if overwrite and has_geotag else "",
     if address:
@@ -97,6 +103,7 @@ class PicGotagger:
         self._db = None
         self._time_range = time_range
         self._overwrite = overwrite
+        self.incremental = not overwrite
 
     def _init_db(self):
         if self._db is None:
@@ -123,7 +130,7 @@ class PicGotagger:
 
     def geotag_picture(self, picture_path):
         try:
-            pic_date = utils.get_picture_date(picture_path)
+            pic_date = fileinfo.get_file_info(picture_path).date
             if pic_date is None:
                 print picture_path, "-> No date found"
                 return GeotagStatus.failed
@@ -143,21 +150,22 @@ class PicGotagger:
             return GeotagStatus.failed
 
     def _geotag_pictures(self, folder_path):
-        try:
-            dir_list = os.listdir(folder_path)
-        except OSError as e:
-            sys.stderr.write(str(e) + "\n")
-            return
-
-        for filename in dir_list:
-            src_file = os.path.join(folder_path, filename)
-            if os.path.isdir(src_file):
-                self._geotag_pictures(src_file)
+        dir_index = None
+        unchanged = None
+        if self.incremental:
+            self._init_db()
+            dir_index = DirIndex(self._db, "geotag")
+            unchanged = dir_index.unchanged
+
+        failed_dirs = set()
+        for entry in dirwalker.walk(folder_path, utils.PICTURE_EXTENSIONS, yield_dirs=True, unchanged=unchanged):
+            if entry.is_dir:
+                if dir_index is not None and entry.path not in failed_dirs:
+                    # Writing the tags may replace the files, so the folder mtime is taken after processing it.
+                    dir_index.mark_entry(entry, True)
                 continue
 
-            if not os.path.isfile(src_file) or not utils.is_picture(src_file):
-                continue
-            
+            src_file = entry.path
             result = self.geotag_picture(src_file)
             if result == GeotagStatus.tagged:
                 self._tagged_count += 1
@@ -165,6 +173,7 @@ class PicGotagger:
                 self._already_tagged_count += 1
             elif result == GeotagStatus.failed:
                 self._failed_count += 1
+                failed_dirs.add(entry.dir_name)
 
     def geotag_pictures(self, folder_path):
         self._failed_count = 0
@@ -1,10 +1,36 @@
 # coding=UTF8
 
+import errno
+import itertools
+import multiprocessing
 import os
 import shutil
 import pyexiv2
 import time
+import archiveplan
+import contentindex
+import dirwalker
+import exifinject
+import fastcopy
+import fileinfo
 import utils
+from db import BuffData
+from dirindex import DirIndex
+
+
+BACKUP_FILE_EXTS = ["." + ext for ext in utils.MIME_TYPES.keys()]
+
+# Files of a folder corrected in one correct_dates task, bigger folders are split among several workers.
+CORRECT_DATES_SHARD_SIZE = 256
+
+
+class CopyResult(object):
+    """md5sum of the data written in verify mode, exif_written if the missing EXIF dates were set while copying."""
+    __slots__ = ("md5sum", "exif_written")
+
+    def __init__(self, md5sum, exif_written=False):
+        self.md5sum = md5sum
+        self.exif_written = exif_written
 
 
 # noinspection PyBroadException
@@ -18,13 +44,27 @@ class PictureArchiver:
         self._move_files = False
         self._diagnostics = False
         self._imgCount = 0
+        self._imgSize = 0
         self._currImgIndex = 0
+        self._doneImgCount = 0
+        self._doneImgSize = 0
         self._success_count = 0
         self._currImgFileName = None
         self._correct_dates_only = False
         self._start_size = 0
+        self._backup_file_exts = BACKUP_FILE_EXTS
+        self._verify = False
+        self._data = None
+        self._dedup = None
+        self._content_index = None
+        self._catalog = None
+        self._resume = True
+        self._plan = None
+        self._planned_files = None
 
         self.onAdvance = None
+        # progress.Progress the log is written through
+        self.progress = None
 
     def _do_advance(self):
         try:
@@ -33,20 +73,36 @@ class PictureArchiver:
         except Exception:
             pass
 
+    def _print(self, text):
+        if self.progress is not None:
+            self.progress.note(text)
+        else:
+            print text
+
     def _log(self, text):
         if self._verbose:
-            print text
+            self._print(text)
 
     def _debug(self, text):
         if self._debug:
-            print text
+            self._print(text)
 
     def _error(self, msg):
-        print "ERROR:", msg
+        if self.progress is not None:
+            self.progress.note(u"ERROR: " + unicode(msg))
+        else:
+            print "ERROR:", msg
 
-    def _correct_exif_date(self, filename, date):
+    def get_progress(self):
+        """Returns (files done, files, bytes done, bytes) of the plan being executed."""
+        return self._doneImgCount, self._imgCount, self._doneImgSize, self._imgSize
+
+    def _correct_exif_date(self, filename, date, info=None):
+        """Sets the missing EXIF date tags, returns True if the file was modified."""
         if not utils.is_picture(filename):
-            return
+            return False
+        if info is not None and info.has_exif_dates:
+            return False
         try:
             exif_data = pyexiv2.ImageMetadata(filename)
             need_write = False
@@ -66,8 +122,10 @@ class PictureArchiver:
 
             if need_write:
                 exif_data.write(True)
+            return need_write
         except Exception as e:
             self._error(e)
+        return False
 
     def _is_valid_backup_file(self, file_name):
         fname, fext = os.path.splitext(file_name)
@@ -83,135 +141,534 @@ class PictureArchiver:
         else:
             return ""
 
-    def _correct_picture_date(self, picture_path, datetime):
-        self._correct_exif_date(picture_path, datetime)
+    def _correct_picture_date(self, picture_path, datetime, info=None, correct_exif=True):
+        """Sets the missing EXIF dates and the file time, info is the FileInfo of the file (or its source).
+
+        Returns True if the file content was modified.
+        """
+        modified = correct_exif and self._correct_exif_date(picture_path, datetime, info)
+        fileinfo.invalidate(picture_path)
 
         filetime = time.mktime(datetime.timetuple())
         os.utime(picture_path, (filetime, filetime))
 
         self._debug("Corrected: " + picture_path)
+        return modified
+
+    def _correct_file_date(self, path):
+        """Corrects the dates of a file in place, returns False if they were already correct and nothing was written."""
+        info = fileinfo.get_file_info(path)
+        date = info.date
+        exif_correct = not utils.is_picture(path) or info.has_exif_dates
+        if exif_correct and int(info.stat().st_mtime) == int(time.mktime(date.timetuple())):
+            return False
+
+        self._correct_picture_date(path, date, info)
+        return True
+
+    def _walk_dir_correct_date(self, root_dir, dir_index=None, jobs=1):
+        unchanged = dir_index.unchanged if dir_index is not None else None
+        dir_entries = {}
+        remaining = {}
+
+        def list_shards():
+            names = {}
+            for entry in dirwalker.walk(root_dir, yield_dirs=True, unchanged=unchanged):
+                if not entry.is_dir:
+                    names.setdefault(entry.dir_name, []).append(entry.name)
+                    continue
 
-    def _walk_dir_correct_date(self, root_dir):
-        dir_list = os.listdir(root_dir)
-        for filename in dir_list:
-            src_file = os.path.join(root_dir, filename)
-
-            if os.path.isdir(src_file):
-                self._walk_dir_correct_date(src_file)
-                continue
-
-            if os.path.isfile(src_file):
-                picture_date = utils.get_picture_date(src_file)
-                self._correct_picture_date(src_file, picture_date)
-
-    def _walk_dir(self, root_dir):
-        dir_list = os.listdir(root_dir)
-        self._imgCount += len(dir_list)
-
-        files_left = len(dir_list)
-        for filename in dir_list:
-            self._currImgIndex += 1
-            self._currImgFileName = filename
-            self._do_advance()
+                # Folders without files are sent too, they are marked when their (empty) shard comes back.
+                file_names = names.pop(entry.path, [])
+                dir_shards = [file_names[i:i + CORRECT_DATES_SHARD_SIZE]
+                              for i in range(0, len(file_names), CORRECT_DATES_SHARD_SIZE)] or [[]]
+                dir_entries[entry.path] = entry
+                remaining[entry.path] = len(dir_shards)
+                for shard in dir_shards:
+                    yield entry.path, shard
+
+        pool = None
+        if jobs > 1:
+            # Listed up front, the pool consumes the tasks from another thread and the index can't be read there.
+            shards = list(list_shards())
+            pool = multiprocessing.Pool(jobs)
+            results = pool.imap_unordered(_correct_dates_shard, shards)
+        else:
+            results = itertools.imap(_correct_dates_shard, list_shards())
 
-            src_file = os.path.join(root_dir, filename)
+        start = time.time()
+        workers = {}
+        failed = set()
+        try:
+            for dir_name, count, corrected, errors, seconds, pid in results:
+                worker = workers.setdefault(pid, [0, 0, 0.0])
+                worker[0] += count
+                worker[1] += corrected
+                worker[2] += seconds
+                if errors:
+                    failed.add(dir_name)
+
+                remaining[dir_name] -= 1
+                if remaining[dir_name] > 0:
+                    continue
+                del remaining[dir_name]
+                entry = dir_entries.pop(dir_name)
+                # A folder with errors is left unmarked to be retried in the next pass.
+                if dir_index is not None and dir_name not in failed:
+                    dir_index.mark_entry(entry, True)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        self._log_correct_dates(workers, time.time() - start)
+
+    def _log_correct_dates(self, workers, elapsed):
+        count = sum(worker[0] for worker in workers.values())
+        corrected = sum(worker[1] for worker in workers.values())
+        self._log(str(count) + " files checked, " + str(corrected) + " corrected in " + utils.format_time(elapsed) +
+                  " (" + str(int(count / elapsed if elapsed > 0 else 0)) + " files/s)")
+        for pid in sorted(workers):
+            count, corrected, seconds = workers[pid]
+            self._log("    Worker " + str(pid) + ": " + str(count) + " files, " + str(corrected) + " corrected, " +
+                      str(int(count / seconds if seconds > 0 else 0)) + " files/s")
+
+    def _skip_file(self, entry, reason):
+        if reason == dirwalker.SKIP_TYPE:
+            message = "SKIPING: '" + entry.path + "' is not a picture or video"
+        else:
+            message = "SKIPING: " + entry.path + " is not larger than " + utils.sizeof_fmt(self._start_size) + \
+                      " bytes (" + utils.sizeof_fmt(entry.size) + ")"
+        self._plan_skip(entry.path, message)
 
-            if os.path.isdir(src_file):
-                self._walk_dir(src_file)
-                continue
+    def _plan_skip(self, src_file, message):
+        self._log(message)
+        return self._plan.add(archiveplan.SKIP, src_file, note=message)
 
-            if not os.path.isfile(src_file):
+    def _remove_dir(self, dir_name):
+        try:
+            if not self._diagnostics:
+                os.rmdir(dir_name)
+        except OSError as e:
+            # Folders with files left, not moved or not archived, are kept.
+            if e.errno not in (errno.ENOTEMPTY, errno.EEXIST, errno.ENOENT):
+                self._error("Error removing dir")
+
+    def _plan_file(self, entry, known_dirs, dest_device):
+        """Decides what to do with a single file, adds it to the plan and returns its operation.
+
+        known_dirs are the destination folders already checked, existing or planned to be created.
+        """
+        plan = self._plan
+        src_file = entry.path
+        filename = entry.name
+
+        info = fileinfo.get_file_info(src_file, entry.stat())
+        picture_date = info.date
+        if picture_date is None:
+            return self._plan_skip(src_file, "SKIPING: '" + src_file + "' Couldn't determine file date")
+
+        dest_folder_name = self._get_dest_folder_name(picture_date)
+
+        dest_folder = os.path.join(self._destPath, dest_folder_name)
+        dest_file = os.path.join(dest_folder, filename)
+        move = self._move_files or src_file.startswith(u"/home/hm/Imágenes/Camara")
+
+        if self._catalog is not None:
+            cataloged = self._catalog.get(dest_file)
+            dest_exists = cataloged is not None
+            same_file = dest_exists and os.path.abspath(src_file) == os.path.abspath(dest_file)
+        else:
+            dest_exists = os.path.isfile(dest_file)
+            same_file = dest_exists and os.path.samefile(src_file, dest_file)
+
+        if same_file:
+            return self._plan_skip(src_file, "SKIPING: '" + dest_file + "' Source and destination are the same.")
+
+        src_size = entry.size
+        if dest_file in self._planned_files:
+            # Another source file with the same name and date, the disk does not have it yet.
+            dest_exists = True
+            dest_size = self._planned_files[dest_file]
+        elif dest_exists:
+            dest_size = cataloged[0] if self._catalog is not None else os.path.getsize(dest_file)
+        if dest_exists and (dest_size >= src_size or move):
+            # A move never replaces an archived file, the source would be lost.
+            return self._plan_skip(src_file, "SKIPING: '" + dest_file + "' already exists.")
+        self._planned_files[dest_file] = src_size
+
+        if self._content_index is not None:
+            duplicate = self._content_index.find(src_file, entry.stat())
+            if duplicate is not None:
+                if self._dedup != contentindex.LINK or os.path.lexists(dest_file):
+                    return self._plan_skip(src_file, "SKIPING: '" + src_file + "' already archived as '" +
+                                           duplicate + "'")
+                return plan.add(archiveplan.LINK, src_file, dest_file, note=duplicate)
+
+        if dest_folder not in known_dirs:
+            known_dirs.add(dest_folder)
+            if not (self._catalog.has_dir(dest_folder) if self._catalog is not None else os.path.isdir(dest_folder)):
+                plan.add(archiveplan.MKDIR, dest=dest_folder)
+
+        if move:
+            note = archiveplan.RENAME if entry.stat().st_dev == dest_device else None
+            return plan.add(archiveplan.MOVE, src_file, dest_file, src_size, picture_date, note)
+        # Only a smaller file is replaced, the copy of any other file that turns out to exist fails.
+        return plan.add(archiveplan.COPY, src_file, dest_file, src_size, picture_date,
+                        archiveplan.REPLACE if dest_exists else None)
+
+    def _build_plan(self):
+        self._plan = archiveplan.ArchivePlan(self._srcPath, self._destPath, self._move_files)
+        # The nearest existing folder tells the device, the destination may not exist yet.
+        dest_device = None
+        dest_path = os.path.abspath(self._destPath)
+        while dest_device is None:
+            try:
+                dest_device = os.stat(dest_path).st_dev
+            except OSError:
+                if dest_path == os.path.dirname(dest_path):
+                    break
+                dest_path = os.path.dirname(dest_path)
+
+        self._planned_files = {}
+        known_dirs = set()
+        moved_from = set()
+        for entry in dirwalker.walk(self._srcPath, self._backup_file_exts, self._start_size, self._skip_file):
+            try:
+                operation = self._plan_file(entry, known_dirs, dest_device)
+            except Exception as exp:
+                self._error(exp)
+                self._plan.add(archiveplan.SKIP, entry.path, note=str(exp))
                 continue
 
-            if not self._is_valid_backup_file(src_file):
-                self._log("SKIPING: '" + src_file + "' is not a picture or video")
+            if operation.op == archiveplan.MOVE:
+                moved_from.add(entry.dir_name)
+        self._planned_files = None
+
+        # The folders files are moved from, and their parents, are removed if they end up empty. Deepest first, so
+        # a folder is tried after all its sub folders.
+        prune = set()
+        for dir_name in moved_from:
+            while dir_name not in prune:
+                prune.add(dir_name)
+                if os.path.normpath(dir_name) == os.path.normpath(self._srcPath):
+                    break
+                dir_name = os.path.dirname(dir_name)
+        for dir_name in sorted(prune, key=lambda d: (-d.count(os.sep), d)):
+            self._plan.add(archiveplan.RMDIR, dir_name)
+
+    def _execute_operation(self, operation):
+        op = operation.op
+        if op == archiveplan.MKDIR:
+            self._log("CREATING: Folder '" + operation.dest + "'")
+            if not self._diagnostics:
+                utils.makedirs(operation.dest)
+            self._plan.set_state(operation, archiveplan.DONE)
+        elif op == archiveplan.RMDIR:
+            self._remove_dir(operation.src)
+            self._plan.set_state(operation, archiveplan.DONE)
+        elif op == archiveplan.LINK:
+            self._link_duplicate(operation.dest, operation.note)
+            self._plan.set_state(operation, archiveplan.DONE)
+        elif op in (archiveplan.COPY, archiveplan.MOVE):
+            # Marked when the file is finished.
+            self._archive_file(operation)
+
+    def _execute_operations(self, operations):
+        for operation in operations:
+            if operation.state != archiveplan.PENDING:
                 continue
+            try:
+                self._execute_operation(operation)
+            except Exception as exp:
+                self._error(exp)
+                self._plan.set_state(operation, archiveplan.FAILED)
 
-            if self._start_size > 0:
-                fs = os.path.getsize(src_file)
-                if self._start_size > fs:
-                    self._log("SKIPING: " + src_file + " is not larger than " + utils.sizeof_fmt(self._start_size) + " bytes (" +
-                              utils.sizeof_fmt(fs) + ")")
-                    continue
+    def _execute_plan(self):
+        # All the destination folders are created first and the emptied source folders removed in a final sweep.
+        self._execute_operations(op for op in self._plan.operations if op.op == archiveplan.MKDIR)
 
-            picture_date = utils.get_picture_date(src_file)
-            if picture_date is None:
-                self._log("SKIPING: '" + src_file + "' Couldn't determine file date")
+        copied = 0
+        stt = time.time()
+        for operation in self._plan.operations:
+            if operation.op in (archiveplan.MKDIR, archiveplan.RMDIR):
+                continue
+            if operation.op in archiveplan.FILE_OPERATIONS:
+                self._currImgIndex += 1
+                self._currImgFileName = os.path.basename(operation.src)
+                self._do_advance()
+                self._doneImgCount += 1
+                self._doneImgSize += operation.size or 0
+
+            if operation.state != archiveplan.PENDING:
                 continue
-
-            dest_folder_name = self._get_dest_folder_name(picture_date)
-
-            dest_folder = os.path.join(self._destPath, dest_folder_name)
-            dest_file = os.path.join(dest_folder, filename)
-            move = self._move_files or src_file.startswith(u"/home/hm/Imágenes/Camara")
 
             try:
-                if os.path.isfile(dest_file) and os.path.samefile(src_file, dest_file):
-                    self._log("SKIPING: '" + dest_file + "' Source and destination are the same.")
-                    continue
-
-                src_size = os.path.getsize(src_file)
-                if os.path.isfile(dest_file):
-                    dest_size = os.path.getsize(dest_file)
-                    if dest_size >= src_size:
-                        self._log("SKIPING: '" + dest_file + "' already exists.")
-                        continue
-
-                if not os.path.isdir(dest_folder):
-                    self._log("CREATING: Folder '" + dest_folder + "'")
-                    if not self._diagnostics:
-                        os.makedirs(dest_folder)
-
-                if move:
-                    self._log("MOVING: '" + src_file + "' to '" + dest_file + "'")
-                    if not self._diagnostics:
-                        shutil.move(src_file, dest_folder)
-
-                    files_left -= 1
-                    if files_left == 0:
-                        try:
-                            if not self._diagnostics:
-                                os.rmdir(root_dir)
-                        except:
-                            self._error("Error removing dir")
+                self._execute_operation(operation)
+            except Exception as exp:
+                self._error(exp)
+                self._plan.set_state(operation, archiveplan.FAILED)
+                continue
 
+            if operation.op == archiveplan.COPY or \
+                    (operation.op == archiveplan.MOVE and operation.note != archiveplan.RENAME):
+                copied += operation.size
+
+        self._do_advance()
+        if not self._diagnostics:
+            archiveplan.record_copy_rate(copied, time.time() - stt)
+
+        self._execute_operations(op for op in self._plan.operations if op.op == archiveplan.RMDIR)
+
+    def _archive_file(self, operation):
+        """Copies or moves a single file to its date folder."""
+        src_file = operation.src
+        dest_file = operation.dest
+        src_size = operation.size
+        move = operation.op == archiveplan.MOVE
+        copy_result = None
+
+        if move:
+            if not os.path.lexists(src_file) and os.path.isfile(dest_file):
+                # Already moved when the previous run was interrupted.
+                self._log("MOVED: '" + src_file + "' to '" + dest_file + "'")
+            elif os.path.lexists(dest_file):
+                # The catalog or the scan missed it, a rename would replace it.
+                raise OSError(errno.EEXIST, "Not moving over an existing file", dest_file)
+            else:
+                self._log("MOVING: '" + src_file + "' to '" + dest_file + "'")
+                if not self._diagnostics:
+                    self._move_file(src_file, dest_file, operation.note == archiveplan.RENAME)
+            info = fileinfo.get_file_info(dest_file)
+        else:
+            self._log("COPING: '" + src_file + "' to '" + dest_file + "'")
+            info = fileinfo.get_file_info(src_file)
+            if not self._diagnostics:
+                header = self._exif_header(src_file, operation.date, info)
+                if header is not None:
+                    src_size += len(header.data) - header.skip
+                if self._copied_before(dest_file, src_size, operation):
+                    self._log("COPIED: '" + src_file + "' to '" + dest_file + "'")
+                    copy_result = CopyResult(None, header is not None)
                 else:
-                    self._log("COPING: '" + src_file + "' to '" + dest_file + "'")
-                    if not self._diagnostics:
-                        shutil.copy(src_file, dest_folder)
+                    copy_result = self._copy_file(src_file, dest_file, header,
+                                                  operation.note == archiveplan.REPLACE)
 
-                success = (not move or not os.path.isfile(src_file)) and os.path.isfile(dest_file) and src_size == os.path.getsize(dest_file)
-                if success:
-                    if not self._diagnostics:
-                        self._correct_picture_date(dest_file, picture_date)
+        self._finish_file(src_file, dest_file, src_size, operation.date, info, move, copy_result, operation)
 
-                    self._success_count += 1
+    def _copied_before(self, dest_file, size, operation):
+        """True if the interrupted run of a resumed plan already copied dest_file.
 
-            except Exception as exp:
-                self._error(exp)
-                continue
+        A smaller file written since the plan was made is the partial copy that run left, it is removed. Any other
+        file is left to the copy, which fails instead of replacing it unless the plan meant to. A copy that failed
+        removed what it wrote, a file there when it is retried is not its own.
+        """
+        if not self._plan.resumed or operation.seq in self._plan.retried:
+            return False
+        try:
+            st = os.stat(dest_file)
+        except OSError:
+            return False
+
+        if st.st_size == size:
+            return True
+        if operation.note != archiveplan.REPLACE and self._plan.created is not None and \
+                st.st_mtime >= self._plan.created:
+            os.remove(dest_file)
+        return False
+
+    def _move_file(self, src_file, dest_file, rename):
+        if rename:
+            try:
+                os.rename(src_file, dest_file)
+                return
+            except OSError as e:
+                # Another file system mounted inside the source or the destination.
+                if e.errno != errno.EXDEV:
+                    raise
+        shutil.move(src_file, dest_file)
+
+    def _link_duplicate(self, dest_file, duplicate):
+        """Hard links a file already in the archive under another name or date into its date folder."""
+        if os.path.lexists(dest_file):
+            # Linked when the previous run was interrupted.
+            return
+
+        self._log("LINKING: '" + dest_file + "' to '" + duplicate + "'")
+        if not self._diagnostics:
+            utils.makedirs(os.path.dirname(dest_file))
+            os.link(duplicate, dest_file)
+            if self._catalog is not None:
+                self._catalog.add(dest_file)
+        self._success_count += 1
+
+    def _get_data(self):
+        # Created on first use, so it belongs to the thread that finishes the files.
+        if self._data is None:
+            self._data = BuffData()
+        return self._data
+
+    def _exif_header(self, src_file, picture_date, info):
+        """Returns the exifinject.ExifHeader to copy src_file with its missing EXIF dates set, None if not needed."""
+        if not utils.is_picture(src_file) or info.exif_tags is None or info.has_exif_dates:
+            return None
+        return exifinject.build_header(src_file, picture_date, info.exif_tags)
+
+    def _copy_file(self, src_file, dest_file, header=None, replace=False):
+        """Copies src_file to dest_file writing header in place of the start of the source if given.
+
+        dest_file is only overwritten if replace is set, otherwise the copy fails if it exists.
+
+        Returns a CopyResult, with the md5sum of the data written in verify mode. The copy is synced to the disk
+        then, reading it back would most likely be served from the page cache and prove nothing.
+        """
+        prefix, skip = (header.data, header.skip) if header is not None else (None, 0)
+        md5sum = None
+        if self._verify:
+            md5sum = fastcopy.copy_file_hashed(src_file, dest_file, prefix=prefix, skip=skip, sync=True,
+                                               replace=replace)["md5"]
+        else:
+            fastcopy.copy_file(src_file, dest_file, prefix=prefix, skip=skip, replace=replace)
+        return CopyResult(md5sum, header is not None)
+
+    def _finish_file(self, src_file, dest_file, src_size, picture_date, info, move, copy_result=None, operation=None):
+        """Checks the copied or moved file and corrects its date, src_size is the size the destination must have.
+
+        operation is marked in the plan as done or failed.
+        """
+        success = (not move or not os.path.isfile(src_file)) and os.path.isfile(dest_file) and src_size == os.path.getsize(dest_file)
+        md5sum = copy_result.md5sum if copy_result is not None else None
+
+        if success:
+            if not self._diagnostics:
+                correct_exif = copy_result is None or not copy_result.exif_written
+                self._correct_picture_date(dest_file, picture_date, info, correct_exif)
+                if md5sum is not None:
+                    # The digest and size of the data the copy wrote, before pyexiv2 set the dates if it had to.
+                    self._get_data().set_file_archived(os.path.abspath(dest_file), md5sum, src_size, picture_date)
+                if self._content_index is not None:
+                    self._content_index.add(dest_file)
+                if self._catalog is not None:
+                    self._catalog.add(dest_file)
+
+            self._success_count += 1
+
+        if operation is not None:
+            self._plan.set_state(operation, archiveplan.DONE if success else archiveplan.FAILED)
 
     def archive_pictures(self):
         self._imgCount = 0
+        self._imgSize = 0
         self._currImgIndex = 0
+        self._doneImgCount = 0
+        self._doneImgSize = 0
         self._success_count = 0
-        self._walk_dir(self._srcPath)
 
-        self._log(str(self._success_count) + " of " + str(self._currImgIndex) + " files copied.")
+        self._plan = None
+        if not self._diagnostics:
+            if self._resume:
+                self._plan = archiveplan.ArchivePlan.load_open(self._srcPath, self._destPath, self._move_files)
+                if self._plan is not None and not self._plan.matches_source():
+                    self._log("The source changed since the interrupted run, scanning it again.")
+                    self._plan = None
+            if self._plan is None:
+                archiveplan.ArchivePlan.discard(self._srcPath, self._destPath, self._move_files)
+
+        if self._plan is not None:
+            self._log("RESUMING: " + str(len(self._plan.pending())) + " of " + str(len(self._plan.operations)) +
+                      " operations pending.")
+        else:
+            self._build_plan()
+            if not self._diagnostics:
+                self._plan.save()
+
+        self._imgCount = sum(1 for operation in self._plan.operations
+                             if operation.op in archiveplan.FILE_OPERATIONS)
+        self._imgSize = sum(operation.size or 0 for operation in self._plan.operations
+                            if operation.op in archiveplan.FILE_OPERATIONS)
+        self._log("PLAN: " + self._plan.describe(self._plan.pending()))
+        self._execute_plan()
+        self._plan.finish()
+        self.log_summary()
+
+    def log_summary(self, prefix=""):
+        self._log(prefix + str(self._success_count) + " of " + str(self._currImgIndex) + " files copied.")
 
     @classmethod
-    def do(cls, src_path, dest_path, diagnostics, move, start_size):
+    def create(cls, src_path, dest_path, diagnostics, move, start_size, verify=False, dedup=None,
+               content_index=None, catalog=None, resume=True):
+        """
+        Args:
+          resume: Continue the plan of an interrupted run from the same source, destination and mode if there is one,
+              otherwise it is discarded and the source scanned again.
+          catalog: The Catalog of dest_path, the destination files existence and size are checked in it instead of
+              in the disk.
+          dedup: contentindex.SKIP to skip the files already anywhere in the archive, contentindex.LINK to hard link
+              them in their date folder instead, None to only check the date folder.
+          content_index: The ContentIndex of dest_path to use, one is created if dedup is set and it is None.
+        """
         obj = cls(src_path, dest_path)
         obj._diagnostics = diagnostics
         obj._move_files = move
         obj._start_size = int(start_size) * 1024 * 1024
+        obj._verify = verify
+        obj._dedup = dedup
+        obj._catalog = catalog
+        obj._resume = resume
+        if dedup is not None:
+            if content_index is None:
+                content_index = contentindex.ContentIndex(dest_path, obj._backup_file_exts)
+            obj._content_index = content_index
+        return obj
+
+    @classmethod
+    def do(cls, src_path, dest_path, diagnostics, move, start_size, verify=False, dedup=None, catalog=None,
+           resume=True, progress=None):
+        """progress is the progress.Progress the run is reported to, None to only log it."""
+        obj = cls.create(src_path, dest_path, diagnostics, move, start_size, verify, dedup, None, catalog, resume)
+        if progress is not None:
+            obj.progress = progress
+            obj.onAdvance = progress.on_archiver_advance
         print obj._start_size
 
         if obj._diagnostics:
             obj._log("WARING: Diagnostics mode activated.")
+        if obj._content_index is not None:
+            obj._log("Indexing '" + dest_path + "'")
+            obj._content_index.refresh()
         obj.archive_pictures()
 
     @classmethod
-    def correct_dates(cls, src_path):
+    def correct_dates(cls, src_path, incremental=True, jobs=1):
+        """Corrects the dates of every file under src_path, skipping the folders unchanged since the last pass.
+
+        With jobs > 1 the folders are corrected by a pool of that many processes, pyexiv2 is CPU bound.
+        """
         obj = cls(src_path, src_path)
-        obj._walk_dir_correct_date(src_path)
\ No newline at end of file
+        dir_index = None
+        if incremental:
+            dir_index = DirIndex(BuffData(), "correct-dates")
+        obj._walk_dir_correct_date(src_path, dir_index, jobs)
+
+
+_shard_archiver = None
+
+
+def _correct_dates_shard(shard):
+    """correct_dates task, returns (dir_name, files, corrected, errors, seconds, worker pid)."""
+    global _shard_archiver
+    dir_name, file_names = shard
+    if _shard_archiver is None:
+        _shard_archiver = PictureArchiver(dir_name, dir_name)
+
+    start = time.time()
+    corrected = 0
+    errors = 0
+    for name in file_names:
+        try:
+            if _shard_archiver._correct_file_date(os.path.join(dir_name, name)):
+                corrected += 1
+        except Exception as e:
+            _shard_archiver._error(e)
+            errors += 1
+    return dir_name, len(file_names), corrected, errors, time.time() - start, os.getpid()
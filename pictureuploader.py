@@ -1,47 +1,59 @@
 import os
 import sys
+import threading
 import time
 
 from db import BuffData
+from dirindex import DirIndex
+from manifest import Manifest
+import concurrency
+import dirwalker
+import httppool
+import progress
+import resumable
+import uploadpipeline
+import uploadqueue
 import utils
 
+INVENTORY_SYNC_KEY = "remote-inventory:"
+# Seconds the next incremental inventory sync starts before the last one, photos may be indexed late by the service
+INVENTORY_SYNC_OVERLAP = 3600
+_INVENTORY_BATCH = 500
+# Files recorded between two reads of the queue size for the progress
+_QUEUE_STATS_INTERVAL = 50
+
 
 class FileWithCallback(object):
-    def __init__(self, filename, org_filename=None):
+    """File being uploaded, the bytes read are counted in the Transfer of org_filename in progress."""
+
+    def __init__(self, filename, org_filename=None, progress=None):
         if org_filename is None:
             org_filename = filename
 
         self.file = open(filename, 'rb')
         self.filename = filename
         self._org_filename = org_filename
-        self._lastp = 0
         # the following attributes and methods are required
         self.len = os.path.getsize(filename)
         self.fileno = self.file.fileno
         self.tell = self.file.tell
-        self._start_time = time.time()
-        self._done_called = False
-
-    def callback(self, p):
-        if self._lastp != p:
-            print "Uploading file " + self._org_filename, str(p) + "%\r",
-            sys.stdout.flush()
-            self._lastp = p
+        self._transfer = progress.transfer(org_filename, self.len) if progress is not None else None
 
     def all_done(self):
-        if self._done_called:
-            return
+        if self._transfer is not None:
+            self._transfer.end()
+            self._transfer = None
 
-        print "Done with file " + self._org_filename, " - Uploaded ", utils.sizeof_fmt(self.len), "in", \
-            utils.format_time(time.time() - self._start_time), "\r",
-        print
-        self._done_called = True
+    def close(self):
+        self.all_done()
+        self.file.close()
 
-    def read(self, size):
-        self.callback(self.tell() * 100 // self.len)
+    def read(self, size=-1):
         r = self.file.read(size)
-        done = r is None or r == ""
-        if done:
+        if r:
+            if self._transfer is not None:
+                self._transfer.update(len(r))
+        else:
             self.all_done()
         return r
 
@@ -51,15 +63,28 @@ class PictureUploader:
         self._cloud_service_name = None
         self._dataHelper = BuffData()
         self._count = 0
-        self._total_pics_count = 0
-        self._nonpiccount = 0
-        self._total_pics_size = 0
-        self._nonpic_size = 0
+        self._manifest = None
+        self.incremental = True
         self._sizecount = 0
         self._failcount = 0
         self._starttime = 0
         self._allowed_file_exts = [".jpg", ".jpeg", ".png"]
+        self._uploaded_size = 0
         self.user_name = None
+        # Threads of each upload pipeline stage, see uploadpipeline.DEFAULT_WORKERS
+        self.workers = {}
+        # Uploads in flight allowed by the service, the actual number is adjusted to the link between 1 and this
+        self.max_uploads = 2
+        # find_remote() looks the files up in the inventory fetched by sync_inventory()
+        self.use_inventory = False
+        # File the progress is written to as JSON lines ("-" for the standard output), None for the status line
+        self.progress_file = None
+        self.progress = None
+        # Account the upload queue belongs to, set by the subclasses
+        self._account = ""
+        # The concurrency.AimdLimiter of the running upload
+        self._limiter = None
+        self._local = threading.local()
 
     def is_valid_file_type(self, file_name):
         fname, fext = os.path.splitext(file_name)
@@ -68,100 +93,297 @@ class PictureUploader:
     def _set_service_name(self, service_name):
         self._cloud_service_name = service_name
 
-    def _internal_scan_directory(self, dir_name):
-        if not os.path.isdir(dir_name):
-            sys.stderr.write(dir_name + " is not a directory.\n")
-            return
-
+    def _get_data(self):
+        # find_remote() runs in the pipeline threads, sqlite connections can't be shared between threads.
+        data = getattr(self._local, "data", None)
+        if data is None:
+            data = self._local.data = BuffData()
+        return data
+
+    def _inventory_scope(self):
+        return self._cloud_service_name + ":" + (self.user_name or "")
+
+    def sync_inventory(self, full=False):
+        """Fetches the photos added to the account since the last sync (all of them if full) into the local remote
+        inventory, so find_remote() does not query the service for every file. Returns the number of photos fetched.
+        """
+        scope = self._inventory_scope()
+        since = None
+        if full:
+            self._dataHelper.clear_remote_inventory(scope)
+        else:
+            last_sync = self._dataHelper.get_setting(INVENTORY_SYNC_KEY + scope)
+            if last_sync is not None:
+                since = float(last_sync) - INVENTORY_SYNC_OVERLAP
+
+        started = time.time()
+        photos = set()
+        entries = []
+        for remote_key, photo_id in self.fetch_inventory(since):
+            photos.add(photo_id)
+            entries.append((remote_key, photo_id))
+            if len(entries) >= _INVENTORY_BATCH:
+                self._dataHelper.set_remote_inventory(scope, entries)
+                entries = []
+        self._dataHelper.set_remote_inventory(scope, entries)
+
+        self._dataHelper.set_setting(INVENTORY_SYNC_KEY + scope, str(started))
+        self.use_inventory = True
+        return len(photos)
+
+    def fetch_inventory(self, since=None):
+        """Yields (remote_key, photo_id) for the photos in the account added after the since timestamp, or all."""
+        return iter([])
+
+    def inventory_keys(self, file_name, md5sum):
+        """The keys file_name may have in the remote inventory."""
+        return ["md5:" + md5sum]
+
+    def _get_dir_index(self, data):
+        if not self.incremental:
+            return None
+        return DirIndex(data, "upload:" + self._cloud_service_name)
+
+    def _internal_scan_directory(self, dir_name, manifest):
+        def count_non_picture(entry, reason):
+            manifest.add_other(entry.size)
+
+        # The scan may run in its own thread, sqlite connections can't be shared between threads.
+        dir_index = self._get_dir_index(BuffData() if self.incremental else None)
+        unchanged = dir_index.unchanged if dir_index is not None else None
         try:
-            dir_list = os.listdir(dir_name)
-        except OSError as e:
-            sys.stderr.write(str(e) + "\n")
-            return
-
-        for filename in dir_list:
-            src_file = os.path.join(dir_name, filename)
-            if os.path.isdir(src_file):
-                self._internal_scan_directory(src_file)
-                continue
-
-            if not os.path.isfile(src_file) or not self.is_valid_file_type(src_file):
-                self._nonpic_size += utils.get_file_size(src_file)
-                self._nonpiccount += 1
-                continue
-
-            self._total_pics_size += utils.get_file_size(src_file)
-            self._total_pics_count += 1
-
-    def scan_directory(self, dir_name):
-        self._nonpiccount = 0
-        self._total_pics_size = 0
-        self._nonpic_size = 0
-        self._total_pics_count = 0
-        self._internal_scan_directory(dir_name)
-        return self._total_pics_count, self._nonpiccount, self._total_pics_size, self._nonpic_size
-
-    def _internal_upload_directory(self, dir_name):
-        if not os.path.isdir(dir_name):
-            sys.stderr.write(dir_name + " is not a directory.\n")
-            return
+            for entry in dirwalker.walk(dir_name, self._allowed_file_exts, on_skip=count_non_picture,
+                                        yield_dirs=True, unchanged=unchanged):
+                if entry.is_dir:
+                    subdir_names = [os.path.basename(d) for d in entry.subdirs]
+                    manifest.add_dir(entry.path, utils.stat_mtime_ns(entry.stat()), entry.count - len(subdir_names),
+                                     subdir_names)
+                else:
+                    manifest.add(entry.path, entry.size)
+        finally:
+            manifest.close()
+
+    def start_scan(self, dir_name):
+        """Scans dir_name in a background thread, returns the manifest being filled."""
+        self._manifest = Manifest(dir_name)
+        thread = threading.Thread(target=self._internal_scan_directory, args=(dir_name, self._manifest))
+        thread.daemon = True
+        thread.start()
+        return self._manifest
+
+    def scan_directory(self, dir_name, manifest_file=None):
+        """Finds the files to upload in dir_name, the result is kept as a manifest for upload_directory.
+
+        If manifest_file exists, was made for dir_name and none of its folders changed since, it is loaded instead
+        of walking the folder, otherwise the manifest is saved to it after the scan.
+        """
+        manifest = None
+        if manifest_file is not None and os.path.isfile(manifest_file):
+            manifest = Manifest.load(manifest_file)
+            dir_index = self._get_dir_index(self._get_data())
+            if manifest.root != dir_name or \
+                    not manifest.is_current(dir_index.unchanged if dir_index is not None else None):
+                print "The manifest", manifest_file, "does not match", dir_name + ", scanning it again."
+                manifest = None
+
+        if manifest is None:
+            manifest = Manifest(dir_name)
+            self._internal_scan_directory(dir_name, manifest)
+            if manifest_file is not None:
+                manifest.save(manifest_file)
+
+        self._manifest = manifest
+        return manifest.count, manifest.other_count, manifest.size, manifest.other_size
+
+    def _internal_upload_directory(self, manifest, queue=None):
+        """Uploads the files of manifest, or the ones leased from queue if it is set."""
+        dir_index = self._get_dir_index(self._dataHelper) if queue is None else None
+        failed_dirs = set()
+        limiter = concurrency.AimdLimiter(self.workers.get(uploadpipeline.UPLOAD, 2), self.max_uploads)
+        decisions = [None]
+        status = self.progress
+        queue_total = [0, 0, 0]
+
+        def set_total():
+            if queue is None:
+                status.set_total(manifest.count, manifest.size, manifest.complete)
+                return
+
+            # The other workers take files from the queue too, the total is what this one did and what is left.
+            if queue_total[2] % _QUEUE_STATS_INTERVAL == 0:
+                stats = queue.stats()
+                left = [stats.get(state, (0, 0)) for state in (uploadqueue.PENDING, uploadqueue.LEASED)]
+                queue_total[0] = self._count + sum(count for count, size in left)
+                queue_total[1] = self._sizecount + sum(size for count, size in left)
+            queue_total[2] += 1
+            status.set_total(queue_total[0], queue_total[1], False)
+
+        def on_record(job):
+            if limiter.decision != decisions[0]:
+                decisions[0] = limiter.decision
+                status.note("Parallel uploads: " + limiter.decision)
 
+            self._count += 1
+            self._sizecount += job.size
+
+            uploaded = False
+            if job.already_uploaded:
+                status.note(u"File " + job.path + u" already uploaded.")
+            elif job.photo_id != 0:
+                self._dataHelper.set_file_uploaded(job.path, self._cloud_service_name, job.photo_id, job.md5sum)
+                self._uploaded_size += job.size
+                uploaded = True
+            else:
+                self._failcount += 1
+                failed_dirs.add(os.path.dirname(job.path))
+
+            if queue is not None:
+                if job.already_uploaded or job.photo_id != 0:
+                    finished = queue.complete(job.path)
+                else:
+                    finished = queue.fail(job.path, unicode(job.error) if job.error is not None else None)
+                if not finished:
+                    status.note(u"The lease of " + job.path + u" expired, it was left to another worker.")
+
+            # Only the bytes sent count for the throughput, not the files skipped.
+            set_total()
+            status.add(1, job.size, job.size if uploaded else 0, job.photo_id == 0 and not job.already_uploaded)
+
+        def on_dir(dir_name):
+            if dir_index is not None and dir_name not in failed_dirs:
+                dir_index.mark(dir_name, *manifest.dir_info(dir_name))
+
+        status.describe = limiter.describe
+        set_total()
+        self._limiter = limiter
         try:
-            dir_list = os.listdir(dir_name)
-        except OSError as e:
-            sys.stderr.write(str(e) + "\n")
-            return
-
-        for filename in dir_list:
-            src_file = os.path.join(dir_name, filename)
-            if os.path.isdir(src_file):
-                self._internal_upload_directory(src_file)
-                continue
-
-            if not os.path.isfile(src_file):
-                continue
+            uploadpipeline.UploadPipeline(self, self.workers, limiter=limiter).run(
+                manifest if queue is None else queue, on_record, on_dir)
+        finally:
+            self._limiter = None
 
-            # if file is not jpg then continue
-            if not self.is_valid_file_type(src_file):
-                print("File " + filename + " is not an allowed file type.\n")
-                continue
-
-            self._count += 1
-            file_size = utils.get_file_size(src_file)
-            self._sizecount += file_size
+    def upload_directory(self, dir_name):
+        """Uploads the files found by the last scan of dir_name, or scans it while uploading if there is none."""
+        self._starttime = time.time()
+        # One connection for each upload in flight and some for the API calls made meanwhile.
+        httppool.configure(pool_size=self.max_uploads + 2)
+        manifest = self._manifest
+        if manifest is None or manifest.root != dir_name:
+            manifest = self.start_scan(dir_name)
 
-            md5sum = utils.get_md5sum_from_file(src_file)
+        self.progress = progress.open_progress("pictures", self.progress_file)
+        try:
+            self._internal_upload_directory(manifest)
+        finally:
+            self.progress.close()
+            self.progress = None
+        return time.time() - self._starttime
 
-            uploaded = self._dataHelper.file_already_uploaded(self._cloud_service_name, md5sum)
-            if uploaded:
-                print "File", src_file, "already uploaded. 1"
-                continue
+    def open_queue(self, **kwargs):
+        """The uploadqueue.UploadQueue of the service and account, kwargs are passed to it."""
+        return uploadqueue.UploadQueue("upload:" + self._cloud_service_name + ":" + self._account, **kwargs)
 
-            stt = time.time()
-            photo_id = self.upload_file(src_file, md5sum)
-            secondstoupload = time.time() - stt
-            bits_per_second = file_size / secondstoupload
+    def enqueue_directory(self, dir_name, queue=None):
+        """Adds the files found in dir_name to the upload queue, returns the number added.
 
-            if photo_id != 0:
-                self._dataHelper.set_file_uploaded(src_file, self._cloud_service_name, photo_id, md5sum)
-            else:
-                self._failcount += 1
+        The files that failed too many times are queued again.
+        """
+        queue = queue or self.open_queue()
+        manifest = Manifest(dir_name)
+        self._internal_scan_directory(dir_name, manifest)
+        queue.retry_failed()
+        return queue.enqueue((path, size) for path, size in manifest if size is not None)
 
-            if self._total_pics_count > 0:
-                p = float(self._count) / float(self._total_pics_count) * 100.0
-                print str(int(p)) + "% done. (" + str(self._count), "of", self._total_pics_count, \
-                    "pictures,", self._failcount, "fails - " + utils.sizeof_fmt(self._sizecount) + \
-                                                  " of " + utils.sizeof_fmt(self._total_pics_size) + ") ETA: " + \
-                                                  utils.format_eta(bits_per_second, self._sizecount,
-                                                                   self._total_pics_size)
+    def work_queue(self, queue=None):
+        """Uploads the files leased from the upload queue until there are no pending ones, returns the seconds taken.
 
-    def upload_directory(self, dir_name):
+        The uploaded folders are not marked in the folder index, the files of a folder may be uploaded by several
+        workers.
+        """
+        queue = queue or self.open_queue()
         self._starttime = time.time()
-        self._internal_upload_directory(dir_name)
+        httppool.configure(pool_size=self.max_uploads + 2)
+        self.progress = progress.open_progress("pictures", self.progress_file)
+        queue.start_heartbeat(self.note)
+        try:
+            self._internal_upload_directory(None, queue)
+        finally:
+            queue.stop_heartbeat()
+            # Interrupted, the files leased and not finished are left to the other workers.
+            queue.release()
+            self.progress.close()
+            self.progress = None
         return time.time() - self._starttime
 
+    def open_upload(self, upload_name, file_name):
+        """Opens upload_name to be sent in place of file_name, counting the bytes read in the progress."""
+        return FileWithCallback(upload_name or file_name, file_name, self.progress)
+
+    def note(self, text):
+        """Prints text, without mixing it with the progress status line."""
+        if self.progress is not None:
+            self.progress.note(text)
+        else:
+            print text
+
+    def retry(self, func, description):
+        """resumable.retry() reporting the retries with note() and the throttling to the upload limiter."""
+        return resumable.retry(func, description, on_retry=self.on_retry)
+
+    def on_retry(self, description, error, delay):
+        limiter = self._limiter
+        if limiter is not None and concurrency.is_throttling(error):
+            # Fewer uploads in flight from now on, not once the retries of this one are exhausted.
+            limiter.throttled()
+        self.note(u"Retrying " + unicode(description or "") + u" in " + utils.format_time(delay) + u": " +
+                  unicode(error))
+
+    def start_transfer(self, file_name, size):
+        """Returns a progress.Transfer for the uploads not read through open_upload, None if there is no progress."""
+        if self.progress is None:
+            return None
+        return self.progress.transfer(file_name, size)
+
+    def find_remote(self, file_name, md5sum):
+        """Returns the id of file_name if the service already has it, 0 otherwise."""
+        if not self.use_inventory:
+            return 0
+
+        data = self._get_data()
+        scope = self._inventory_scope()
+        for remote_key in self.inventory_keys(file_name, md5sum):
+            photo_id = data.get_remote_photo_id(scope, remote_key)
+            if photo_id is not None:
+                return photo_id
+        return 0
+
+    def transform_file(self, file_name):
+        """Returns the name of a temporary file to upload in place of file_name, None to upload it as it is."""
+        return None
+
+    def send_file(self, file_name, md5sum, upload_name=None):
+        """Uploads file_name (or upload_name in its place), returns the new photo id or 0 if it failed."""
+        raise NotImplementedError("send_file not implement")
+
     def upload_file(self, file_name, md5sum=None):
-        raise NotImplementedError("upload_file not implement")
+        if md5sum is None:
+            md5sum = self._dataHelper.get_file_md5sum(file_name)
+
+        photo_id = self.find_remote(file_name, md5sum)
+        if photo_id != 0:
+            self.note(u"File " + file_name + u" already uploaded. ID: " + unicode(photo_id))
+            return photo_id
+
+        upload_name = None
+        try:
+            upload_name = self.transform_file(file_name)
+            return self.send_file(file_name, md5sum, upload_name)
+        except Exception as e:
+            sys.stderr.write(u"Error on " + file_name + u": " + unicode(e) + u"\n")
+            return 0
+        finally:
+            if upload_name is not None:
+                os.remove(upload_name)
 
     def authenticate(self):
         return True
@@ -0,0 +1,232 @@
+"""Progress of a long run: counts, bytes, throughput and ETA.
+
+The transfers report the bytes they send to a Progress, which adds the
+ones in flight to the finished files and renders the status from its own
+thread every interval seconds, instead of each read formatting and
+flushing a line. The throughput is an exponentially weighted moving
+average of the rate measured between renders, a sample weighs half after
+RATE_HALF_LIFE seconds, so the ETA follows the link without jumping with
+every file.
+
+In machine mode a JSON object is written per line instead: one per render
+("progress"), per message ("message") and a last one ("done"). Written to
+the standard output, it keeps it for itself and the rest of the prints of
+the run go to the standard error.
+
+"""
+
+import json
+import sys
+import threading
+import time
+
+import utils
+
+DEFAULT_INTERVAL = 0.5
+# Renders to a file or a pipe are full lines, less often.
+LOG_INTERVAL = 10.0
+RATE_HALF_LIFE = 10.0
+
+_stdout = None
+
+
+class Transfer(object):
+    """Bytes sent of a file in flight."""
+
+    def __init__(self, progress, name, size):
+        self.name = name
+        self.size = size
+        self.done = 0
+        self._progress = progress
+
+    def update(self, size):
+        """Adds size bytes sent."""
+        with self._progress._lock:
+            self.done += size
+
+    def set(self, done):
+        with self._progress._lock:
+            self.done = done
+
+    def end(self):
+        """Stops counting the transfer, its file is counted by Progress.add() once it is finished."""
+        with self._progress._lock:
+            self._progress._transfers.discard(self)
+
+
+class Progress(object):
+    def __init__(self, unit="files", output=None, machine=False, interval=DEFAULT_INTERVAL):
+        """
+        Args:
+          unit: What is counted, for the status line.
+          output: File the progress is written to, the standard output if None.
+          machine: Write JSON lines instead of the status line.
+        """
+        self.unit = unit
+        self.output = output or sys.stdout
+        self.machine = machine
+        self.tty = not machine and hasattr(self.output, "isatty") and self.output.isatty()
+        self.interval = interval if machine or self.tty else max(interval, LOG_INTERVAL)
+        # Callable returning a text added to the status line
+        self.describe = None
+        self.count = 0
+        self.size = 0
+        self.failed = 0
+        self.total_count = 0
+        self.total_size = 0
+        self.total_complete = True
+        self.rate = None
+        self._transferred = 0
+        self._transfers = set()
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._start_time = time.time()
+        self._sample = None
+        self._line_length = 0
+        self._close_output = False
+
+    def start(self):
+        self._start_time = time.time()
+        self._sample = (self._start_time, self._transferred)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def close(self):
+        """Stops rendering, writing the final status."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._render(True)
+        if self._close_output:
+            self.output.close()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._render()
+
+    def set_total(self, count, size, complete=True):
+        """complete is False while the files are still being found."""
+        with self._lock:
+            self.total_count = count
+            self.total_size = size
+            self.total_complete = complete
+
+    def add(self, count=1, size=0, transferred=None, failed=False):
+        """Counts finished files, transferred are the bytes sent for them (all of size if None)."""
+        with self._lock:
+            self.count += count
+            self.size += size
+            self._transferred += size if transferred is None else transferred
+            if failed:
+                self.failed += count
+
+    def set_done(self, count, size):
+        """Sets the finished files, for the runs that only know the position they are at."""
+        with self._lock:
+            self._transferred += max(0, size - self.size)
+            self.count = count
+            self.size = size
+
+    def transfer(self, name, size):
+        """Returns the Transfer of a file starting to be sent."""
+        transfer = Transfer(self, name, size)
+        with self._lock:
+            self._transfers.add(transfer)
+        return transfer
+
+    def on_archiver_advance(self, archiver):
+        """PictureArchiver.onAdvance hook."""
+        count, total_count, size, total_size = archiver.get_progress()
+        self.set_total(total_count, total_size)
+        self.set_done(count, size)
+
+    def _write(self, text):
+        if isinstance(text, unicode):
+            text = text.encode("utf-8")
+        self.output.write(text)
+        self.output.flush()
+
+    def note(self, text):
+        """Writes a message without mixing it with the status line."""
+        with self._lock:
+            if self.machine:
+                self._write(json.dumps({"event": "message", "text": text}) + "\n")
+            elif self.tty and self._line_length:
+                self._write("\r" + " " * self._line_length + "\r" + text + "\n")
+                self._line_length = 0
+            else:
+                self._write(text + "\n")
+
+    def _update_rate(self, now):
+        transferred = self._transferred + sum(t.done for t in self._transfers)
+        if self._sample is not None and now > self._sample[0]:
+            elapsed = now - self._sample[0]
+            rate = (transferred - self._sample[1]) / elapsed
+            if self.rate is None:
+                self.rate = rate
+            else:
+                self.rate += (1.0 - 0.5 ** (elapsed / RATE_HALF_LIFE)) * (rate - self.rate)
+        self._sample = (now, transferred)
+
+    def status(self):
+        """The current progress as a dict, the one written in machine mode."""
+        with self._lock:
+            done = self.size + sum(t.done for t in self._transfers)
+            eta = None
+            if self.rate:
+                eta = max(0.0, (self.total_size - done) / self.rate)
+            return {"elapsed": round(time.time() - self._start_time, 3), "count": self.count,
+                    "total_count": self.total_count, "total_complete": self.total_complete, "failed": self.failed,
+                    "bytes": done, "total_bytes": self.total_size, "active": len(self._transfers),
+                    "rate": round(self.rate, 1) if self.rate is not None else None,
+                    "eta": round(eta, 1) if eta is not None else None}
+
+    def format(self, status):
+        total = str(status["total_count"]) + ("" if status["total_complete"] else "+")
+        text = str(int(status["bytes"] * 100.0 / status["total_bytes"]) if status["total_bytes"] else 0) + \
+            "% done. (" + str(status["count"]) + " of " + total + " " + self.unit + ", " + \
+            str(status["failed"]) + " fails - " + utils.sizeof_fmt(status["bytes"]) + " of " + \
+            utils.sizeof_fmt(status["total_bytes"]) + ") " + \
+            (utils.sizeof_fmt(status["rate"]) + "/s" if status["rate"] is not None else "?/s") + \
+            " ETA: " + (utils.format_time(status["eta"]) if status["eta"] is not None else "?")
+        if self.describe is not None:
+            text += " - " + self.describe()
+        return text
+
+    def _render(self, final=False):
+        with self._lock:
+            self._update_rate(time.time())
+            status = self.status()
+            if self.machine:
+                status["event"] = "done" if final else "progress"
+                self._write(json.dumps(status, sort_keys=True) + "\n")
+            elif self.tty:
+                line = self.format(status)
+                self._write("\r" + line.ljust(self._line_length) + ("\n" if final else ""))
+                self._line_length = 0 if final else len(line)
+            else:
+                self._write(self.format(status) + "\n")
+
+
+def reserve_stdout():
+    """Keeps the standard output for the JSON lines, returns it. The prints go to the standard error from now on."""
+    global _stdout
+    if _stdout is None:
+        _stdout = sys.stdout
+        sys.stdout = sys.stderr
+    return _stdout
+
+
+def open_progress(unit, file_name=None):
+    """Starts a Progress writing the status line, or JSON lines to file_name ('-' for the standard output)."""
+    if file_name is None:
+        return Progress(unit).start()
+    if file_name == "-":
+        return Progress(unit, reserve_stdout(), True).start()
+    status = Progress(unit, open(file_name, "a"), True)
+    status._close_output = True
+    return status.start()
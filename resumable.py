@@ -0,0 +1,215 @@
+"""Chunked, resumable uploads and retry with backoff.
+
+Big files are sent with the Google resumable upload protocol: a POST
+with the metadata opens an upload session, then the data goes in chunks
+(PUT with Content-Range) and the server answers 308 with the range it has
+so far. The session URL and the confirmed offset are kept in BuffData,
+so a failed chunk, or a whole run stopped in the middle of a video, goes
+on from the last byte the server confirmed instead of from zero.
+
+Transient failures (connection errors, 408, 429 and 5xx) are retried
+after a random delay up to BACKOFF_BASE * 2 ^ attempt seconds (full
+jitter), so parallel uploads hitting the same failure don't retry in
+lockstep.
+
+"""
+
+import httplib
+import random
+import re
+import socket
+import time
+
+try:
+    import requests
+except ImportError:
+    requests = None
+
+import httppool
+import utils
+
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+# Google requires the chunks to be multiples of this, except the last one
+CHUNK_ALIGNMENT = 256 * 1024
+
+RETRY_STATUS = (408, 429, 500, 502, 503, 504)
+RETRY_ATTEMPTS = 8
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 64.0
+
+_RESUME_INCOMPLETE = 308
+_RANGE = re.compile(r"bytes=(\d+)-(\d+)")
+
+
+class TransientError(Exception):
+    def __init__(self, message, status=None):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+class SessionExpired(Exception):
+    pass
+
+
+def is_transient(error):
+    """True if the operation that raised error may succeed if tried again."""
+    if isinstance(error, (TransientError, socket.error, httplib.HTTPException)):
+        return True
+    if requests is not None and isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+
+    status = getattr(error, "status", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    try:
+        return int(status) in RETRY_STATUS
+    except (TypeError, ValueError):
+        return False
+
+
+def backoff_delay(attempt):
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * (2 ** attempt)))
+
+
+def print_retry(description, error, delay):
+    print "Retrying", description or "", "in", utils.format_time(delay) + ":", error
+
+
+def retry(func, description=None, attempts=None, on_retry=None):
+    """Calls func until it succeeds, retrying the transient errors with backoff. Re-raises the last error.
+
+    on_retry is called as on_retry(description, error, delay) before waiting to try again, print_retry if None.
+    """
+    attempts = attempts or RETRY_ATTEMPTS
+    on_retry = on_retry or print_retry
+    attempt = 0
+    while True:
+        try:
+            return func()
+        except Exception as e:
+            attempt += 1
+            if attempt >= attempts or not is_transient(e):
+                raise
+            delay = backoff_delay(attempt)
+            on_retry(description, e, delay)
+            time.sleep(delay)
+
+
+class ResumableUpload(object):
+    def __init__(self, data, service_name, file_name, md5sum, chunk_size=DEFAULT_CHUNK_SIZE, pool=None,
+                 on_progress=None, on_retry=None):
+        """
+        Args:
+          data: The BuffData of the calling thread, where the upload session is kept.
+          service_name: The service the session belongs to.
+          md5sum: Digest of file_name, a session of a file that changed since it was opened is not resumed.
+          on_progress: Called with the number of bytes confirmed by the server after every chunk.
+          on_retry: Called before every retry, see retry().
+        """
+        self._data = data
+        self._service_name = service_name
+        self._file_name = file_name
+        self._md5sum = md5sum
+        self._chunk_size = max(CHUNK_ALIGNMENT, chunk_size - chunk_size % CHUNK_ALIGNMENT)
+        self._pool = pool or httppool.get_pool()
+        self._on_progress = on_progress
+        self._on_retry = on_retry
+        self.size = utils.get_file_size(file_name)
+        self.resumed_from = 0
+
+    def _check(self, response, body):
+        if response.status in RETRY_STATUS:
+            raise TransientError("HTTP " + str(response.status) + " " + response.reason, response.status)
+        if response.status in (404, 410):
+            raise SessionExpired(self._file_name)
+        raise IOError("Upload of " + self._file_name + " failed: HTTP " + str(response.status) + " " +
+                      response.reason + " " + body[:200])
+
+    def _offset(self, response):
+        match = _RANGE.match(response.getheader("Range") or "")
+        return int(match.group(2)) + 1 if match else 0
+
+    def _create(self, url, metadata, metadata_type, content_type, headers):
+        request_headers = dict(headers)
+        request_headers.update({"Content-Type": metadata_type, "X-Upload-Content-Type": content_type,
+                                "X-Upload-Content-Length": str(self.size)})
+        response = self._pool.request("POST", url, metadata, request_headers)
+        body = response.read()
+        session_url = response.getheader("Location")
+        if response.status not in (200, 201) or not session_url:
+            self._check(response, body)
+        return session_url
+
+    def _query(self, session_url, headers):
+        """Returns the offset confirmed by the server, and the final response body if it already has everything."""
+        request_headers = dict(headers)
+        request_headers["Content-Range"] = "bytes */" + str(self.size)
+        response = self._pool.request("PUT", session_url, "", request_headers)
+        body = response.read()
+        if response.status == _RESUME_INCOMPLETE:
+            return self._offset(response), None
+        if response.status in (200, 201):
+            return self.size, body
+        self._check(response, body)
+
+    def _send_chunk(self, session_url, f, offset, headers):
+        f.seek(offset)
+        chunk = f.read(self._chunk_size)
+        request_headers = dict(headers)
+        request_headers["Content-Range"] = "bytes " + str(offset) + "-" + str(offset + len(chunk) - 1) + "/" + \
+                                           str(self.size)
+        response = self._pool.request("PUT", session_url, chunk, request_headers)
+        body = response.read()
+        if response.status == _RESUME_INCOMPLETE:
+            return self._offset(response), None
+        if response.status in (200, 201):
+            return self.size, body
+        self._check(response, body)
+
+    def upload(self, url, metadata, metadata_type, content_type, headers=None):
+        """Sends the file, resuming its last session if there is one. Returns the body of the final response."""
+        headers = headers or {}
+        session_url = None
+        offset = 0
+        result = None
+        session = self._data.get_upload_session(self._service_name, self._file_name, self._md5sum)
+        if session is not None:
+            # sqlite gives it back as unicode, httplib can't mix it with the binary body.
+            session_url = str(session[0])
+            try:
+                offset, result = retry(lambda: self._query(session_url, headers), self._file_name,
+                                       on_retry=self._on_retry)
+                self.resumed_from = offset
+            except SessionExpired:
+                session_url = None
+
+        if session_url is None:
+            session_url = retry(lambda: self._create(url, metadata, metadata_type, content_type, headers),
+                                self._file_name, on_retry=self._on_retry)
+            offset = 0
+            self._data.set_upload_session(self._service_name, self._file_name, self._md5sum, session_url, 0,
+                                          self.size)
+
+        uncertain = [False]
+
+        def send():
+            # After a failed chunk the server may have kept part of it, it is asked where to go on from.
+            position = offset
+            if uncertain[0]:
+                position, body = self._query(session_url, headers)
+                if body is not None:
+                    return position, body
+            uncertain[0] = True
+            sent = self._send_chunk(session_url, f, position, headers)
+            uncertain[0] = False
+            return sent
+
+        with open(self._file_name, "rb") as f:
+            while result is None:
+                offset, result = retry(send, self._file_name, on_retry=self._on_retry)
+                self._data.set_upload_offset(self._service_name, self._file_name, offset)
+                if self._on_progress is not None:
+                    self._on_progress(offset)
+
+        self._data.remove_upload_session(self._service_name, self._file_name)
+        return result
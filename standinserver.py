@@ -0,0 +1,240 @@
+import BaseHTTPServer
+import os
+import random
+import re
+import shutil
+import SocketServer
+import ssl
+import subprocess
+import tempfile
+import threading
+
+"""Local stand-in for the photo services, used by the benchmarks.
+
+Accepts uploads over HTTP/1.1 with keep-alive, optionally over TLS with a
+throwaway self signed certificate, and answers like the Flickr upload
+API. Every connection opened is counted, so a client that reuses them can
+be told from one that does not.
+
+It also speaks the Google resumable upload protocol (POST to
+/upload/resumable/... opens a session, PUT to the session sends the
+chunks) and can inject faults: with faults > 0, that fraction of the
+uploads is answered with a 503 or has its connection dropped halfway
+through the body, keeping what was received until then like a real
+server would.
+
+"""
+
+_RESPONSE = '<?xml version="1.0" encoding="utf-8" ?>\n<rsp stat="ok">\n<photoid>%d</photoid>\n</rsp>\n'
+_ENTRY = "<?xml version='1.0' encoding='UTF-8'?>\n<entry xmlns='http://www.w3.org/2005/Atom' " \
+         "xmlns:gphoto='http://schemas.google.com/photos/2007'><gphoto:id>%d</gphoto:id></entry>\n"
+_CONTENT_RANGE = re.compile(r"bytes (?:(\d+)-(\d+)|\*)/(\d+)")
+
+FAULT_ERROR = "error"
+FAULT_DROP = "drop"
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.stand_in.count_connection()
+
+    def _read_body(self, limit=None, keep=False):
+        """Reads the body, or its first limit bytes. Returns it if keep is set."""
+        remaining = int(self.headers.getheader("Content-Length") or 0)
+        if limit is not None:
+            remaining = min(remaining, limit)
+        parts = []
+        while remaining > 0:
+            data = self.rfile.read(min(remaining, 256 * 1024))
+            if not data:
+                break
+            remaining -= len(data)
+            self.server.stand_in.count_bytes(len(data))
+            if keep:
+                parts.append(data)
+        return "".join(parts)
+
+    def _drop(self):
+        """Reads half of the body and closes the connection without an answer."""
+        body = self._read_body(int(self.headers.getheader("Content-Length") or 0) // 2, True)
+        self.close_connection = 1
+        return body
+
+    def _reply(self, status, body, content_type="text/xml"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        stand_in = self.server.stand_in
+        if self.path.startswith("/upload/resumable/"):
+            self._read_body()
+            session_id = stand_in.open_session(int(self.headers.getheader("X-Upload-Content-Length")))
+            self.send_response(200)
+            self.send_header("Location", stand_in.url + "/session/" + str(session_id))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        fault = stand_in.fault()
+        if fault == FAULT_DROP:
+            self._drop()
+        elif fault == FAULT_ERROR:
+            self._read_body()
+            self._reply(503, "Service Unavailable", "text/plain")
+        else:
+            self._read_body()
+            self._reply(200, _RESPONSE % stand_in.next_id())
+
+    def do_PUT(self):
+        if not self.path.startswith("/session/"):
+            return self.do_POST()
+
+        stand_in = self.server.stand_in
+        session = stand_in.sessions.get(int(self.path.split("/")[2]))
+        match = _CONTENT_RANGE.match(self.headers.getheader("Content-Range") or "")
+        if session is None or match is None:
+            self._read_body()
+            return self._reply(404, "Not Found", "text/plain")
+
+        if match.group(1) is not None:
+            fault = stand_in.fault()
+            if fault == FAULT_DROP:
+                session.receive(int(match.group(1)), self._drop())
+                return
+            if fault == FAULT_ERROR:
+                self._read_body()
+                return self._reply(503, "Service Unavailable", "text/plain")
+            session.receive(int(match.group(1)), self._read_body(keep=True))
+        else:
+            self._read_body()
+
+        if session.complete:
+            return self._reply(201, _ENTRY % session.photo_id, "application/atom+xml")
+        self.send_response(308)
+        if session.data:
+            self.send_header("Range", "bytes=0-" + str(len(session.data) - 1))
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_GET(self):
+        self._reply(200, _RESPONSE % 0)
+
+    def log_message(self, message_format, *args):
+        pass
+
+
+class _Session(object):
+    def __init__(self, size, photo_id):
+        self.size = size
+        self.photo_id = photo_id
+        self.data = bytearray()
+        self.complete = False
+        self._lock = threading.Lock()
+
+    def receive(self, start, data):
+        with self._lock:
+            # A chunk sent again after a failure overwrites what the server kept of it, one starting after the
+            # received data is ignored, the client is told where to go on from.
+            if start <= len(self.data) and not self.complete:
+                del self.data[start:]
+                self.data += data
+                self.complete = len(self.data) >= self.size
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def handle_error(self, request, client_address):
+        # Clients closing their connections without a TLS shutdown.
+        pass
+
+
+class StandInServer(object):
+    def __init__(self, https=True, handler=_Handler, faults=0.0):
+        """
+        Args:
+          faults: Fraction of the uploads that fail, half of them with a 503 and half dropping the connection.
+        """
+        self.https = https
+        self.faults = faults
+        self.connections = 0
+        self.bytes_received = 0
+        self.faults_injected = 0
+        self.sessions = {}
+        self._handler = handler
+        self._ids = 0
+        self._lock = threading.Lock()
+        self._server = None
+        self._cert_folder = None
+
+    def _make_certificate(self):
+        self._cert_folder = tempfile.mkdtemp(prefix="standin_")
+        cert_file = os.path.join(self._cert_folder, "cert.pem")
+        key_file = os.path.join(self._cert_folder, "key.pem")
+        with open(os.devnull, "w") as devnull:
+            subprocess.check_call(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                                   "-subj", "/CN=localhost", "-keyout", key_file, "-out", cert_file],
+                                  stdout=devnull, stderr=devnull)
+        return cert_file, key_file
+
+    def start(self):
+        self._server = _Server(("127.0.0.1", 0), self._handler)
+        self._server.stand_in = self
+        if self.https:
+            cert_file, key_file = self._make_certificate()
+            self._server.socket = ssl.wrap_socket(self._server.socket, keyfile=key_file, certfile=cert_file,
+                                                  server_side=True)
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        if self._cert_folder is not None:
+            shutil.rmtree(self._cert_folder)
+            self._cert_folder = None
+
+    @property
+    def url(self):
+        return ("https" if self.https else "http") + "://127.0.0.1:" + str(self._server.server_address[1])
+
+    def client_context(self):
+        """ssl context of the clients, the certificate is not verified."""
+        return ssl._create_unverified_context() if self.https else None
+
+    def count_connection(self):
+        with self._lock:
+            self.connections += 1
+
+    def count_bytes(self, size):
+        with self._lock:
+            self.bytes_received += size
+
+    def next_id(self):
+        with self._lock:
+            self._ids += 1
+            return self._ids
+
+    def fault(self):
+        """Returns the fault to inject in an upload, None if it must succeed."""
+        if random.random() >= self.faults:
+            return None
+        with self._lock:
+            self.faults_injected += 1
+        return random.choice((FAULT_ERROR, FAULT_DROP))
+
+    def open_session(self, size):
+        session_id = self.next_id()
+        self.sessions[session_id] = _Session(size, session_id)
+        return session_id
@@ -0,0 +1,233 @@
+"""Staged upload of the files of a manifest.
+
+discover -> hash -> dedup check -> transform -> upload -> record
+
+Every stage runs in its own threads connected by bounded queues, so the
+next files are hashed and resized while several uploads are in flight,
+as many as the concurrency.AimdLimiter given allows.
+The discover stage iterates the manifest (which may still be filled by the
+scan) and the record stage runs in the calling thread, the only one that
+writes the upload results and marks the folders as done.
+
+"""
+
+import os
+import Queue
+import sys
+import threading
+import time
+
+from db import BuffData
+import concurrency
+
+HASH = "hash"
+DEDUP = "dedup"
+TRANSFORM = "transform"
+UPLOAD = "upload"
+
+DEFAULT_WORKERS = {HASH: 2, DEDUP: 1, TRANSFORM: 1, UPLOAD: 2}
+DEFAULT_QUEUE_SIZE = 8
+
+_DIR = "dir"
+
+
+class UploadJob(object):
+    """A file going through the pipeline. upload_name is the transformed file sent in its place, if any."""
+    __slots__ = ("path", "size", "md5sum", "upload_name", "photo_id", "already_uploaded", "error", "seconds")
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.md5sum = None
+        self.upload_name = None
+        self.photo_id = 0
+        self.already_uploaded = False
+        self.error = None
+        self.seconds = 0.0
+
+
+class _Stage(object):
+    def __init__(self, name, func, workers, queue_size):
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+        self.queue = Queue.Queue(queue_size)
+        self.next = None
+        self.results = None
+        self._running = self.workers
+        self._lock = threading.Lock()
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=self.name + "-" + str(i))
+            thread.daemon = True
+            thread.start()
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            try:
+                done = self.func(job)
+            except Exception as e:
+                job.error = e
+                done = True
+            # Failed and finished jobs go straight to the record stage.
+            if done or job.error is not None or self.next is None:
+                self.results.put(job)
+            else:
+                self.next.queue.put(job)
+
+        with self._lock:
+            self._running -= 1
+            last = self._running == 0
+        if last:
+            if self.next is not None:
+                for i in range(self.next.workers):
+                    self.next.queue.put(None)
+            else:
+                self.results.put(None)
+
+
+class UploadPipeline(object):
+    def __init__(self, uploader, workers=None, queue_size=DEFAULT_QUEUE_SIZE, limiter=None):
+        """
+        Args:
+          uploader: The PictureUploader that hashes, transforms and sends the files.
+          workers: Number of threads of each stage by name, DEFAULT_WORKERS for the missing ones.
+          limiter: A concurrency.AimdLimiter to adjust the uploads in flight, there is one upload thread for each of
+              its maximum.
+        """
+        self._uploader = uploader
+        self._workers = dict(DEFAULT_WORKERS)
+        self._workers.update(workers or {})
+        self._limiter = limiter
+        if limiter is not None:
+            self._workers[UPLOAD] = limiter.maximum
+        self._queue_size = queue_size
+        self._local = threading.local()
+        self._results = Queue.Queue()
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._closed = set()
+
+    def _get_data(self):
+        # sqlite connections can't be shared between threads.
+        data = getattr(self._local, "data", None)
+        if data is None:
+            data = self._local.data = BuffData()
+        return data
+
+    def _hash(self, job):
+        job.md5sum = self._get_data().get_file_md5sum(job.path)
+
+    def _dedup(self, job):
+        if self._get_data().file_already_uploaded(self._uploader._cloud_service_name, job.md5sum):
+            job.already_uploaded = True
+            return True
+
+        job.photo_id = self._uploader.find_remote(job.path, job.md5sum)
+        return job.photo_id != 0
+
+    def _transform(self, job):
+        job.upload_name = self._uploader.transform_file(job.path)
+
+    def _upload(self, job):
+        limiter = self._limiter
+        size = os.path.getsize(job.upload_name) if job.upload_name is not None else job.size
+        if limiter is not None:
+            limiter.acquire()
+        start = time.time()
+        error = None
+        try:
+            job.photo_id = self._uploader.send_file(job.path, job.md5sum, job.upload_name)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            job.seconds = time.time() - start
+            if limiter is not None:
+                limiter.release(size, job.seconds, error is not None or job.photo_id == 0,
+                                error is not None and concurrency.is_throttling(error))
+            if job.upload_name is not None:
+                os.remove(job.upload_name)
+
+    def _discover(self, manifest, first_stage):
+        try:
+            for path, size in manifest:
+                if size is None:
+                    # Folders come after all their files, it is marked when the last one is recorded.
+                    self._results.put((_DIR, path))
+                    continue
+
+                dir_name = os.path.dirname(path)
+                with self._lock:
+                    self._pending[dir_name] = self._pending.get(dir_name, 0) + 1
+                first_stage.queue.put(UploadJob(path, size))
+        finally:
+            for i in range(first_stage.workers):
+                first_stage.queue.put(None)
+
+    def _file_done(self, dir_name):
+        """Returns True if dir_name was closed and this was its last pending file."""
+        with self._lock:
+            count = self._pending[dir_name] - 1
+            if count > 0:
+                self._pending[dir_name] = count
+                return False
+            del self._pending[dir_name]
+            if dir_name in self._closed:
+                self._closed.discard(dir_name)
+                return True
+            return False
+
+    def _dir_done(self, dir_name):
+        """Returns True if every file of dir_name was recorded already."""
+        with self._lock:
+            if self._pending.get(dir_name, 0) == 0:
+                return True
+            self._closed.add(dir_name)
+            return False
+
+    def run(self, manifest, on_record=None, on_dir=None):
+        """Uploads the files of manifest.
+
+        Args:
+          on_record: Called with every UploadJob once it went through the pipeline, in the calling thread.
+          on_dir: Called with the path of every manifest folder once all its files were recorded.
+        """
+        stages = [_Stage(HASH, self._hash, self._workers[HASH], self._queue_size),
+                  _Stage(DEDUP, self._dedup, self._workers[DEDUP], self._queue_size),
+                  _Stage(TRANSFORM, self._transform, self._workers[TRANSFORM], self._queue_size),
+                  _Stage(UPLOAD, self._upload, self._workers[UPLOAD], self._queue_size)]
+        for stage, next_stage in zip(stages, stages[1:] + [None]):
+            stage.next = next_stage
+            stage.results = self._results
+            stage.start()
+
+        discover = threading.Thread(target=self._discover, args=(manifest, stages[0]))
+        discover.daemon = True
+        discover.start()
+
+        while True:
+            item = self._results.get()
+            if item is None:
+                break
+
+            if isinstance(item, tuple):
+                dir_name = item[1]
+                if self._dir_done(dir_name) and on_dir is not None:
+                    on_dir(dir_name)
+                continue
+
+            if item.error is not None:
+                sys.stderr.write(u"Error on " + item.path + u": " + unicode(item.error) + u"\n")
+            if on_record is not None:
+                on_record(item)
+
+            dir_name = os.path.dirname(item.path)
+            if self._file_done(dir_name) and on_dir is not None:
+                on_dir(dir_name)
+
+        discover.join()
@@ -0,0 +1,126 @@
+"""Persistent queue of the files to upload, drained by several workers.
+
+The files found by a walk are enqueued in picture-data.db and any number
+of worker processes, on this machine or on others sharing the database,
+lease them in small batches. A lease expires after lease_seconds unless
+the worker holding it renews it, which its heartbeat thread does while it
+runs, so the files leased by a worker that crashed go back to the queue
+and only those are delayed. Every lease counts as an attempt, a file that
+failed max_attempts times is left as failed.
+
+"""
+
+import os
+import socket
+import threading
+
+from db import BuffData
+
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+DEFAULT_LEASE_SECONDS = 600
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_BATCH = 16
+
+
+class UploadQueue(object):
+    def __init__(self, scope, lease_seconds=DEFAULT_LEASE_SECONDS, max_attempts=DEFAULT_MAX_ATTEMPTS, worker=None,
+                 batch=DEFAULT_BATCH):
+        """
+        Args:
+          scope: The service and account the queue belongs to.
+          worker: Name of the worker holding the leases, the host name and pid if None.
+          batch: Files leased at a time while iterating.
+        """
+        self.scope = scope
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.worker = worker or socket.gethostname() + ":" + str(os.getpid())
+        self.batch = batch
+        self._local = threading.local()
+        self._stop = threading.Event()
+        self._heartbeat = None
+        self._on_error = None
+
+    def _get_data(self):
+        # The queue is used from the pipeline threads, sqlite connections can't be shared between threads.
+        data = getattr(self._local, "data", None)
+        if data is None:
+            data = BuffData()
+            self._local.data = data
+        return data
+
+    def enqueue(self, entries):
+        """Adds the (path, size) entries not in the queue yet, returns the number added."""
+        return self._get_data().enqueue_uploads(self.scope, entries)
+
+    def lease(self, count=None):
+        """Returns up to count (path, size) pending entries, leased to this worker."""
+        return self._get_data().lease_uploads(self.scope, self.worker, count or self.batch, self.lease_seconds,
+                                              self.max_attempts)
+
+    def complete(self, path):
+        """Sets path done, returns False if its lease expired and another worker took it over."""
+        return self._get_data().finish_upload(self.scope, path, self.worker, DONE)
+
+    def fail(self, path, error=None):
+        """Puts path back in the queue, or leaves it as failed if it was already tried max_attempts times.
+
+        Returns False if its lease expired and another worker took it over, it is left to that one.
+        """
+        return self._get_data().finish_upload(self.scope, path, self.worker, FAILED, error, self.max_attempts)
+
+    def renew(self):
+        self._get_data().renew_upload_leases(self.scope, self.worker, self.lease_seconds)
+
+    def release(self):
+        """Gives back the entries leased and not finished, without counting the attempt."""
+        self._get_data().release_uploads(self.scope, self.worker)
+
+    def retry_failed(self):
+        """Puts the failed entries back in the queue, returns their number."""
+        return self._get_data().retry_failed_uploads(self.scope)
+
+    def stats(self):
+        """Returns a dict of (count, size) by state."""
+        return self._get_data().get_upload_queue_stats(self.scope)
+
+    def start_heartbeat(self, on_error=None):
+        """Renews the leases of this worker in a background thread until stop_heartbeat().
+
+        on_error is called with the message when the leases could not be renewed, it is printed if None.
+        """
+        self._on_error = on_error
+        self._stop.clear()
+        self._heartbeat = threading.Thread(target=self._renew_leases)
+        self._heartbeat.daemon = True
+        self._heartbeat.start()
+
+    def stop_heartbeat(self):
+        self._stop.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+            self._heartbeat = None
+
+    def _renew_leases(self):
+        while not self._stop.wait(self.lease_seconds / 3.0):
+            try:
+                self.renew()
+            except Exception as e:
+                message = u"Could not renew the upload leases: " + unicode(e)
+                if self._on_error is not None:
+                    self._on_error(message)
+                else:
+                    print message
+
+    def __iter__(self):
+        """Yields the (path, size) entries leased batch after batch until there are no pending ones."""
+        while True:
+            entries = self.lease()
+            if not entries:
+                return
+            for entry in entries:
+                yield entry
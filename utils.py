@@ -1,6 +1,5 @@
 import base64
 import getpass
-import hashlib
 import json
 import os
 import time
@@ -8,10 +7,16 @@ import pyexiv2
 import re
 import datetime
 
+import exifreader
+import filehash
+import mp4reader
+
 
 primary_backup_marker = "destination_folder"
 secondary_backup_marker = "secondary_backup"
 
+PICTURE_EXTENSIONS = [".jpg", ".jpeg", ".png"]
+
 
 def format_time(_time):
     days = int(_time // 86400)
@@ -60,25 +65,39 @@ def get_file_size(file_name):
         return 0
 
 
+def stat_mtime_ns(st):
+    try:
+        return st.st_mtime_ns
+    except AttributeError:
+        return int(round(st.st_mtime * 1000000000))
+
+
+def sql_like_escape(text):
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def makedirs(path):
+    """Like os.makedirs but doesn't fail if the folder already exists (or is created concurrently)."""
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
+
 def is_picture(file_name):
     fname, fext = os.path.splitext(file_name)
-    return fext.lower() in [".jpg", ".jpeg", ".png"]
+    return fext.lower() in PICTURE_EXTENSIONS
 
 
 def get_md5sum_from_file(file_name):
-    m = hashlib.md5()
-    with open(file_name, "rb") as f:
-        while True:
-            buf = f.read(128)
-            if not buf:
-                break
-            m.update(buf)
-
-    return m.hexdigest()
+    return filehash.md5sum(file_name)
 
 
 def get_exif_value(exif_data, key):
     try:
+        if isinstance(exif_data, dict):
+            return exif_data.get(key)
         return exif_data[key].value
     except Exception:
         return None
@@ -95,6 +114,10 @@ def read_picture_date(exif_data):
 
 
 def date_from_exif_data(filename):
+    exif_data = exifreader.read_exif(filename)
+    if exif_data is not None:
+        return read_picture_date(exif_data)
+
     try:
         exif_data = pyexiv2.ImageMetadata(filename)
         exif_data.read()
@@ -163,6 +186,8 @@ def get_picture_date(picture_path):
     obj_date = None
     if is_picture(picture_path):
         obj_date = date_from_exif_data(picture_path)
+    elif mp4reader.is_iso_media(picture_path):
+        obj_date = mp4reader.read_creation_date(picture_path)
 
     if obj_date is None:
         obj_date = get_date_from_filename(picture_path)